@@ -0,0 +1,6 @@
+"""Performance benchmarks for uvc. These are not part of the installed
+package; run them from the top of the source tree, for example::
+
+    python -m benchmarks.micro --output results.json
+    python -m benchmarks.micro --baseline results.json
+"""
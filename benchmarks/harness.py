@@ -0,0 +1,146 @@
+"""Timing, reporting and baseline comparison shared by the
+benchmark scripts."""
+
+import sys
+import json
+import time
+import platform
+from optparse import OptionParser
+
+if hasattr(time, "perf_counter"):
+    clock = time.perf_counter
+else:
+    clock = time.time
+
+class Benchmarks(object):
+    """Collects timings. Each benchmark is a function that is called
+    repeatedly; the reported figure is the best time per call, which
+    is the least disturbed by whatever else the machine is doing."""
+    
+    def __init__(self, repeat=5, min_time=0.05, name_filter=None):
+        self.repeat = repeat
+        self.min_time = min_time
+        self.name_filter = name_filter
+        self.results = {}
+    
+    def wanted(self, name):
+        return not self.name_filter or self.name_filter in name
+    
+    def time(self, name, func):
+        """Times func(), calling it enough times per repeat to run for
+        at least min_time seconds."""
+        if not self.wanted(name):
+            return
+        number = 1
+        while True:
+            elapsed = self._run(func, number)
+            if elapsed >= self.min_time or number >= 1000000:
+                break
+            number *= 10 if elapsed < self.min_time / 10 else 2
+        timings = [elapsed] + [self._run(func, number) 
+                               for i in range(self.repeat - 1)]
+        per_call = [timing / number for timing in timings]
+        self.results[name] = dict(best=min(per_call), 
+                                  mean=sum(per_call) / len(per_call),
+                                  calls=number, repeat=self.repeat)
+        print "%-60s %12.3f us" % (name, min(per_call) * 1e6)
+        sys.stdout.flush()
+    
+    def _run(self, func, number):
+        start = clock()
+        for i in xrange(number):
+            func()
+        return clock() - start
+    
+    def record(self, name, result):
+        """Stores a result that was measured some other way."""
+        self.results[name] = result
+
+def percentile(samples, percent):
+    """Returns the percentile of samples, interpolating between the
+    two nearest values."""
+    ordered = sorted(samples)
+    if not ordered:
+        return None
+    position = (len(ordered) - 1) * percent / 100.0
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    fraction = position - lower
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * fraction
+
+def summarize(samples):
+    """Summarizes a list of timings for reporting."""
+    return dict(count=len(samples), mean=sum(samples) / len(samples),
+                p50=percentile(samples, 50), p95=percentile(samples, 95),
+                p99=percentile(samples, 99), max=max(samples))
+
+def environment():
+    return dict(python=platform.python_version(), 
+                platform=platform.platform(),
+                time=time.strftime("%Y-%m-%dT%H:%M:%S"))
+
+def save(filename, results):
+    with open(filename, "w") as f:
+        json.dump(dict(environment=environment(), results=results), f,
+                  indent=2, sort_keys=True)
+
+def load(filename):
+    with open(filename) as f:
+        return json.load(f)["results"]
+
+def compare(results, baseline, threshold, key="best"):
+    """Prints how results compare with baseline and returns the names
+    of the benchmarks that got slower by more than threshold (a
+    fraction, so 0.1 is 10%)."""
+    regressions = []
+    print
+    print "%-60s %10s %10s %8s" % ("benchmark", "baseline", "current", 
+                                   "change")
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        old = baseline[name][key]
+        new = results[name][key]
+        if not old:
+            continue
+        change = (new - old) / old
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print "%-60s %10.4g %10.4g %+7.1f%%%s" % (name, old, new, 
+                                                  change * 100, flag)
+    return regressions
+
+def option_parser(usage):
+    parser = OptionParser(usage=usage)
+    parser.add_option("-o", "--output", dest="output",
+        help="write the results to this JSON file")
+    parser.add_option("-b", "--baseline", dest="baseline",
+        help="compare the results with this JSON file")
+    parser.add_option("-t", "--threshold", dest="threshold", type="float",
+        default=0.1, help="slowdown (as a fraction) that counts as a "
+        "regression [default: %default]")
+    parser.add_option("-f", "--filter", dest="name_filter",
+        help="only run benchmarks whose names contain this")
+    parser.add_option("-r", "--repeat", dest="repeat", type="int",
+        default=5, help="times to repeat each measurement [default: %default]")
+    parser.add_option("--min-time", dest="min_time", type="float",
+        default=0.05, help="minimum seconds per measurement "
+        "[default: %default]")
+    return parser
+
+def finish(options, results, key="best"):
+    """Saves and compares results as the command line options say,
+    returning the process exit status."""
+    if options.output:
+        save(options.output, results)
+    if options.baseline:
+        regressions = compare(results, load(options.baseline), 
+                              options.threshold, key)
+        if regressions:
+            print
+            print "%s benchmark(s) regressed by more than %d%%" % (
+                len(regressions), options.threshold * 100)
+            return 1
+    return 0
@@ -0,0 +1,137 @@
+"""Micro-benchmarks for uvc's in-process hot paths: command
+conversion, dialect inference, status parsing, path normalization and
+tree walking. Nothing here spawns a VCS.
+
+    python -m benchmarks.micro [--output FILE] [--baseline FILE]
+"""
+
+import sys
+import shutil
+import tempfile
+from cStringIO import StringIO
+
+from uvc import main, commands, hg
+from uvc.path import path
+
+from benchmarks import harness
+
+convert_cases = [
+    ("clone", ["clone", "http://example.com/repo", "newrepo"]),
+    ("commit", ["commit", "-m", "message", "file0.txt"]),
+    ("diff", ["diff", "file0.txt"]),
+    ("status", ["status"]),
+    ("add", ["add", "file0.txt", "file1.txt"]),
+    ("remove", ["remove", "file0.txt"]),
+    ("revert", ["revert", "file0.txt"]),
+    ("resolved", ["resolved", "file0.txt"]),
+    ("push", ["push", "http://example.com/repo"]),
+    ("update", ["update"]),
+]
+
+status_codes = "MARC!?I"
+
+def make_tree(root, dirs=20, files_per_dir=50):
+    """Creates a small working copy: dirs directories of files."""
+    for i in range(dirs):
+        directory = root / ("dir%s" % i)
+        directory.makedirs()
+        for j in range(files_per_dir):
+            (directory / ("file%s.txt" % j)).write_bytes("x")
+    for j in range(2):
+        (root / ("file%s.txt" % j)).write_bytes("x")
+
+def make_deep_tree(root, depth):
+    directory = root
+    for i in range(depth):
+        directory = directory / ("d%s" % i)
+    directory.makedirs()
+    return directory
+
+def status_text(lines):
+    return "".join("%s dir%s/file%s.txt\n" 
+                   % (status_codes[i % len(status_codes)], i % 100, i)
+                   for i in xrange(lines))
+
+def bench_convert(bench, root):
+    context = main.Context(root)
+    for dialect in ["hg", "git", "svn"]:
+        for name, args in convert_cases:
+            full_args = [dialect] + args
+            bench.time("convert.%s.%s" % (dialect, name),
+                       lambda: main.convert(context, list(full_args)))
+
+def bench_infer_dialect(bench, root):
+    hg_top = root / "hg_deep"
+    (hg_top / ".hg").makedirs()
+    deep = make_deep_tree(hg_top, 50)
+    bench.time("infer_dialect.depth50.found",
+               lambda: main.infer_dialect(deep))
+    
+    # nothing to find: walks all the way to /
+    none_deep = make_deep_tree(root / "none_deep", 50)
+    bench.time("infer_dialect.depth50.not_found",
+               lambda: main.infer_dialect(none_deep))
+    
+    siblings = [make_deep_tree(hg_top / ("sibling%s" % i), 10) 
+                for i in range(100)]
+    bench.time("infer_dialects.100_siblings",
+               lambda: main.infer_dialects(siblings))
+
+def bench_status_output(bench):
+    for lines in [100000, 1000000]:
+        bench_status_output_lines(bench, lines)
+
+def bench_status_output_lines(bench, lines):
+    text = status_text(lines)
+    bench.time("status_output.parse.%s" % lines,
+               lambda: commands.StatusOutput(0, StringIO(text)))
+    output = commands.StatusOutput(0, StringIO(text))
+    # as_list() is only built once, so time what it does
+    bench.time("status_output.as_list.%s" % lines, lambda: list(output))
+    bench.time("status_output.modified.%s" % lines,
+               lambda: sum(1 for filename in output.modified()))
+    bench.time("status_output.str.%s" % lines, lambda: str(output))
+    
+    # what hg status -0 produces
+    records = text.replace("\n", "\0")
+    bench.time("status_output.parse_hg.%s" % lines,
+               lambda: commands.StatusOutput(0, StringIO(records), 
+                                             hg._parse_status))
+
+def bench_normalize_path(bench, root):
+    context = main.Context(root)
+    secure = main.SecureContext(root)
+    bench.time("context.normalize_path",
+               lambda: context._normalize_path("dir1/../dir2/file3.txt"))
+    bench.time("secure_context.normalize_path",
+               lambda: secure._normalize_path("dir1/../dir2/file3.txt"))
+
+def bench_path(bench, root):
+    bench.time("path.walk.1000_files", lambda: list(root.walk()))
+    bench.time("path.walkfiles.1000_files", lambda: list(root.walkfiles()))
+    start = root / "a" / "b" / "c" / "d" / "e"
+    dest = root / "a" / "b" / "x" / "y" / "z" / "file.txt"
+    bench.time("path.relpathto", lambda: start.relpathto(dest))
+
+def main_(args=None):
+    parser = harness.option_parser("%prog [options]")
+    options, args = parser.parse_args(args)
+    bench = harness.Benchmarks(options.repeat, options.min_time,
+                               options.name_filter)
+    
+    root = path(tempfile.mkdtemp(prefix="uvc-bench-")).realpath()
+    try:
+        tree = root / "tree"
+        make_tree(tree)
+        bench_convert(bench, tree)
+        bench_infer_dialect(bench, root)
+        bench_status_output(bench)
+        bench_normalize_path(bench, tree)
+        bench_path(bench, tree)
+    finally:
+        shutil.rmtree(root)
+    
+    return harness.finish(options, bench.results)
+
+if __name__ == "__main__":
+    sys.exit(main_())
@@ -0,0 +1,262 @@
+"""End-to-end benchmarks that run real hg, git and svn commands
+through uvc against local repositories. Each dialect gets a "remote"
+repository (a bare git repository, an hg repository or a file://
+svn repository) of configurable size, and a number of editor
+sessions are run against it:
+
+    clone, edit, status, diff, add, add.all, commit, push, update
+
+add.all adds every new file, without naming them. For svn it is
+compared with add.all.two_pass, the svn status then svn add that uvc
+used to run for it.
+
+Latencies are reported as p50/p95/p99 per dialect and step::
+
+    python -m benchmarks.scenarios --files 1000 --history 50 \\
+        --sessions 20 --output scenarios.json
+
+Dialects whose command line tools are not installed are skipped."""
+
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+from cStringIO import StringIO
+
+from uvc import main
+from uvc.path import path
+
+from benchmarks import harness
+
+binaries = dict(hg=["hg"], git=["git"], svn=["svn", "svnadmin"])
+
+steps = ["clone", "edit", "status", "diff", "add", "add.all", 
+         "add.all.two_pass", "commit", "push", "update", "cli.status"]
+
+def available(dialect):
+    for binary in binaries[dialect]:
+        for directory in os.environ.get("PATH", "").split(os.pathsep):
+            if os.access(os.path.join(directory, binary), os.X_OK):
+                break
+        else:
+            return False
+    return True
+
+def call(command_line, cwd):
+    subprocess.check_call(command_line, cwd=cwd, stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT)
+
+def setup_environment(root):
+    """Gives the VCSes a user to commit as and enables hg's fetch
+    extension, which uvc's update uses."""
+    hgrc = root / "hgrc"
+    hgrc.write_text("[ui]\nusername = uvc bench <bench@example.com>\n"
+                    "[extensions]\nfetch =\n")
+    os.environ["HGRCPATH"] = hgrc
+    for prefix in ["GIT_AUTHOR", "GIT_COMMITTER"]:
+        os.environ[prefix + "_NAME"] = "uvc bench"
+        os.environ[prefix + "_EMAIL"] = "bench@example.com"
+
+def write_files(working_dir, count, revision):
+    """Writes count files spread over directories of 100 files."""
+    for i in range(count):
+        filename = working_dir / ("dir%s" % (i // 100)) / ("file%s.txt" % i)
+        if not filename.parent.exists():
+            filename.parent.makedirs()
+        filename.write_text("file %s revision %s\n" % (i, revision) * 20)
+
+def modify_files(working_dir, files, count, offset, marker):
+    for i in range(count):
+        number = (offset + i * 7919) % files
+        filename = working_dir / ("dir%s" % (number // 100)) / \
+            ("file%s.txt" % number)
+        filename.write_text(filename.text() + "%s\n" % marker)
+
+def create_remote(dialect, root, files, history):
+    """Creates the repository that sessions clone from, with files
+    files and history commits. Returns its URL."""
+    seed = root / ("%s-seed" % dialect)
+    seed.makedirs()
+    if dialect == "git":
+        remote = root / "remote.git"
+        call(["git", "init", "-q", "--bare", remote], root)
+        call(["git", "init", "-q"], seed)
+        commit = ["git", "commit", "-q", "-a", "-m"]
+        first_add = ["git", "add", "."]
+    elif dialect == "hg":
+        remote = root / "remote-hg"
+        call(["hg", "init", remote], root)
+        call(["hg", "clone", "-q", remote, seed], root)
+        commit = ["hg", "commit", "-m"]
+        first_add = ["hg", "add", "-q"]
+    else:
+        remote = root / "remote-svn"
+        call(["svnadmin", "create", remote], root)
+        url = "file://" + remote
+        call(["svn", "checkout", "-q", url, seed], root)
+        commit = ["svn", "commit", "-q", "-m"]
+        first_add = ["svn", "add", "-q", "--force", "."]
+    
+    write_files(seed, files, 0)
+    call(first_add, seed)
+    call(commit + ["initial"], seed)
+    for revision in range(1, history):
+        modify_files(seed, files, max(files // 20, 1), revision, 
+                     "history %s" % revision)
+        call(commit + ["history %s" % revision], seed)
+    
+    if dialect == "git":
+        call(["git", "push", "-q", remote, "HEAD:refs/heads/master"], seed)
+        call(["git", "symbolic-ref", "HEAD", "refs/heads/master"], remote)
+        return remote
+    elif dialect == "hg":
+        call(["hg", "push", "-q"], seed)
+        return remote
+    return "file://" + remote
+
+def write_new_files(working_dir, count, prefix):
+    """Writes count unversioned files, and a dotfile that adding
+    everything should leave alone."""
+    directory = working_dir / prefix
+    directory.makedirs()
+    for i in range(count):
+        (directory / ("file%s.txt" % i)).write_text("new file\n")
+    (directory / ".hidden").write_text("not for adding\n")
+
+def two_pass_svn_add(working_dir):
+    """What uvc ran for svn add without targets before it let svn find
+    the files: svn status, then svn add of each unknown file."""
+    output = subprocess.Popen(["svn", "status"], cwd=working_dir,
+                              stdout=subprocess.PIPE).communicate()[0]
+    unknown = [line[8:] for line in output.splitlines()
+               if line.startswith("?") and not line[8:].startswith(".")]
+    if unknown:
+        call(["svn", "add"] + unknown, working_dir)
+
+class Session(object):
+    """One editor session: a fresh clone that is edited and synced."""
+    
+    def __init__(self, dialect, url, sessions_dir, number, churn, files,
+                 timings):
+        self.dialect = dialect
+        self.url = url
+        self.sessions_dir = sessions_dir
+        self.number = number
+        self.churn = churn
+        self.files = files
+        self.timings = timings
+        self.dest = "session%s" % number
+        self.working_dir = sessions_dir / self.dest
+    
+    def timed(self, step, func):
+        start = harness.clock()
+        result = func()
+        self.timings.setdefault((self.dialect, step), []).append(
+            harness.clock() - start)
+        return result
+    
+    def run(self, args, context=None):
+        if context is None:
+            context = main.Context(self.working_dir)
+        command = main.convert(context, [self.dialect] + args)
+        output = main.run_command(command, context)
+        return_code = getattr(output, "return_code", 0)
+        if return_code:
+            raise RuntimeError("%s %s failed: %s" % (self.dialect, 
+                               " ".join(args), output))
+        # make sure the output has been consumed
+        str(output)
+        return output
+    
+    def cli(self, args):
+        """Runs uvc the way the uvc command line script does, which
+        works in the current directory."""
+        cwd = os.getcwd()
+        stdout = sys.stdout
+        os.chdir(self.working_dir)
+        sys.stdout = StringIO()
+        try:
+            main.run(["uvc"] + args)
+        finally:
+            sys.stdout = stdout
+            os.chdir(cwd)
+    
+    def go(self):
+        sessions_context = main.Context(self.sessions_dir)
+        self.timed("clone", lambda: self.run(["clone", self.url, self.dest],
+                                             sessions_context))
+        self.timed("edit", lambda: modify_files(self.working_dir, 
+                   self.files, self.churn, self.number, 
+                   "session %s" % self.number))
+        self.timed("status", lambda: self.run(["status"]))
+        self.timed("cli.status", lambda: self.cli(["status"]))
+        self.timed("diff", lambda: self.run(["diff"]))
+        new_file = "new%s.txt" % self.number
+        (self.working_dir / new_file).write_text("new file\n")
+        self.timed("add", lambda: self.run(["add", new_file]))
+        if self.dialect == "svn":
+            write_new_files(self.working_dir, self.churn, "two_pass")
+            self.timed("add.all.two_pass", 
+                       lambda: two_pass_svn_add(self.working_dir))
+        write_new_files(self.working_dir, self.churn, "new")
+        self.timed("add.all", lambda: self.run(["add"]))
+        self.timed("commit", lambda: self.run(["commit", "-m", 
+                   "session %s" % self.number]))
+        self.timed("push", lambda: self.run(["push"]))
+        self.timed("update", lambda: self.run(["update"]))
+
+def main_(args=None):
+    parser = harness.option_parser("%prog [options]")
+    parser.add_option("--files", dest="files", type="int", default=500,
+        help="files in each repository [default: %default]")
+    parser.add_option("--history", dest="history", type="int", default=20,
+        help="commits in each repository [default: %default]")
+    parser.add_option("--churn", dest="churn", type="int", default=10,
+        help="files edited in each session [default: %default]")
+    parser.add_option("--sessions", dest="sessions", type="int", 
+        default=10, help="sessions per dialect [default: %default]")
+    parser.add_option("--dialects", dest="dialects", default="hg,git,svn",
+        help="comma separated dialects to run [default: %default]")
+    parser.add_option("--key", dest="key", default="p95",
+        help="statistic compared with the baseline [default: %default]")
+    options, args = parser.parse_args(args)
+    
+    root = path(tempfile.mkdtemp(prefix="uvc-scenarios-")).realpath()
+    environ = dict(os.environ)
+    timings = {}
+    try:
+        setup_environment(root)
+        for dialect in options.dialects.split(","):
+            if not available(dialect):
+                print "Skipping %s: not installed" % dialect
+                continue
+            dialect_root = root / dialect
+            dialect_root.makedirs()
+            url = create_remote(dialect, dialect_root, options.files,
+                                options.history)
+            sessions_dir = dialect_root / "sessions"
+            sessions_dir.makedirs()
+            for number in range(options.sessions):
+                Session(dialect, url, sessions_dir, number, options.churn,
+                        options.files, timings).go()
+    finally:
+        os.environ.clear()
+        os.environ.update(environ)
+        shutil.rmtree(root)
+    
+    results = {}
+    print "%-24s %10s %10s %10s" % ("step", "p50 ms", "p95 ms", "p99 ms")
+    for (dialect, step), samples in sorted(timings.items()):
+        name = "%s.%s" % (dialect, step)
+        if not harness.Benchmarks(name_filter=options.name_filter) \
+           .wanted(name):
+            continue
+        results[name] = summary = harness.summarize(samples)
+        print "%-24s %10.2f %10.2f %10.2f" % (name, summary["p50"] * 1000,
+            summary["p95"] * 1000, summary["p99"] * 1000)
+    
+    return harness.finish(options, results, key=options.key)
+
+if __name__ == "__main__":
+    sys.exit(main_())
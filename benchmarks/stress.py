@@ -0,0 +1,131 @@
+"""Stress benchmarks using the fake VCS executables from
+uvc.tests.fakevcs: huge status and diff output, read all at once and
+streamed, trickling output and hung commands. Each case runs in its
+own process so that its peak memory use can be reported::
+
+    python -m benchmarks.stress --status-lines 2000000 \\
+        --diff-bytes 500000000 --output stress.json
+"""
+
+import sys
+import json
+import logging
+import resource
+import subprocess
+
+from uvc import main, commands, hg, git
+from uvc.tests.fakevcs import FakeVCS
+
+from benchmarks import harness
+
+def _context():
+    return main.Context(".")
+
+def status_buffered(options):
+    context = _context()
+    status = hg.status(commands.status(context, []))
+    return len(main.run_command(status, context).as_list())
+
+def status_streaming(options):
+    context = _context()
+    status = hg.status(commands.status(context, []))
+    count = 0
+    for entry in main.run_command(status, context, stream=True):
+        count += 1
+    return count
+
+def diff_buffered(options):
+    context = _context()
+    diff = git.diff(commands.diff(context, []))
+    return len(str(main.run_command(diff, context)))
+
+def diff_streaming(options):
+    context = _context()
+    diff = git.diff(commands.diff(context, []))
+    return sum(len(chunk) for chunk in 
+               main.run_command(diff, context, stream=True).chunks())
+
+def trickle_first_byte(options):
+    """Seconds until the first output of a slowly written diff
+    arrives."""
+    context = _context()
+    diff = git.diff(commands.diff(context, []))
+    start = harness.clock()
+    output = main.run_command(diff, context, stream=True)
+    output.chunks().next()
+    first = harness.clock() - start
+    output.close()
+    return first
+
+def hung_fetch(options):
+    context = _context()
+    update = hg.update(commands.update(context, []))
+    output = main.run_command(update, context, timeout=options.timeout)
+    assert output.timed_out
+    return len(str(output))
+
+cases = [status_buffered, status_streaming, diff_buffered, diff_streaming,
+         trickle_first_byte, hung_fetch]
+
+def fake_for(options):
+    fake = FakeVCS()
+    fake.set("hg", "status", lines=options.status_lines, 
+             line="M some/directory/file%(n)d.txt\0")
+    fake.set("git", "diff", bytes=options.diff_bytes)
+    fake.set("hg", "fetch", output="pulling from remote\n", hang=3600)
+    return fake
+
+def run_case(name, options):
+    """Runs one case in this process and prints its measurements."""
+    # the hung command is logged as a warning; keep that quiet
+    logging.basicConfig(level=logging.ERROR)
+    case = dict((case.__name__, case) for case in cases)[name]
+    fake = fake_for(options)
+    if name == "trickle_first_byte":
+        fake.set("git", "diff", bytes=options.diff_bytes, chunk_size=4096,
+                 delay=0.01)
+    with fake:
+        start = harness.clock()
+        result = case(options)
+        wall = harness.clock() - start
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    print json.dumps(dict(wall=wall, result=result, 
+                          max_rss_kb=usage.ru_maxrss))
+
+def main_(args=None):
+    parser = harness.option_parser("%prog [options]")
+    parser.add_option("--status-lines", dest="status_lines", type="int",
+        default=2000000, help="lines of status output [default: %default]")
+    parser.add_option("--diff-bytes", dest="diff_bytes", type="int",
+        default=100000000, help="bytes of diff output [default: %default]")
+    parser.add_option("--timeout", dest="timeout", type="float", default=1,
+        help="timeout for the hung command [default: %default]")
+    parser.add_option("--case", dest="case", help="(internal) run a single "
+        "case in this process")
+    parser.add_option("--key", dest="key", default="wall",
+        help="measurement compared with the baseline [default: %default]")
+    options, args = parser.parse_args(args)
+    
+    if options.case:
+        run_case(options.case, options)
+        return 0
+    
+    results = {}
+    print "%-24s %10s %12s" % ("case", "seconds", "max rss MB")
+    for case in cases:
+        name = case.__name__
+        if options.name_filter and options.name_filter not in name:
+            continue
+        output = subprocess.check_output([sys.executable, "-m", 
+            "benchmarks.stress", "--case", name, 
+            "--status-lines", str(options.status_lines),
+            "--diff-bytes", str(options.diff_bytes),
+            "--timeout", str(options.timeout)])
+        results[name] = result = json.loads(output.splitlines()[-1])
+        print "%-24s %10.3f %12.1f" % (name, result["wall"], 
+                                       result["max_rss_kb"] / 1024.0)
+    
+    return harness.finish(options, results, key=options.key)
+
+if __name__ == "__main__":
+    sys.exit(main_())
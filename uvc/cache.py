@@ -0,0 +1,250 @@
+"""Small in-memory caches used to avoid repeating work between
+commands."""
+
+import os
+import stat
+import hashlib
+import threading
+from collections import OrderedDict
+
+class LRUCache(object):
+    """A thread safe mapping that holds at most max_entries items,
+    throwing away the least recently used items when it is full.
+    If max_bytes is given, the sizes passed to put must add up to
+    no more than that as well.
+
+    A cache registered with a CacheManager also shares the manager's
+    budget with the other caches; the cost passed to put (roughly,
+    seconds of work to recreate the item, default_cost if it isn't
+    given) decides which cache gives up an item when that runs out."""
+
+    def __init__(self, max_entries=1000, max_bytes=None, default_cost=1.0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.default_cost = default_cost
+        self.manager = None
+        self.name = None
+        self._data = OrderedDict()
+        # key -> (size, cost, priority)
+        self._info = {}
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _priority(self, size, cost):
+        manager = self.manager
+        if manager is None:
+            return 0.0
+        return manager.priority(size, cost)
+
+    def get(self, key, default=None):
+        """Returns the value stored for key (marking it as recently
+        used), or default if there isn't one."""
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = value
+            size, cost, priority = self._info[key]
+            self._info[key] = (size, cost, self._priority(size, cost))
+            self.hits += 1
+            return value
+
+    def put(self, key, value, size=0, cost=None):
+        if cost is None:
+            cost = self.default_cost
+        with self._lock:
+            self._remove(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                # it would push everything else out, and still not fit
+                return
+            self._data[key] = value
+            self._info[key] = (size, cost, self._priority(size, cost))
+            self.bytes += size
+            while len(self._data) > self.max_entries or \
+                  (self.max_bytes is not None and self.bytes > self.max_bytes):
+                self._evict_oldest()
+        # outside the lock: the manager locks the other caches too
+        manager = self.manager
+        if manager is not None and size:
+            manager.enforce()
+
+    def _remove(self, key):
+        if key in self._data:
+            del self._data[key]
+            self.bytes -= self._info.pop(key)[0]
+            return True
+        return False
+
+    def _evict_oldest(self):
+        oldest = next(iter(self._data))
+        self._remove(oldest)
+        self.evictions += 1
+
+    def oldest_priority(self):
+        """Returns the eviction priority of the least recently used
+        item that takes up space, or None if there isn't one."""
+        with self._lock:
+            if not self.bytes:
+                return None
+            return self._info[next(iter(self._data))][2]
+
+    def evict_oldest(self):
+        with self._lock:
+            if self._data:
+                self._evict_oldest()
+
+    def pop(self, key, default=None):
+        with self._lock:
+            value = self._data.get(key, default)
+            self._remove(key)
+            return value
+
+    def discard_if(self, predicate):
+        """Removes every entry for which predicate(key, value) is
+        true."""
+        with self._lock:
+            for key, value in self._data.items():
+                if predicate(key, value):
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._info.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return dict(entries=len(self._data), bytes=self.bytes,
+                        hits=self.hits, misses=self.misses,
+                        evictions=self.evictions)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+class CacheManager(object):
+    """Holds the caches of a process to one budget of max_bytes.
+
+    When the registered caches add up to more than that, items are
+    evicted using GreedyDual-Size: each item's priority is its cost
+    per byte plus a clock that rises to the priority of each evicted
+    item, so that cheap, large and long unused items go first. Each
+    cache offers up its least recently used item, and the one with the
+    lowest priority is evicted."""
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.clock = 0.0
+        self._caches = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, lru):
+        """Adds lru (an LRUCache) to the budget under name, replacing
+        any cache already registered as name."""
+        with self._lock:
+            previous = self._caches.get(name)
+            if previous is not None:
+                previous.manager = None
+            lru.manager = self
+            lru.name = name
+            self._caches[name] = lru
+        self.enforce()
+        return lru
+
+    def unregister(self, name):
+        with self._lock:
+            lru = self._caches.pop(name, None)
+            if lru is not None:
+                lru.manager = None
+
+    def get_cache(self, name):
+        return self._caches.get(name)
+
+    def priority(self, size, cost):
+        return self.clock + float(cost) / max(size, 1)
+
+    @property
+    def bytes(self):
+        return sum(lru.bytes for lru in self._caches.values())
+
+    def set_budget(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.enforce()
+
+    def enforce(self):
+        """Evicts items until the caches fit in the budget."""
+        with self._lock:
+            if self.max_bytes is None:
+                return
+            while self.bytes > self.max_bytes:
+                victim = lowest = None
+                for lru in self._caches.values():
+                    priority = lru.oldest_priority()
+                    if priority is not None and \
+                       (lowest is None or priority < lowest):
+                        victim, lowest = lru, priority
+                if victim is None:
+                    return
+                self.clock = max(self.clock, lowest)
+                victim.evict_oldest()
+
+    def stats(self):
+        """Returns name -> dict(entries, bytes, hits, misses,
+        hit_ratio, evictions) for each registered cache."""
+        result = {}
+        for name, lru in self._caches.items():
+            stats = lru.stats()
+            lookups = stats["hits"] + stats["misses"]
+            stats["hit_ratio"] = float(stats["hits"]) / lookups \
+                                 if lookups else 0.0
+            result[name] = stats
+        return result
+
+# the manager for uvc's own caches
+manager = CacheManager()
+
+def _add_stat(digest, filename):
+    try:
+        info = os.lstat(filename)
+    except OSError:
+        digest.update("%s missing\0" % filename)
+        return None
+    digest.update("%s %s %s %s %r\0" % (filename, info.st_mode, info.st_ino,
+                                        info.st_size, info.st_mtime))
+    return info
+
+def fingerprint(filenames, trees=(), skip=()):
+    """Returns a digest of the size, modification time, inode and mode
+    of each of filenames, and of everything below each directory in
+    trees (apart from names in skip). If any of that changes, so does
+    the fingerprint. Symlinks are not followed."""
+    digest = hashlib.sha1()
+    for filename in filenames:
+        _add_stat(digest, filename)
+    for top in trees:
+        info = _add_stat(digest, top)
+        if info is None or not stat.S_ISDIR(info.st_mode):
+            continue
+        pending = [top]
+        while pending:
+            directory = pending.pop()
+            try:
+                names = sorted(os.listdir(directory))
+            except OSError:
+                continue
+            for name in names:
+                if name in skip:
+                    continue
+                child = os.path.join(directory, name)
+                info = _add_stat(digest, child)
+                if info is not None and stat.S_ISDIR(info.st_mode):
+                    pending.append(child)
+    return digest.digest()
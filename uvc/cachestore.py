@@ -0,0 +1,302 @@
+"""An on-disk cache shared by the processes on one machine, so that
+cached results survive restarts. Entries live in a sqlite database in
+write-ahead log mode: writes are transactions, so a crash never leaves
+a half written entry behind, and several processes can read and write
+at once.
+
+Entries are grouped into namespaces ("results", "dialects"...), each of
+which can have its own time to live. When the values add up to more
+than max_bytes, the least recently used entries are thrown away.
+
+Values are pickled, and unpickling runs code of the pickler's choosing,
+so the database is created readable and writable by its owner only,
+and a database (or write-ahead log) that anyone else could have
+written is refused."""
+
+import os
+import stat
+import time
+import errno
+import logging
+import sqlite3
+import threading
+import cPickle as pickle
+
+from uvc.exc import UVCError
+
+log = logging.getLogger("uvc.cachestore")
+
+class CacheStoreError(UVCError):
+    """The cache database can't be trusted."""
+    pass
+
+# run in one transaction, so that processes starting at the same time
+# don't trip over each other
+_schema = """
+BEGIN IMMEDIATE;
+CREATE TABLE IF NOT EXISTS entries (
+    namespace TEXT NOT NULL,
+    key BLOB NOT NULL,
+    value BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL,
+    PRIMARY KEY (namespace, key)
+);
+CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed);
+CREATE TABLE IF NOT EXISTS totals (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    bytes INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO totals (id, bytes) VALUES (0, 0);
+CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries
+BEGIN
+    UPDATE totals SET bytes = bytes + NEW.size WHERE id = 0;
+END;
+CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries
+BEGIN
+    UPDATE totals SET bytes = bytes - OLD.size WHERE id = 0;
+END;
+COMMIT;
+"""
+
+# reading an entry only records the access if it hasn't been recorded
+# for this many seconds, so that reads rarely need to write
+_touch_interval = 60
+
+def _normalize_key(key):
+    if isinstance(key, unicode):
+        return key.encode("utf-8")
+    if isinstance(key, str):
+        # subclasses (such as uvc.path.path) have a repr of their own
+        return str(key)
+    if isinstance(key, (tuple, list)):
+        return tuple(_normalize_key(each) for each in key)
+    if isinstance(key, bool) or key is None:
+        return key
+    if isinstance(key, (int, long)):
+        return int(key)
+    if isinstance(key, float):
+        return key
+    raise TypeError("Unsupported cache key: %r" % (key,))
+
+def _encode_key(key):
+    """Returns the database's form of key. Unlike a pickle, this is the
+    same for keys that are equal: it doesn't depend on which strings
+    happen to be the same object, or on unicode versus str."""
+    return sqlite3.Binary(repr(_normalize_key(key)))
+
+def _check_owner(filename):
+    """Raises CacheStoreError unless filename (if it exists) belongs to
+    this user and only they can write to it."""
+    try:
+        info = os.stat(filename)
+    except OSError, e:
+        if e.errno == errno.ENOENT:
+            return
+        raise CacheStoreError("Unable to check %s: %s" % (filename, e))
+    if info.st_uid != os.getuid():
+        raise CacheStoreError("%s belongs to another user" % (filename,))
+    if info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise CacheStoreError("%s can be written by other users" 
+                              % (filename,))
+
+class CacheStore(object):
+    """A cache in the sqlite database filename. ttls maps namespace
+    names to how many seconds their entries are good for; entries in
+    other namespaces last until they are evicted. busy_timeout is how
+    long to wait for another process that is writing.
+
+    Raises CacheStoreError if the database belongs to another user or
+    others can write to it."""
+
+    def __init__(self, filename, max_bytes=256 * 1024 * 1024, ttls=None,
+                 busy_timeout=10):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.ttls = dict(ttls or {})
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self._stats = {}
+        self._create_schema()
+
+    def _connect(self):
+        """Returns this thread's connection; sqlite connections can't
+        be shared between threads."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            self._create_file()
+            for suffix in ["", "-wal", "-shm"]:
+                _check_owner(self.filename + suffix)
+            connection = sqlite3.connect(self.filename,
+                                         timeout=self.busy_timeout,
+                                         isolation_level=None)
+            connection.text_factory = str
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def _create_file(self):
+        # sqlite would create it with the umask's permissions, and its
+        # write-ahead log and shared memory files take the same ones
+        try:
+            fd = os.open(self.filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                         0600)
+        except OSError, e:
+            if e.errno == errno.EEXIST:
+                return
+            raise CacheStoreError("Unable to create %s: %s" 
+                                  % (self.filename, e))
+        os.close(fd)
+
+    def _create_schema(self):
+        connection = self._connect()
+        for attempt in range(10):
+            try:
+                connection.executescript(_schema)
+                return
+            except sqlite3.OperationalError, e:
+                # another process created the tables while this one
+                # was preparing its statements
+                if "schema has changed" not in str(e):
+                    raise
+                try:
+                    connection.execute("ROLLBACK")
+                except sqlite3.OperationalError:
+                    # there was no transaction to roll back
+                    pass
+        connection.executescript(_schema)
+
+    def _count(self, namespace, name):
+        with self._stats_lock:
+            counts = self._stats.setdefault(namespace,
+                                            dict(hits=0, misses=0))
+            counts[name] += 1
+
+    def set_ttl(self, namespace, seconds):
+        """Entries in namespace expire seconds after they are stored
+        (None means they don't)."""
+        self.ttls[namespace] = seconds
+
+    def get(self, namespace, key, default=None):
+        """Returns the value stored for key in namespace, or default.
+        A database that can't be read counts as a miss."""
+        try:
+            return self._get(namespace, key, default)
+        except (sqlite3.Error, CacheStoreError), e:
+            log.warning("Unable to read from %s: %s", self.filename, e)
+            self._count(namespace, "misses")
+            return default
+
+    def _get(self, namespace, key, default):
+        connection = self._connect()
+        encoded_key = _encode_key(key)
+        row = connection.execute("SELECT value, created, accessed "
+                                 "FROM entries WHERE namespace = ? AND key = ?",
+                                 (namespace, encoded_key)).fetchone()
+        if row is None:
+            self._count(namespace, "misses")
+            return default
+
+        value, created, accessed = row
+        now = time.time()
+        ttl = self.ttls.get(namespace)
+        if ttl is not None and created + ttl < now:
+            connection.execute("DELETE FROM entries "
+                               "WHERE namespace = ? AND key = ?",
+                               (namespace, encoded_key))
+            self._count(namespace, "misses")
+            return default
+        if accessed + _touch_interval < now:
+            connection.execute("UPDATE entries SET accessed = ? "
+                               "WHERE namespace = ? AND key = ?",
+                               (now, namespace, encoded_key))
+        self._count(namespace, "hits")
+        return pickle.loads(str(value))
+
+    def put(self, namespace, key, value):
+        """Stores value (which must be picklable) for key. Failing to
+        write is logged rather than raised; it's only a cache."""
+        try:
+            self._put(namespace, key, value)
+        except (sqlite3.Error, CacheStoreError), e:
+            log.warning("Unable to write to %s: %s", self.filename, e)
+
+    def _put(self, namespace, key, value):
+        encoded_key = _encode_key(key)
+        pickled = pickle.dumps(value, 2)
+        size = len(pickled)
+        if size > self.max_bytes:
+            return
+        now = time.time()
+        connection = self._connect()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.execute("DELETE FROM entries "
+                               "WHERE namespace = ? AND key = ?",
+                               (namespace, encoded_key))
+            connection.execute("INSERT INTO entries (namespace, key, value, "
+                               "size, created, accessed) "
+                               "VALUES (?, ?, ?, ?, ?, ?)",
+                               (namespace, encoded_key,
+                                sqlite3.Binary(pickled), size, now, now))
+            self._evict(connection)
+        except:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def _evict(self, connection):
+        total = connection.execute("SELECT bytes FROM totals").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # make some room, so that every put doesn't have to evict
+        target = self.max_bytes * 0.9
+        rows = connection.execute("SELECT namespace, key, size FROM entries "
+                                  "ORDER BY accessed")
+        doomed = []
+        for namespace, key, size in rows:
+            if total <= target:
+                break
+            doomed.append((namespace, sqlite3.Binary(key)))
+            total -= size
+        connection.executemany("DELETE FROM entries "
+                               "WHERE namespace = ? AND key = ?", doomed)
+        log.debug("Evicted %s entries from %s", len(doomed), self.filename)
+
+    def delete(self, namespace, key):
+        self._connect().execute("DELETE FROM entries "
+                                "WHERE namespace = ? AND key = ?",
+                                (namespace, _encode_key(key)))
+
+    def clear(self, namespace=None):
+        if namespace is None:
+            self._connect().execute("DELETE FROM entries")
+        else:
+            self._connect().execute("DELETE FROM entries WHERE namespace = ?",
+                                    (namespace,))
+
+    def stats(self):
+        """Returns namespace -> dict(entries, bytes, hits, misses), with
+        the hits and misses of this process only."""
+        result = {}
+        rows = self._connect().execute("SELECT namespace, count(*), "
+                                       "total(size) FROM entries "
+                                       "GROUP BY namespace")
+        for namespace, entries, size in rows:
+            result[namespace] = dict(entries=entries, bytes=int(size),
+                                     hits=0, misses=0)
+        with self._stats_lock:
+            for namespace, counts in self._stats.items():
+                result.setdefault(namespace, dict(entries=0, bytes=0))
+                result[namespace].update(counts)
+        return result
+
+    def close(self):
+        """Closes this thread's connection."""
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
@@ -3,9 +3,12 @@ that are not specific to any given version control system."""
 
 from optparse import OptionParser
 from urlparse import urlparse, urlunparse
+from cStringIO import StringIO
+from array import array
 
 from uvc.path import path
 from uvc.exc import *
+from uvc import util
 
 import logging
 
@@ -22,6 +25,10 @@ class GetValueFromEditor(UVCError):
         self.prompt = prompt
     
 class BasicOutput(object):
+    # what running the command cost (a util.ResourceUsage), set by
+    # main.run_command
+    usage = None
+    
     def __init__(self, return_code, stdout):
         self.return_code = return_code
         self.output = stdout.read()
@@ -29,6 +36,57 @@ class BasicOutput(object):
     def __str__(self):
         return self.output
 
+class StreamingOutput(object):
+    """Output of a command that may still be running. Iterating over
+    it yields lines as the command produces them, and chunks()
+    yields raw blocks of output, so arbitrarily large output can
+    be passed along without holding it all in memory. return_code
+    is None until the output has been consumed."""
+    
+    def __init__(self, stream):
+        self.stream = stream
+    
+    @property
+    def return_code(self):
+        return self.stream.returncode
+    
+    @property
+    def timed_out(self):
+        return self.stream.timed_out
+    
+    @property
+    def usage(self):
+        """Set once the command has finished."""
+        return self.stream.usage
+    
+    def __iter__(self):
+        return iter(self.stream)
+    
+    def chunks(self):
+        return self.stream.chunks()
+    
+    def close(self):
+        """Stops the command if it is still running."""
+        self.stream.close()
+    
+    def __str__(self):
+        return self.stream.read()
+
+class TimeoutOutput(object):
+    """Output of a command that was killed because it ran longer
+    than its timeout. output is whatever it wrote before then."""
+    
+    return_code = None
+    timed_out = True
+    usage = None
+    
+    def __init__(self, timeout, output):
+        self.timeout = timeout
+        self.output = output
+    
+    def __str__(self):
+        return self.output
+
 class DialectCommand(object):
     """Base class for the dialect-specific command classes.
     If you subclass this, the default behavior is to pass
@@ -37,6 +95,23 @@ class DialectCommand(object):
     # dialects should override this
     dialect_name = ""
     
+    # how the VCS can read targets from a file when there are too many
+    # for the command line: (parts to put in their place, with %s for
+    # the file's name, the separator between targets), or None
+    targets_file = None
+    
+    # whether the output of a read only command may be cached (see
+    # main.use_result_cache); False for commands that name things,
+    # such as branches, that can move without the VCS metadata the
+    # cache checks changing
+    cacheable = True
+    
+    # whether execute just spawns the command line, so that it can
+    # also be run as a util.CommandStream (see main.start_command);
+    # dialects that override execute to run it some other way set
+    # this to False
+    spawns = True
+    
     @classmethod
     def from_args(cls, context, args):
         generic = globals()[cls.__name__](context, args)
@@ -51,11 +126,29 @@ class DialectCommand(object):
     def process_output(self, return_code, stdout):
         return BasicOutput(return_code, stdout)
     
+    def process_output_stream(self, stream):
+        """Like process_output, but for a command that is still
+        running. stream is a util.CommandStream."""
+        return StreamingOutput(stream)
+    
+    def process_batch_output(self, return_code, outputs):
+        """Like process_output, for a command whose targets were split
+        between several runs. outputs holds what each run printed, in
+        order."""
+        return self.process_output(return_code, StringIO("".join(outputs)))
+    
     def command_parts(self):
         return self.generic.command_parts()
     
     def get_command_line(self):
         return [self.dialect_name] + self.command_parts()
+    
+    def execute(self, working_dir, command_line, timeout=None):
+        """Runs command_line in working_dir, returning the return code,
+        a file-like object with the output and a util.ResourceUsage.
+        Dialects can override this to run commands some other way than
+        spawning them."""
+        return util.execute(working_dir, command_line, timeout=timeout)
         
     def set_auth(context):
         """Updates the authentication information based on the
@@ -66,9 +159,30 @@ class DialectCommand(object):
         pass
         
     def __getattr__(self, attr):
+        # commands like init have no generic command to pass through to
+        if attr == "generic":
+            raise AttributeError(attr)
         return getattr(self.generic, attr)
     
 class BaseCommand(object):
+    # seconds the command may run before it is killed. None means
+    # use main.local_timeout or main.remote_timeout, depending on
+    # whether the command talks to a remote repository. Dialect
+    # command classes can set this as well.
+    timeout = None
+    
+    # commands that make a new working copy set this, so that cached
+    # dialect inference below the working directory is thrown away
+    creates_repository = False
+    
+    # commands that only look at the working copy and repository set
+    # this, so that their output can be cached (see main.use_result_cache)
+    read_only = False
+    
+    # commands that do the same to each target set this, so that a
+    # long list of targets can be split between several runs
+    batchable = False
+    
     def __init__(self, context, args):
         self.working_dir = context.working_dir
         self.auth = context.auth
@@ -116,6 +230,7 @@ class clone(BaseCommand):
     
     reads_remote = True
     writes_remote = False
+    creates_repository = True
     
     @classmethod
     def guess_dialect(cls, context, args):
@@ -206,6 +321,7 @@ class commit(BaseCommand):
 class WithTargets(BaseCommand):
     """Base class for commands that take a set of target files"""
     targets_required = False
+    batchable = True
     
     def __init__(self, context, args):
         super(WithTargets, self).__init__(context, args)
@@ -231,6 +347,7 @@ class diff(WithTargets):
     
     reads_remote = False
     writes_remote = False
+    read_only = True
     
 class remove(WithTargets):
     """Remove a file from the repository."""
@@ -256,6 +373,7 @@ class status(WithTargets):
     
     reads_remote = False
     writes_remote = False
+    read_only = True
     
 class revert(WithTargets):
     """Revert a set of files"""
@@ -263,8 +381,103 @@ class revert(WithTargets):
     reads_remote = False
     writes_remote = False
 
+class cat(BaseCommand):
+    """Retrieves the contents of files as of a revision (by default,
+    the revision the working copy is based on)."""
+    
+    revision = None
+    
+    reads_remote = False
+    writes_remote = False
+    read_only = True
+    
+    parser = OptionParser()
+    parser.add_option("-r", "--rev", dest="revision",
+        help="revision to read the files from")
+    
+    def __init__(self, context, args):
+        super(cat, self).__init__(context, args)
+        options, args = self.parser.parse_args(args)
+        if not args:
+            raise BadArgument("You must list at least one file to read.")
+        # the files may not be in the working copy anymore, but
+        # they have to be inside of it
+        for target in args:
+            context._normalize_path(target)
+        self.revision = options.revision
+        self.targets = args
+    
+    def command_parts(self):
+        parts = ["cat"]
+        if self.revision:
+            parts.extend(["-r", self.revision])
+        parts.extend(self.targets)
+        return parts
+
+class attr(BaseCommand):
+    """Looks up attributes of files, such as whether they are text
+    or binary."""
+    
+    default_attributes = ["text", "binary", "eol", "diff", "merge"]
+    
+    reads_remote = False
+    writes_remote = False
+    read_only = True
+    
+    parser = OptionParser()
+    parser.add_option("-a", "--attribute", dest="attributes", 
+        action="append", help="attribute to look up (may be repeated)")
+    
+    def __init__(self, context, args):
+        super(attr, self).__init__(context, args)
+        options, args = self.parser.parse_args(args)
+        if not args:
+            raise BadArgument("You must list at least one file.")
+        for target in args:
+            context._normalize_path(target)
+        self.attributes = options.attributes or self.default_attributes
+        self.targets = args
+    
+    def command_parts(self):
+        parts = ["attr"]
+        for attribute in self.attributes:
+            parts.extend(["-a", attribute])
+        parts.extend(self.targets)
+        return parts
+
+class AttributesOutput(object):
+    """Output of the attr command: lines of "path: attribute: value"."""
+    
+    usage = None
+    
+    def __init__(self, return_code, stdout):
+        self.return_code = return_code
+        data = []
+        for line in stdout:
+            line = line.rstrip("\n")
+            if line:
+                data.append(line.rsplit(": ", 2))
+        self.data = data
+    
+    def as_dict(self):
+        """Returns {path: {attribute: value}}."""
+        result = {}
+        for filename, attribute, value in self.data:
+            result.setdefault(filename, {})[attribute] = value
+        return result
+    
+    def __str__(self):
+        return "".join(": ".join(info) + "\n" for info in self.data)
+
 class StatusOutput(object):
-    """Output specific to a status command."""
+    """Output specific to a status command.
+    
+    Working copies can have a very large number of files, so the
+    entries are not kept as Python objects. The states are kept in a
+    bytearray, and the filenames are packed one after the other into a
+    single buffer, along with an array of where each one ends. That is
+    about a tenth of the memory of a list of [state, filename] pairs.
+    as_list() builds those pairs (once) for code that wants them."""
     
     MODIFIED = "M"
     ADDED = "A"
@@ -275,32 +488,134 @@ class StatusOutput(object):
     IGNORED = "I"
     valid_values = set(['M', 'A', 'R', 'C', '!', '?', 'I'])
     
-    def __init__(self, returncode, stdout):
-        data = []
+    usage = None
+    
+    def __init__(self, returncode, stdout=None, parse=None):
+        """parse is a function that yields (state, filename) pairs
+        from stdout. The default reads "state filename" lines."""
+        self._states = bytearray()
+        self._filenames = bytearray()
+        self._ends = array("L")
+        self._counts = dict.fromkeys(self.valid_values, 0)
+        self._list = None
+        if stdout is not None:
+            for state, filename in (parse or _parse_status_lines)(stdout):
+                self.append(state, filename)
+    
+    def append(self, state, filename):
+        """Adds an entry. state is one of valid_values."""
+        self._states.append(state)
+        self._filenames.extend(filename)
+        self._ends.append(len(self._filenames))
+        self._counts[state] += 1
+        self._list = None
+    
+    def __len__(self):
+        return len(self._states)
+    
+    def count(self, state):
+        """Returns the number of entries with the given state."""
+        return self._counts.get(state, 0)
+    
+    def counts(self):
+        """Returns a dictionary of state -> number of entries."""
+        return dict(self._counts)
+    
+    def _filename(self, i):
+        start = self._ends[i - 1] if i else 0
+        return str(self._filenames[start:self._ends[i]])
+    
+    def __iter__(self):
+        """Yields [state, filename] pairs."""
+        for i in xrange(len(self._states)):
+            yield [chr(self._states[i]), self._filename(i)]
+    
+    def filenames(self, state):
+        """Yields the filenames of the entries with the given state."""
+        if not self._counts.get(state):
+            return
+        states = self._states
+        i = states.find(state)
+        while i != -1:
+            yield self._filename(i)
+            i = states.find(state, i + 1)
+    
+    def modified(self):
+        return self.filenames(self.MODIFIED)
+    
+    def added(self):
+        return self.filenames(self.ADDED)
+    
+    def removed(self):
+        return self.filenames(self.REMOVED)
+    
+    def clean(self):
+        return self.filenames(self.CLEAN)
+    
+    def missing(self):
+        return self.filenames(self.MISSING)
+    
+    def unknown(self):
+        return self.filenames(self.UNKNOWN)
+    
+    def ignored(self):
+        return self.filenames(self.IGNORED)
+    
+    def as_list(self):
+        if self._list is None:
+            self._list = list(self)
+        return self._list
+    
+    # older code used the list directly
+    data = property(as_list)
+    
+    def __str__(self):
+        return "".join("%s %s\n" % (chr(self._states[i]), self._filename(i))
+                       for i in xrange(len(self._states))) or "\n"
+
+def _parse_status_lines(stdout):
+    """Yields [state, filename] pairs from status output, reading
+    one line at a time."""
+    line = stdout.readline()
+    while line:
+        line = line.rstrip()
+        if line and line[0] in StatusOutput.valid_values:
+            yield line.split(" ", 1)
         line = stdout.readline()
-        while line:
-            line = line.rstrip()
-            if line and line[0] in StatusOutput.valid_values:
-                data.append(line.split(" ", 1))
-            line = stdout.readline()
-        self.data = data
+
+class StreamingStatusOutput(StreamingOutput):
+    """Status output that is parsed as the command produces it.
+    Iterating yields the same [state, filename] pairs that
+    StatusOutput.as_list() contains. parse is as for StatusOutput."""
+    
+    def __init__(self, stream, parse=None):
+        super(StreamingStatusOutput, self).__init__(stream)
+        self.parse = parse or _parse_status_lines
+    
+    def __iter__(self):
+        for state, filename in self.parse(self.stream):
+            yield [state, filename]
     
     def as_list(self):
-        return self.data
+        return list(self)
     
     def __str__(self):
-        return "\n".join(" ".join(info) for info in self.data) + "\n"
+        return "".join(" ".join(info) + "\n" for info in self)
         
 class SimpleStringOutput(object):
     """Output that doesn't involve a return code"""
     
     returncode = None
+    usage = None
     
     def __init__(self, output):
         self.output = output
         
     def __str__(self):
         return self.output
+    
+    def __iter__(self):
+        return iter(StringIO(self.output))
         
 class push(BaseCommand):
     """The push command"""
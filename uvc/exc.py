@@ -25,4 +25,22 @@ class RepositoryAlreadyInitialized(UVCError):
     """Denotes that a directory is already version
     controlled when the user tries to initialize
     it."""
-    pass
\ No newline at end of file
+    pass
+    
+class CommandLineTooLong(UVCError):
+    """The command's arguments are more than the system lets a command
+    be given."""
+    pass
+
+class CommandCancelled(UVCError):
+    """The command was stopped before it finished."""
+    pass
+
+class CommandTimeout(UVCError):
+    """The command ran longer than it was allowed to and was killed.
+    output holds whatever it had written until then."""
+    def __init__(self, message, timeout, output, usage=None):
+        UVCError.__init__(self, message)
+        self.timeout = timeout
+        self.output = output
+        self.usage = usage
\ No newline at end of file
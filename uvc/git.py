@@ -1,13 +1,57 @@
 """Implements the Git VCS dialect."""
 import os
+import mmap
+import posixpath
+import logging
+import stat
+import time
+import struct
+from collections import namedtuple
+from cStringIO import StringIO
 
-from uvc.commands import UVCError, DialectCommand, StatusOutput, BaseCommand
+from uvc.commands import UVCError, DialectCommand, StatusOutput, BaseCommand, \
+                        StreamingStatusOutput, AttributesOutput
 from uvc.exc import RepositoryAlreadyInitialized
+from uvc.path import path
+from uvc import gitbatch, util, commands, cache
+
+_log = logging.getLogger("uvc.git")
 
 class GitError(UVCError):
     """A Git-dialect specific error."""
     pass
 
+# long-running cat-file and check-attr processes, shared by the cat
+# and attr commands and by read_files/check_attributes
+batch_helpers = gitbatch.HelperPool()
+
+def read_files(working_dir, paths, revision="HEAD"):
+    """Returns the contents of each of the paths (relative to
+    working_dir) as of revision, or None for paths that do not exist
+    there. This goes through a git cat-file --batch process that is
+    kept running for the working directory."""
+    names = ["%s:./%s" % (revision, filename) for filename in paths]
+    return batch_helpers.cat_file(working_dir, names)
+
+def check_attributes(working_dir, paths, attributes):
+    """Returns a dictionary of attribute values for each of the paths
+    (relative to working_dir), using a git check-attr process that is
+    kept running for the working directory."""
+    return batch_helpers.check_attr(working_dir, attributes, paths)
+
+def _relative_targets(working_dir, targets):
+    working_dir = path(working_dir)
+    return [working_dir.relpathto(target) if os.path.isabs(target) 
+            else target for target in targets]
+
+def _helper_result(returncode, output, started):
+    """Builds execute's result for commands served by batch_helpers.
+    The helpers are shared, so only wall time and output size are
+    known for a single command."""
+    output = "".join(output)
+    usage = util.ResourceUsage(time.time() - started, len(output))
+    return [returncode, StringIO(output), usage]
+
 class GitCommand(DialectCommand):
     dialect_name = "git"
 
@@ -25,6 +69,7 @@ class AuthGitCommand(GitCommand):
 class init(GitCommand):
     reads_remote = False
     writes_remote = False
+    creates_repository = True
     
     @classmethod
     def from_args(cls, context, args):
@@ -44,19 +89,21 @@ class clone(AuthGitCommand):
     reads_remote = True
     writes_remote = False
 
-    def __init__(self, context, args):
-        super(clone, self).__init__(context, args)
+    def __init__(self, generic):
+        super(clone, self).__init__(generic)
         
         # If this is a git repository, make sure to
         # remove the extension in the URL
-        if self.dest[-4:] == ".git":
-            self.dest = self.dest[:-4]
+        if generic.dest[-4:] == ".git":
+            generic.dest = generic.dest[:-4]
 
 checkout = clone
 
 class commit(GitCommand):
     reads_remote = False
     writes_remote = False
+    targets_file = (["--pathspec-from-file=%s", "--pathspec-file-nul"], 
+                    "\0")
     
     def command_parts(self):
         parts = super(commit, self).command_parts()
@@ -71,6 +118,8 @@ class diff(GitCommand):
 class remove(GitCommand):
     reads_remote = False
     writes_remote = False
+    targets_file = (["--pathspec-from-file=%s", "--pathspec-file-nul"], 
+                    "\0")
     
     def command_parts(self):
         parts = super(remove, self).command_parts()
@@ -81,6 +130,8 @@ class remove(GitCommand):
 class add(GitCommand):
     reads_remote = False
     writes_remote = False
+    targets_file = (["--pathspec-from-file=%s", "--pathspec-file-nul"], 
+                    "\0")
     
 class push(AuthGitCommand):
     reads_remote = True
@@ -107,12 +158,141 @@ class resolved(GitCommand):
             parts.append("-a")
         return parts
         
+class cat(GitCommand):
+    reads_remote = False
+    writes_remote = False
+    spawns = False
+    
+    @property
+    def cacheable(self):
+        # HEAD and its branch are fingerprinted; other branches and
+        # tags aren't
+        revision = self.generic.revision
+        return revision is None or util.is_full_hash(revision)
+    
+    def command_parts(self):
+        revision = self.generic.revision or "HEAD"
+        targets = _relative_targets(self.generic.working_dir,
+                                    self.generic.targets)
+        return ["show"] + ["%s:./%s" % (revision, target) 
+                           for target in targets]
+    
+    def execute(self, working_dir, command_line, timeout=None):
+        started = time.time()
+        revision = self.generic.revision or "HEAD"
+        targets = _relative_targets(working_dir, self.generic.targets)
+        output = []
+        returncode = 0
+        for target, contents in zip(targets, 
+                                    read_files(working_dir, targets, revision)):
+            if contents is None:
+                output.append("fatal: path '%s' does not exist in '%s'\n"
+                              % (target, revision))
+                returncode = 128
+            else:
+                output.append(contents)
+        return _helper_result(returncode, output, started)
+
+class attr(GitCommand):
+    reads_remote = False
+    writes_remote = False
+    spawns = False
+    
+    def command_parts(self):
+        return ["check-attr"] + self.generic.attributes + ["--"] + \
+            _relative_targets(self.generic.working_dir, self.generic.targets)
+    
+    def execute(self, working_dir, command_line, timeout=None):
+        started = time.time()
+        targets = _relative_targets(working_dir, self.generic.targets)
+        attributes = self.generic.attributes
+        output = []
+        for target, values in zip(targets, check_attributes(working_dir,
+                                                  targets, attributes)):
+            for attribute in attributes:
+                output.append("%s: %s: %s\n" 
+                              % (target, attribute, values[attribute]))
+        return _helper_result(0, output, started)
+    
+    def process_output(self, returncode, stdout):
+        return AttributesOutput(returncode, stdout)
+
+def _change_state(xy):
+    """Converts the XY (index, work tree) code of a changed entry
+    in git status --porcelain=v2 to a uvc state."""
+    index, work_tree = xy
+    if index == "A":
+        return StatusOutput.ADDED
+    elif index == "D":
+        return StatusOutput.REMOVED
+    elif work_tree == "D":
+        return StatusOutput.MISSING
+    return StatusOutput.MODIFIED
+
+def _parse_status(stdout):
+    """Yields (state, filename) pairs from git status --porcelain=v2 -z.
+    Entries are NUL terminated; a renamed or copied entry is followed
+    by a second record with the original path. Renames come out the
+    way hg reports them, as an add and a remove."""
+    records = util.split_records(stdout)
+    for record in records:
+        kind = record[:1]
+        if kind == "1":
+            # 1 XY sub mH mI mW hH hI path
+            fields = record.split(" ", 8)
+            yield _change_state(fields[1]), fields[8]
+        elif kind == "2":
+            # 2 XY sub mH mI mW hH hI Xscore path, then the original path
+            fields = record.split(" ", 9)
+            original = next(records, None)
+            yield StatusOutput.ADDED, fields[9]
+            if fields[8].startswith("R") and original is not None:
+                yield StatusOutput.REMOVED, original
+        elif kind == "u":
+            # u XY sub m1 m2 m3 mW h1 h2 h3 path
+            yield StatusOutput.MODIFIED, record.split(" ", 10)[10]
+        elif kind == "?":
+            yield StatusOutput.UNKNOWN, record[2:]
+        elif kind == "!":
+            yield StatusOutput.IGNORED, record[2:]
+
 class status(GitCommand):
     reads_remote = False
     writes_remote = False
     
+    # whether files git doesn't track are reported
+    untracked = True
+    
+    def command_parts(self):
+        parts = super(status, self).command_parts()
+        parts[1:1] = ["--porcelain=v2", "-z"]
+        if not self.untracked:
+            parts.insert(3, "--untracked-files=no")
+        return parts
+    
+    def _parser(self):
+        """git reports paths relative to the root of the working copy;
+        the other dialects report them relative to the working
+        directory, and so does this."""
+        working_dir = os.path.abspath(self.generic.working_dir)
+        root = _find_git_root(working_dir)
+        if root is None or root == working_dir:
+            return _parse_status
+        prefix = os.path.relpath(working_dir, root).replace(os.sep, "/")
+        def parse(stdout):
+            for state, filename in _parse_status(stdout):
+                relative = posixpath.relpath(filename, prefix)
+                if filename.endswith("/"):
+                    # an untracked directory
+                    relative += "/"
+                yield state, relative
+        return parse
+    
     def process_output(self, returncode, stdout):
-        return StatusOutput(returncode, stdout)
+        return StatusOutput(returncode, stdout, self._parser())
+    
+    def process_output_stream(self, stream):
+        return StreamingStatusOutput(stream, self._parser())
     
 class revert(GitCommand):
     reads_remote = False
@@ -126,10 +306,284 @@ class revert(GitCommand):
         return parts
     
 
+class GitIndexError(GitError):
+    """The repository has no index, or one this can't read."""
+    pass
+
+# ctime, mtime (seconds and nanoseconds), dev, ino, mode, uid, gid and
+# size, then the object name and the flags
+_index_header = struct.Struct(">4sLL")
+_index_entry = struct.Struct(">10L20sH")
+_index_extension = struct.Struct(">4sL")
+_index_extended_flag = 0x4000
+_index_stage_mask = 0x3000
+_index_assume_valid = 0x8000
+_index_skip_worktree = 0x4000
+_index_intent_to_add = 0x2000
+
+IndexEntry = namedtuple("IndexEntry", "path mode size mtime ctime ino "
+                        "stage assume_unchanged intent_to_add")
+
+def _read_varint(data, offset):
+    """Reads the offset encoding of index version 4, returning the
+    value and the offset after it."""
+    byte = ord(data[offset])
+    offset += 1
+    value = byte & 0x7f
+    while byte & 0x80:
+        byte = ord(data[offset])
+        offset += 1
+        value = ((value + 1) << 7) | (byte & 0x7f)
+    return value, offset
+
+def _find_git_root(directory):
+    directory = os.path.abspath(directory)
+    while True:
+        if os.path.isdir(os.path.join(directory, ".git")):
+            return directory
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return None
+        directory = parent
+
+class GitIndex(object):
+    """Reads the entries of a repository's .git/index (versions 2 to
+    4) by mapping it into memory, without running git. Paths are
+    relative to the root of the working copy, with "/" between
+    directories. The trailing checksum isn't verified, and extensions
+    (the cache tree, the list of untracked files...) are ignored.
+    
+    Raises GitIndexError for a repository without an index, or with
+    an index this can't read, which includes a split index (whose
+    entries are partly in another file)."""
+    
+    def __init__(self, directory):
+        self.root = _find_git_root(directory)
+        if self.root is None:
+            raise GitIndexError("No git repository above %s" % directory)
+        self.filename = os.path.join(self.root, ".git", "index")
+        try:
+            with open(self.filename, "rb") as stream:
+                info = os.fstat(stream.fileno())
+                if info.st_size < _index_header.size:
+                    raise GitIndexError("%s is truncated" % self.filename)
+                self.data = mmap.mmap(stream.fileno(), 0, 
+                                      access=mmap.ACCESS_READ)
+        except (IOError, OSError, mmap.error), e:
+            raise GitIndexError("Unable to read %s: %s" 
+                                % (self.filename, e))
+        self.mtime = info.st_mtime
+        signature, self.version, self.count = \
+            _index_header.unpack_from(self.data, 0)
+        if signature != "DIRC" or self.version not in (2, 3, 4):
+            self.close()
+            raise GitIndexError("Unknown index format %s in %s"
+                                % (self.version, self.root))
+    
+    def entries(self):
+        """Yields an IndexEntry for each entry, in path order. mtime
+        and ctime are (seconds, nanoseconds) pairs; like size, they
+        are truncated to 32 bits the way git stores them."""
+        data = self.data
+        version = self.version
+        offset = _index_header.size
+        previous = ""
+        try:
+            for i in xrange(self.count):
+                start = offset
+                (ctime, ctime_ns, mtime, mtime_ns, dev, ino, mode, uid, gid,
+                 size, sha, flags) = _index_entry.unpack_from(data, offset)
+                offset += _index_entry.size
+                extended = 0
+                if flags & _index_extended_flag:
+                    extended, = struct.unpack_from(">H", data, offset)
+                    offset += 2
+                if version == 4:
+                    strip, offset = _read_varint(data, offset)
+                    end = data.find("\0", offset)
+                    name = previous[:len(previous) - strip] + data[offset:end]
+                    offset = end + 1
+                    previous = name
+                else:
+                    end = data.find("\0", offset)
+                    name = data[offset:end]
+                    # entries are padded with NULs to a multiple of 8
+                    offset = start + ((end - start + 8) & ~7)
+                if end < 0:
+                    raise GitIndexError("%s is truncated" % self.filename)
+                if not name:
+                    raise GitIndexError("%s has an entry without a name" 
+                                        % self.filename)
+                yield IndexEntry(name, mode, size, (mtime, mtime_ns), 
+                                 (ctime, ctime_ns), ino,
+                                 (flags & _index_stage_mask) >> 12,
+                                 bool(flags & _index_assume_valid or
+                                      extended & _index_skip_worktree),
+                                 bool(extended & _index_intent_to_add))
+            # the extensions follow, then the checksum; a split index
+            # has a link extension naming the file with the rest of
+            # its entries
+            end = len(data) - 20
+            while offset + _index_extension.size <= end:
+                signature, size = _index_extension.unpack_from(data, offset)
+                if signature == "link":
+                    raise GitIndexError("%s is a split index" 
+                                        % self.filename)
+                offset += _index_extension.size + size
+        except struct.error:
+            raise GitIndexError("%s is truncated" % self.filename)
+    
+    def _is_racy(self, entry):
+        # a file changed in the same second (or nanosecond, where it
+        # is recorded) as the index was written can't be trusted
+        seconds, nanoseconds = entry.mtime
+        return seconds + nanoseconds / 1e9 >= self.mtime
+    
+    def changed(self, entry):
+        """True if the file for entry may differ from what the index
+        recorded: its lstat data doesn't match, it is gone, it is
+        unmerged or only intended to be added, or its timestamp is as
+        new as the index."""
+        if entry.stage or entry.intent_to_add:
+            return True
+        try:
+            info = os.lstat(os.path.join(self.root, entry.path))
+        except OSError:
+            return True
+        if stat.S_IFMT(info.st_mode) != stat.S_IFMT(entry.mode) or \
+           (stat.S_ISREG(info.st_mode) and 
+            (info.st_mode & 0100) != (entry.mode & 0100)):
+            return True
+        if info.st_size & 0xffffffff != entry.size or \
+           info.st_ino & 0xffffffff != entry.ino:
+            return True
+        for recorded, actual in ((entry.mtime, info.st_mtime), 
+                                 (entry.ctime, info.st_ctime)):
+            seconds, nanoseconds = recorded
+            if int(actual) & 0xffffffff != seconds:
+                return True
+            # a float doesn't hold nanoseconds, so allow for rounding
+            if nanoseconds and \
+               abs(actual - int(actual) - nanoseconds / 1e9) > 1e-6:
+                return True
+        return self._is_racy(entry)
+    
+    def close(self):
+        self.data.close()
+
+def tracked_files(working_dir):
+    """Returns the tracked files, relative to the root of the working
+    copy, read from the index."""
+    index = GitIndex(working_dir)
+    try:
+        return [entry.path for entry in index.entries()
+                if not stat.S_ISDIR(entry.mode)]
+    finally:
+        index.close()
+
+def _changed_candidates(index):
+    candidates = []
+    seen = set()
+    for entry in index.entries():
+        if entry.assume_unchanged or stat.S_ISDIR(entry.mode) or \
+           entry.path in seen:
+            continue
+        # submodules never match, and are always checked
+        if index.changed(entry):
+            # unmerged files have an entry for each stage
+            seen.add(entry.path)
+            candidates.append(entry.path)
+    return candidates
+
+def changed_candidates(working_dir):
+    """Returns the tracked files (relative to the root of the working
+    copy) whose lstat data doesn't match the index, which are the only
+    ones git status could report as changed in the working tree.
+    Files marked assume-unchanged or skip-worktree are left out, as
+    git leaves them out. Raises GitIndexError if the index can't be
+    read."""
+    index = GitIndex(working_dir)
+    try:
+        return _changed_candidates(index)
+    finally:
+        index.close()
+
+def working_tree_status(working_dir):
+    """Returns a StatusOutput for the tracked files that have changed
+    in the working tree, running git status only for the files whose
+    lstat data doesn't match the index (or for everything, if the
+    index can't be read). Paths are relative to the root. Changes
+    that are only staged, and untracked files, aren't reported."""
+    from uvc import main
+    try:
+        index = GitIndex(working_dir)
+        try:
+            root = index.root
+            candidates = _changed_candidates(index)
+        finally:
+            index.close()
+    except GitIndexError, e:
+        _log.debug("Running a full git status instead: %s", e)
+        root = _find_git_root(working_dir) or working_dir
+        candidates = None
+    if candidates == []:
+        return StatusOutput(0)
+    
+    context = main.Context(root)
+    generic = commands.status(context, [])
+    if candidates is not None:
+        # set directly, as the files may no longer exist; literal, so
+        # that names with wildcards in them only match themselves
+        generic.targets = [":(literal)" + candidate 
+                           for candidate in candidates]
+    command = status(generic)
+    command.untracked = False
+    return main.run_command(command, context)
+
+def _config_files(marker):
+    """Returns git's config files for the repository in marker: its
+    own, the user's and the system's."""
+    xdg = os.environ.get("XDG_CONFIG_HOME") or os.path.expanduser("~/.config")
+    return [os.path.join(marker, "config"), os.path.expanduser("~/.gitconfig"),
+            os.path.join(xdg, "git", "config"), "/etc/gitconfig"]
+
+# root -> (fingerprint of the config files, core.excludesFile) as
+# last read from git
+_excludes_files = {}
+
+def _excludes_file(root, configs):
+    """Returns the user's global ignore file (core.excludesFile) for the
+    working copy at root. git is only asked again when one of configs
+    has changed."""
+    key = cache.fingerprint(configs)
+    cached = _excludes_files.get(root)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    retcode, stdout = util.run_in_directory(root, 
+        ["git", "config", "--path", "--get", "core.excludesFile"])
+    filename = stdout.read().strip()
+    if retcode != 0 or not filename:
+        xdg = os.environ.get("XDG_CONFIG_HOME") or \
+              os.path.expanduser("~/.config")
+        filename = os.path.join(xdg, "git", "ignore")
+    filename = os.path.join(root, filename)
+    _excludes_files[root] = (key, filename)
+    return filename
+
 class GitDialect(object):
     
     name = "git"
     
+    # the directory that marks a working copy of this dialect
+    marker = ".git"
+    
+    # the file in the marker directory that records what is tracked
+    state_files = ["index"]
+    
+    # files in any directory of the working tree that change what
+    # commands report about the files below it
+    directory_files = [".gitignore", ".gitattributes"]
+    
     def convert(self, command_object):
         """Converts to a Git-specific command."""
         local_command = self.get_dialect_command_class(command_object.__class__.__name__)
@@ -156,7 +610,29 @@ class GitDialect(object):
     
     def cwd_is_this_dialect(self):
         """Returns 1 if the .git directory is here, 0 otherwise."""
-        if os.path.isdir(".git"):
+        return self.is_this_dialect(os.getcwd())
+    
+    def is_this_dialect(self, directory):
+        """Returns 1 if the .git directory is in directory, 0 otherwise."""
+        if os.path.isdir(os.path.join(directory, self.marker)):
             return 1
         return 0
     
+    def fingerprint_files(self, root):
+        """Returns the files that change when the index, the current
+        commit or the ignore rules outside the working tree do, for
+        cache fingerprints."""
+        marker = os.path.join(root, self.marker)
+        configs = _config_files(marker)
+        files = [os.path.join(marker, "index"), os.path.join(marker, "HEAD"),
+                 os.path.join(marker, "packed-refs"),
+                 os.path.join(marker, "info", "exclude"),
+                 _excludes_file(root, configs)] + configs
+        try:
+            head = open(files[1]).read()
+        except IOError:
+            return files
+        if head.startswith("ref: "):
+            files.append(os.path.join(marker, head[5:].strip()))
+        return files
+    
@@ -0,0 +1,243 @@
+"""Long-running git helper processes (git cat-file --batch and
+git check-attr --stdin) for reading many blobs or attributes
+without spawning git for each one. Requests to a helper are
+pipelined: all of them are written before the responses are read."""
+
+import os
+import time
+import logging
+import threading
+import subprocess
+from collections import OrderedDict
+
+from uvc.exc import UVCError
+from uvc.util import _new_process_group, _kill_process_group
+
+log = logging.getLogger("uvc.gitbatch")
+
+# requests smaller than this fit in the pipe, so they can be written
+# without a separate writer thread
+_pipe_safe_size = 32768
+
+class HelperError(UVCError):
+    """A git helper process failed."""
+    pass
+
+class BatchHelper(object):
+    """A git process that reads requests on stdin and answers them on
+    stdout. Only one batch of requests is handled at a time."""
+    
+    def __init__(self, working_dir, command_line):
+        self.working_dir = working_dir
+        self.command_line = command_line
+        self.lock = threading.Lock()
+        self.last_used = time.time()
+        # how many callers have claimed the helper from its pool
+        self.users = 0
+        try:
+            self.process = subprocess.Popen(command_line, cwd=working_dir,
+                        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                        preexec_fn=_new_process_group, close_fds=True)
+        except OSError, e:
+            raise HelperError("Unable to start %s: %s" 
+                              % (" ".join(command_line), e))
+    
+    @property
+    def alive(self):
+        return self.process.poll() is None
+    
+    def _send(self, data):
+        """Writes data to the helper, from another thread if it might
+        not fit in the pipe. Returns the thread, if any, so that the
+        caller can join it after reading the responses."""
+        def write():
+            try:
+                self.process.stdin.write(data)
+                self.process.stdin.flush()
+            except (IOError, OSError), e:
+                log.debug("Writing to %s failed: %s", self.command_line, e)
+        if len(data) < _pipe_safe_size:
+            write()
+            return None
+        writer = threading.Thread(target=write)
+        writer.daemon = True
+        writer.start()
+        return writer
+    
+    def request(self, items):
+        """Sends all of the items and returns their responses, in
+        order."""
+        data = self.encode_requests(items)
+        with self.lock:
+            self.last_used = time.time()
+            writer = None
+            try:
+                writer = self._send(data)
+                return [self.read_response(item) for item in items]
+            except (IOError, OSError, ValueError), e:
+                self.close()
+                raise HelperError("%s failed: %s" 
+                                  % (" ".join(self.command_line), e))
+            finally:
+                if writer is not None:
+                    writer.join()
+                self.last_used = time.time()
+    
+    def _read_until(self, delimiter):
+        data = []
+        read = self.process.stdout.read
+        char = read(1)
+        while char != delimiter:
+            if not char:
+                raise IOError("unexpected end of output")
+            data.append(char)
+            char = read(1)
+        return "".join(data)
+    
+    def close(self):
+        if self.process.poll() is not None:
+            return
+        try:
+            self.process.stdin.close()
+        except (IOError, OSError):
+            pass
+        _kill_process_group(self.process)
+        self.process.wait()
+        self.process.stdout.close()
+
+class CatFile(BatchHelper):
+    """git cat-file --batch. Each request is an object name such as
+    "HEAD:./path/to/file" (relative to the working directory) or a
+    sha1. Each response is the object's contents, or None if there
+    is no such object."""
+    
+    def __init__(self, working_dir):
+        super(CatFile, self).__init__(working_dir, 
+                                      ["git", "cat-file", "--batch"])
+    
+    def encode_requests(self, names):
+        for name in names:
+            if "\n" in name:
+                raise HelperError("Object names cannot contain newlines: %r"
+                                  % (name,))
+        return "".join(name + "\n" for name in names)
+    
+    def read_response(self, name):
+        header = self.process.stdout.readline()
+        if not header:
+            raise IOError("unexpected end of output")
+        if header.endswith(" missing\n") or header.endswith(" ambiguous\n"):
+            return None
+        size = int(header.split()[2])
+        contents = self.process.stdout.read(size)
+        if len(contents) != size or self.process.stdout.read(1) != "\n":
+            raise IOError("truncated object %s" % (name,))
+        return contents
+
+class CheckAttr(BatchHelper):
+    """git check-attr --stdin -z for a fixed set of attributes. Each
+    request is a path relative to the working directory and each
+    response is a dictionary mapping attribute names to values
+    ("set", "unset", "unspecified" or the value)."""
+    
+    def __init__(self, working_dir, attributes):
+        self.attributes = list(attributes)
+        super(CheckAttr, self).__init__(working_dir, 
+            ["git", "check-attr", "--stdin", "-z"] + self.attributes)
+    
+    def encode_requests(self, paths):
+        return "".join(path + "\0" for path in paths)
+    
+    def read_response(self, path):
+        result = {}
+        for attribute in self.attributes:
+            self._read_until("\0")
+            name = self._read_until("\0")
+            result[name] = self._read_until("\0")
+        return result
+
+class HelperPool(object):
+    """Keeps helpers running per working directory, up to max_size of
+    them. The least recently used helper is stopped to make room, and
+    helpers idle for more than idle_timeout seconds are stopped."""
+    
+    def __init__(self, max_size=16, idle_timeout=60):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.helpers = OrderedDict()
+        self.lock = threading.Lock()
+    
+    def get(self, key, factory):
+        """Claims the helper for key, calling factory() to start one if
+        there is no live helper for it yet. The helper is not stopped
+        until it has been given back with release()."""
+        evicted = []
+        with self.lock:
+            now = time.time()
+            for other_key, helper in self.helpers.items():
+                if other_key != key and not helper.users \
+                   and now - helper.last_used > self.idle_timeout:
+                    evicted.append(self.helpers.pop(other_key))
+            helper = self.helpers.pop(key, None)
+            if helper is not None and not helper.alive:
+                evicted.append(helper)
+                helper = None
+            if helper is None:
+                helper = factory()
+            helper.users += 1
+            helper.last_used = now
+            # most recently used goes last
+            self.helpers[key] = helper
+            if len(self.helpers) > self.max_size:
+                for other_key, other in self.helpers.items():
+                    if len(self.helpers) <= self.max_size:
+                        break
+                    if not other.users:
+                        evicted.append(self.helpers.pop(other_key))
+        for old_helper in evicted:
+            old_helper.close()
+        return helper
+    
+    def release(self, helper):
+        """Gives back a helper claimed with get()."""
+        with self.lock:
+            helper.users -= 1
+            helper.last_used = time.time()
+    
+    def _request_once(self, key, factory, items):
+        helper = self.get(key, factory)
+        try:
+            return helper.request(items)
+        finally:
+            self.release(helper)
+    
+    def _request(self, key, factory, items):
+        try:
+            return self._request_once(key, factory, items)
+        except HelperError, e:
+            # the helper may have died; a fresh one gets one more
+            # chance
+            log.debug("Retrying with a new helper: %s", e)
+            return self._request_once(key, factory, items)
+    
+    def cat_file(self, working_dir, names):
+        """Returns the contents of the named objects (None for those
+        that do not exist)."""
+        working_dir = os.path.realpath(working_dir)
+        return self._request(("cat-file", working_dir),
+                             lambda: CatFile(working_dir), names)
+    
+    def check_attr(self, working_dir, attributes, paths):
+        """Returns a dictionary of attribute values for each path."""
+        working_dir = os.path.realpath(working_dir)
+        attributes = tuple(attributes)
+        return self._request(("check-attr", working_dir, attributes),
+                             lambda: CheckAttr(working_dir, attributes),
+                             paths)
+    
+    def close(self):
+        with self.lock:
+            helpers = self.helpers.values()
+            self.helpers.clear()
+        for helper in helpers:
+            helper.close()
@@ -1,15 +1,76 @@
 """Implements the Mercurial VCS dialect."""
 import os
+import time
+import logging
+from cStringIO import StringIO
 
-from uvc.commands import UVCError, DialectCommand, StatusOutput, BaseCommand
+from uvc.commands import UVCError, DialectCommand, StatusOutput, BaseCommand, \
+                        StreamingStatusOutput
 from uvc.exc import RepositoryAlreadyInitialized
+from uvc import hgserver, util
+
+_log = logging.getLogger("uvc.hg")
 
 class HgError(UVCError):
     """A Mercurial-dialect specific error."""
     pass
 
+# when set (see use_command_server), local commands are run through
+# a persistent hg command server instead of spawning hg every time
+command_server_pool = None
+
+def use_command_server(idle_timeout=300, max_servers=32):
+    """Runs hg commands that do not talk to a remote repository
+    through a command server kept running for each working directory,
+    which avoids paying hg's startup cost on every command. Servers
+    idle for idle_timeout seconds are stopped."""
+    global command_server_pool
+    stop_command_server()
+    command_server_pool = hgserver.CommandServerPool(idle_timeout,
+                                                     max_servers)
+
+def stop_command_server():
+    """Stops all command servers and goes back to spawning hg."""
+    global command_server_pool
+    pool = command_server_pool
+    command_server_pool = None
+    if pool is not None:
+        pool.close()
+
 class HgCommand(DialectCommand):
     dialect_name = "hg"
+    
+    # every command that takes files takes patterns, and listfile0:
+    # is a pattern
+    targets_file = (["listfile0:%s"], "\0")
+    
+    @property
+    def spawns(self):
+        return command_server_pool is None or self.reads_remote \
+            or self.writes_remote
+    
+    def execute(self, working_dir, command_line, timeout=None):
+        pool = command_server_pool
+        if pool is None or self.reads_remote or self.writes_remote:
+            return super(HgCommand, self).execute(working_dir, command_line,
+                                                  timeout)
+        started = time.time()
+        try:
+            returncode, output = pool.run(working_dir, command_line[1:],
+                                          timeout)
+        except hgserver.CommandServerError, e:
+            # running a command that changes things again could do it
+            # twice, unless it never reached the server
+            if not isinstance(e, hgserver.CommandServerUnavailable) \
+               and not getattr(self, "read_only", False):
+                raise
+            _log.debug("Spawning hg instead of using command server: %s", e)
+            return super(HgCommand, self).execute(working_dir, command_line,
+                                                  timeout)
+        # the work happens in the long-running server, so there is no
+        # separate CPU or memory usage for this command
+        usage = util.ResourceUsage(time.time() - started, len(output))
+        return [returncode, StringIO(output), usage]
 
 class AuthHgCommand(HgCommand):
     def command_parts(self):
@@ -25,6 +86,7 @@ class AuthHgCommand(HgCommand):
 class init(HgCommand):
     reads_remote = False
     writes_remote = False
+    creates_repository = True
     
     @classmethod
     def from_args(cls, context, args):
@@ -101,12 +163,39 @@ class resolved(HgCommand):
             parts.append("-a")
         return parts
         
+class cat(HgCommand):
+    reads_remote = False
+    writes_remote = False
+    
+    @property
+    def cacheable(self):
+        # the working copy's parent is in the dirstate, but a branch,
+        # bookmark or tag can move without it changing
+        revision = self.generic.revision
+        return revision is None or util.is_full_hash(revision)
+
+def _parse_status(stdout):
+    """Yields (state, filename) pairs from hg status -0, where each
+    entry is "state filename" followed by a NUL."""
+    for record in util.split_records(stdout):
+        if len(record) > 2 and record[0] in StatusOutput.valid_values:
+            yield record[0], record[2:]
+
 class status(HgCommand):
     reads_remote = False
     writes_remote = False
     
+    def command_parts(self):
+        parts = super(status, self).command_parts()
+        # NUL separated entries, so that any filename can be read back
+        parts.insert(1, "-0")
+        return parts
+    
     def process_output(self, returncode, stdout):
-        return StatusOutput(returncode, stdout)
+        return StatusOutput(returncode, stdout, _parse_status)
+    
+    def process_output_stream(self, stream):
+        return StreamingStatusOutput(stream, _parse_status)
     
 class revert(HgCommand):
     reads_remote = False
@@ -124,6 +213,12 @@ class HgDialect(object):
     
     name = "hg"
     
+    # the directory that marks a working copy of this dialect
+    marker = ".hg"
+    
+    # the file in the marker directory that records what is tracked
+    state_files = ["dirstate"]
+    
     def convert(self, command_object):
         """Converts to a Mercurial-specific command."""
         local_command = self.get_dialect_command_class(command_object.__class__.__name__)
@@ -150,7 +245,18 @@ class HgDialect(object):
     
     def cwd_is_this_dialect(self):
         """Returns 1 if the .hg directory is here, 0 otherwise."""
-        if os.path.isdir(".hg"):
+        return self.is_this_dialect(os.getcwd())
+    
+    def is_this_dialect(self, directory):
+        """Returns 1 if the .hg directory is in directory, 0 otherwise."""
+        if os.path.isdir(os.path.join(directory, self.marker)):
             return 1
         return 0
+    
+    def fingerprint_files(self, root):
+        """Returns the files that change when the working copy's parent
+        or the history does, for cache fingerprints."""
+        marker = os.path.join(root, self.marker)
+        return [os.path.join(marker, "dirstate"),
+                os.path.join(marker, "store", "00changelog.i")]
     
\ No newline at end of file
@@ -0,0 +1,247 @@
+"""Runs Mercurial commands through hg's command server
+(hg serve --cmdserver pipe), so that a working copy that is used
+repeatedly only pays for starting Python and loading extensions
+once. See hg.use_command_server."""
+
+import os
+import time
+import struct
+import logging
+import threading
+import subprocess
+
+from uvc.exc import UVCError, CommandTimeout
+from uvc.util import _new_process_group, _kill_process_group, \
+    wait_readable
+
+log = logging.getLogger("uvc.hgserver")
+
+server_command_line = ["hg", "serve", "--cmdserver", "pipe"]
+
+class CommandServerError(UVCError):
+    """The command server could not be started or stopped
+    responding."""
+    pass
+
+class CommandServerUnavailable(CommandServerError):
+    """There was no command server to run the command, so it wasn't
+    started at all and can safely be run some other way."""
+    pass
+
+class CommandServer(object):
+    """One hg command server process, serving one working directory.
+    Only one command can run through it at a time; lock guards it."""
+    
+    def __init__(self, working_dir, command_line=None):
+        if command_line is None:
+            command_line = server_command_line
+        self.working_dir = working_dir
+        self.lock = threading.Lock()
+        self.last_used = time.time()
+        try:
+            self.process = subprocess.Popen(command_line, cwd=working_dir,
+                        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                        preexec_fn=_new_process_group, close_fds=True)
+        except OSError, e:
+            raise CommandServerUnavailable("Unable to start command server: "
+                                           "%s" % (e,))
+        self._out = self.process.stdout.fileno()
+        self._in = self.process.stdin.fileno()
+        try:
+            channel, data = self._read_channel(None)
+        except (CommandServerError, OSError, IOError, struct.error), e:
+            self.close()
+            raise CommandServerUnavailable("Command server failed to start: "
+                                           "%s" % (e,))
+        if channel != "o" or "runcommand" not in data:
+            self.close()
+            raise CommandServerUnavailable("Unexpected command server hello: "
+                                           "%r" % (data,))
+    
+    @property
+    def alive(self):
+        return self.process.poll() is None
+    
+    def _read_exactly(self, size, deadline):
+        chunks = []
+        while size:
+            if deadline is not None:
+                remaining = max(deadline - time.time(), 0)
+                if not wait_readable(self._out, remaining):
+                    raise _Timeout()
+            data = os.read(self._out, size)
+            if not data:
+                raise CommandServerError("Command server exited")
+            chunks.append(data)
+            size -= len(data)
+        return "".join(chunks)
+    
+    def _read_channel(self, deadline):
+        header = self._read_exactly(5, deadline)
+        channel, length = struct.unpack(">cI", header)
+        if channel.isupper():
+            # input channels send the requested size instead of data
+            return channel, length
+        return channel, self._read_exactly(length, deadline)
+    
+    def _write(self, data):
+        while data:
+            written = os.write(self._in, data)
+            data = data[written:]
+    
+    def run(self, args, timeout=None):
+        """Runs hg with args (without the leading "hg"), returning
+        the return code and the combined output. If the server dies,
+        CommandServerError is raised; the command may or may not have
+        taken effect. If the command runs past timeout, the server is
+        killed and CommandTimeout raised."""
+        args = [_encode(arg) for arg in args]
+        if timeout is not None:
+            deadline = time.time() + timeout
+        else:
+            deadline = None
+        output = []
+        data = "\0".join(args)
+        try:
+            self._write("runcommand\n" + struct.pack(">I", len(data)) 
+                        + data)
+        except (OSError, IOError), e:
+            # the server only runs a command once it has all of it
+            self.close()
+            raise CommandServerUnavailable("Command server exited: %s" 
+                                           % (e,))
+        try:
+            while True:
+                channel, data = self._read_channel(deadline)
+                if channel in ("o", "e"):
+                    output.append(data)
+                elif channel == "r":
+                    returncode = struct.unpack(">i", data)[0]
+                    break
+                elif channel in ("I", "L"):
+                    # uvc commands never take input; send EOF
+                    self._write(struct.pack(">I", 0))
+                elif channel.isupper():
+                    raise CommandServerError("Unsupported required "
+                                             "channel %s" % (channel,))
+        except _Timeout:
+            self.close()
+            raise CommandTimeout("Command timed out after %s seconds: hg %s"
+                                 % (timeout, " ".join(args)),
+                                 timeout, "".join(output))
+        except (OSError, IOError, struct.error), e:
+            self.close()
+            raise CommandServerError("Command server failed: %s" % (e,))
+        except CommandServerError:
+            self.close()
+            raise
+        self.last_used = time.time()
+        return returncode, "".join(output)
+    
+    def close(self):
+        """Stops the server."""
+        if self.process.poll() is not None:
+            return
+        try:
+            self.process.stdin.close()
+        except (OSError, IOError):
+            pass
+        _kill_process_group(self.process)
+        self.process.wait()
+        self.process.stdout.close()
+
+class CommandServerPool(object):
+    """Keeps a command server per working directory. Servers that
+    have not been used for idle_timeout seconds are stopped, and at
+    most max_servers are kept running (the least recently used go
+    first)."""
+    
+    def __init__(self, idle_timeout=300, max_servers=32, 
+                 command_line=None):
+        self.idle_timeout = idle_timeout
+        self.max_servers = max_servers
+        self.command_line = command_line
+        self.servers = {}
+        self.lock = threading.Lock()
+    
+    def _evict(self, key):
+        """Stops dead and idle servers, and makes room for key's server
+        if needed. Called with lock held; the evicted servers are
+        returned so they can be closed without holding it."""
+        now = time.time()
+        evicted = []
+        for other_key, server in self.servers.items():
+            if server.lock.locked():
+                continue
+            if not server.alive or now - server.last_used > self.idle_timeout:
+                evicted.append(self.servers.pop(other_key))
+        excess = len(self.servers) - self.max_servers
+        if key not in self.servers:
+            excess += 1
+        if excess > 0:
+            idle = sorted((item for item in self.servers.items() 
+                           if item[0] != key and not item[1].lock.locked()),
+                          key=lambda item: item[1].last_used)
+            for other_key, server in idle[:excess]:
+                evicted.append(self.servers.pop(other_key))
+        return evicted
+    
+    def run(self, working_dir, args, timeout=None):
+        """Runs hg with args in working_dir through that directory's
+        command server, starting one if needed. Raises
+        CommandServerUnavailable if there was no server to run the
+        command (one couldn't be started, or is busy with another
+        command), in which case the caller should spawn hg itself.
+        CommandServerError means the server died once it had the
+        command, which may already have taken effect."""
+        key = os.path.realpath(working_dir)
+        # the server's lock is taken while the pool's is held, so that
+        # _evict can't stop the server before it has been claimed
+        with self.lock:
+            evicted = self._evict(key)
+            server = self.servers.get(key)
+            claimed = server is not None and server.lock.acquire(False)
+        for old_server in evicted:
+            old_server.close()
+        
+        if server is None:
+            new_server = CommandServer(working_dir, self.command_line)
+            new_server.lock.acquire()
+            with self.lock:
+                server = self.servers.get(key)
+                if server is not None and server.alive:
+                    # another thread got there first
+                    claimed = server.lock.acquire(False)
+                else:
+                    server = self.servers[key] = new_server
+                    claimed = True
+            if server is not new_server:
+                new_server.close()
+        
+        if not claimed:
+            raise CommandServerUnavailable("Command server for %s is busy" 
+                                           % key)
+        try:
+            if not server.alive:
+                raise CommandServerUnavailable("Command server for %s exited"
+                                               % key)
+            server.last_used = time.time()
+            return server.run(args, timeout)
+        finally:
+            server.lock.release()
+    
+    def close(self):
+        """Stops all of the servers."""
+        with self.lock:
+            servers = self.servers.values()
+            self.servers = {}
+        for server in servers:
+            server.close()
+
+class _Timeout(Exception):
+    pass
+
+def _encode(arg):
+    if isinstance(arg, unicode):
+        return arg.encode("utf-8")
+    return str(arg)
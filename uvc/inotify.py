@@ -0,0 +1,113 @@
+"""A minimal ctypes binding to Linux's inotify, for watching a working
+copy for changes. available() is False on systems without it."""
+
+import os
+import errno
+import struct
+import ctypes
+import ctypes.util
+
+from uvc.exc import UVCError
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0x00080000
+
+# everything that can change what status reports for a file
+IN_CHANGES = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+              IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF |
+              IN_MOVE_SELF)
+
+_event_header = struct.Struct("iIII")
+
+class InotifyError(UVCError):
+    """inotify isn't available, or a watch couldn't be set up."""
+    pass
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                           use_errno=True)
+    except OSError:
+        return None
+    if not hasattr(libc, "inotify_init1"):
+        return None
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                       ctypes.c_uint32]
+    libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    return libc
+
+_libc = _load_libc()
+
+def available():
+    return _libc is not None
+
+class Inotify(object):
+    """An inotify instance. Reading events never blocks; use fileno()
+    with select to wait for them."""
+
+    def __init__(self):
+        if _libc is None:
+            raise InotifyError("inotify is not available on this system")
+        self.fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            code = ctypes.get_errno()
+            raise InotifyError("Unable to start inotify: %s"
+                               % os.strerror(code))
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask=IN_CHANGES):
+        """Starts watching path and returns the watch descriptor."""
+        wd = _libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            code = ctypes.get_errno()
+            raise InotifyError("Unable to watch %s: %s"
+                               % (path, os.strerror(code)))
+        return wd
+
+    def remove_watch(self, wd):
+        # fails harmlessly if the watch is already gone
+        _libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self):
+        """Returns the (wd, mask, cookie, name) events that have
+        happened since the last call."""
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError, e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    return events
+                raise
+            if not data:
+                return events
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = \
+                    _event_header.unpack_from(data, offset)
+                offset += _event_header.size
+                name = data[offset:offset + length].rstrip("\0")
+                offset += length
+                events.append((wd, mask, cookie, name))
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
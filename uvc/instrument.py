@@ -0,0 +1,161 @@
+"""Timing for the phases of uvc's command pipeline (inferring the
+dialect, normalizing paths, running the child process, parsing its
+output and so on).
+
+Code marks a phase with::
+
+    with instrument.span("infer_dialect"):
+        ...
+
+Nothing is measured until a collector is registered with
+add_collector, so spans cost next to nothing by default. A collector
+is any object with a record(name, seconds) method."""
+
+import time
+import math
+import logging
+import threading
+
+log = logging.getLogger("uvc.instrument")
+
+collectors = []
+
+if hasattr(time, "perf_counter"):
+    _clock = time.perf_counter
+else:
+    _clock = time.time
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_null_span = _NullSpan()
+
+class _Span(object):
+    __slots__ = ["name", "start"]
+    
+    def __init__(self, name):
+        self.name = name
+    
+    def __enter__(self):
+        self.start = _clock()
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = _clock() - self.start
+        for collector in collectors:
+            try:
+                collector.record(self.name, elapsed)
+            except Exception:
+                log.exception("Collector %r failed", collector)
+        return False
+
+def span(name):
+    """Returns a context manager that times the enclosed code as the
+    phase called name."""
+    if not collectors:
+        return _null_span
+    return _Span(name)
+
+def add_collector(collector):
+    collectors.append(collector)
+
+def remove_collector(collector):
+    collectors.remove(collector)
+
+class CallbackCollector(object):
+    """Calls callback(name, seconds) for every span."""
+    
+    def __init__(self, callback):
+        self.callback = callback
+    
+    def record(self, name, seconds):
+        self.callback(name, seconds)
+
+class LoggingCollector(object):
+    """Logs every span."""
+    
+    def __init__(self, logger=log, level=logging.DEBUG):
+        self.logger = logger
+        self.level = level
+    
+    def record(self, name, seconds):
+        self.logger.log(self.level, "%s took %.6fs", name, seconds)
+
+class Histogram(object):
+    """Counts durations in buckets that grow by a factor of
+    2 ** (1.0 / buckets_per_doubling), starting at one microsecond."""
+    
+    buckets_per_doubling = 4
+    
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = {}
+    
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+        if seconds <= 1e-6:
+            bucket = 0
+        else:
+            bucket = int(math.log(seconds / 1e-6, 2) 
+                         * self.buckets_per_doubling) + 1
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+    
+    def _bucket_limit(self, bucket):
+        return 1e-6 * 2 ** (float(bucket) / self.buckets_per_doubling)
+    
+    def percentile(self, percent):
+        """Returns the upper bound of the bucket holding the given
+        percentile (so it is accurate to within one bucket)."""
+        if not self.count:
+            return None
+        wanted = self.count * percent / 100.0
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= wanted:
+                return min(self._bucket_limit(bucket), self.max)
+        return self.max
+    
+    def summary(self):
+        if not self.count:
+            return dict(count=0)
+        return dict(count=self.count, total=self.total, 
+                    mean=self.total / self.count, min=self.min, 
+                    max=self.max, p50=self.percentile(50),
+                    p95=self.percentile(95), p99=self.percentile(99))
+
+class HistogramCollector(object):
+    """Keeps a Histogram of durations for each span name in memory."""
+    
+    def __init__(self):
+        self.histograms = {}
+        self.lock = threading.Lock()
+    
+    def record(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(seconds)
+    
+    def summary(self):
+        """Returns {name: summary} for all spans seen so far."""
+        with self.lock:
+            return dict((name, histogram.summary()) 
+                        for name, histogram in self.histograms.items())
+    
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
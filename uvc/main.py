@@ -2,12 +2,18 @@
 
 import sys
 import os
+import errno
 import subprocess
 import tempfile
 import logging
+import time
+import Queue
+import threading
+import json
+from cStringIO import StringIO
 
-from uvc import commands, hg, svn, git
-from uvc.util import run_in_directory
+from uvc import commands, hg, svn, git, instrument, cache, util
+from uvc.util import CommandStream
 from uvc.path import path
 from uvc.exc import *
 
@@ -15,6 +21,12 @@ log = logging.getLogger("uvc.main")
 
 dialects = dict(hg=hg.HgDialect(), svn=svn.SVNDialect(), git=git.GitDialect())
 
+# how many seconds a command may run before it is killed, unless the
+# command (or the call to run_command) says otherwise. Commands that
+# talk to a remote repository get longer. None means no limit.
+local_timeout = 300
+remote_timeout = 1800
+
 class Context(object):
     # all schemes are allowed
     remote_scheme_whitelist = None
@@ -35,11 +47,12 @@ class Context(object):
         self.auth = auth
         
     def _normalize_path(self, unnorm_path):
-        norm_path = self.working_dir / path(unnorm_path)
-        norm_path = norm_path.normpath()
-        norm_path = norm_path.realpath()
-        norm_path = norm_path.abspath()
-        return norm_path
+        with instrument.span("normalize_path"):
+            norm_path = self.working_dir / path(unnorm_path)
+            norm_path = norm_path.normpath()
+            norm_path = norm_path.realpath()
+            norm_path = norm_path.abspath()
+            return norm_path
     
     def validate_new_directory(self, newdir):
         """Confirms that newdir does not exist, raising a 
@@ -103,19 +116,105 @@ def get_dialect(dialect_name):
     """Looks up the dialect in the dialect registry by name."""
     return dialects.get(dialect_name)
 
-def infer_dialect(directory):
-    d = set(dialects.values())
-    cwd = os.getcwd()
-    directory = os.path.abspath(directory)
+# absolute directory -> (dialect, repository root, identity of the
+# marker directory in the root), so that repeated commands in the same
+# project don't walk up to / every time. Walking up costs about a
+# millisecond, which is what an entry is worth to cache.manager.
+dialect_cache = cache.manager.register(
+    "dialects", cache.LRUCache(max_entries=10000, default_cost=0.001))
+
+# what an entry in dialect_cache takes up, roughly, besides its paths
+_dialect_entry_overhead = 200
+
+def _marker_identity(dialect, root):
+    """Returns something that changes if the marker directory (.hg,
+    .git, .svn) in root is removed or replaced, or None if it isn't
+    there. Only the inode is used, not the mtime: git and svn touch
+    their marker directory on nearly every command."""
     try:
-        os.chdir(directory)
+        info = os.stat(os.path.join(root, dialect.marker))
+    except OSError:
+        return None
+    return (info.st_dev, info.st_ino)
+
+# a cachestore.CacheStore that the dialect and result caches write
+# through to, so that they start out warm after a restart
+cache_store = None
+
+def use_cache_store(store):
+    """Makes the in-memory caches keep a copy of what they hold in
+    store (a cachestore.CacheStore), and look there when they don't
+    have something. None stops that."""
+    global cache_store
+    cache_store = store
+
+def _cached_repository(directory):
+    entry = dialect_cache.get(directory)
+    if entry is None:
+        store = cache_store
+        if store is None:
+            return None
+        stored = store.get("dialects", directory)
+        if stored is None:
+            return None
+        dialect_name, root, identity = stored
+        entry = (get_dialect(dialect_name), root, identity)
+        if entry[0] is None:
+            return None
+        dialect_cache.put(directory, entry,
+                          size=_dialect_entry_size(directory, root))
+    dialect, root, identity = entry
+    if _marker_identity(dialect, root) == identity:
+        return dialect, root
+    dialect_cache.pop(directory)
+    return None
+
+def _dialect_entry_size(directory, root):
+    return len(directory) + len(root) + _dialect_entry_overhead
+
+def _remember_repository(directory, dialect, root):
+    identity = _marker_identity(dialect, root)
+    if identity is not None:
+        dialect_cache.put(directory, (dialect, root, identity),
+                          size=_dialect_entry_size(directory, root))
+        store = cache_store
+        if store is not None:
+            store.put("dialects", directory, (dialect.name, root, identity))
+
+def forget_repositories(directory):
+    """Throws away cached dialect inference for directory and
+    everything below it. This needs to be called when a new working
+    copy is created inside a directory that may have been looked at
+    before (run_command does this for commands that create one)."""
+    directory = os.path.abspath(directory)
+    prefix = directory.rstrip(os.sep) + os.sep
+    dialect_cache.discard_if(lambda key, value: 
+                             key == directory or key.startswith(prefix))
+    store = cache_store
+    if store is not None:
+        # the store can't look keys up by prefix
+        store.clear("dialects")
+
+def find_repository(directory):
+    """Walks up from directory looking for a version controlled
+    project. Returns (dialect, root of the working copy), or
+    (None, None) if directory isn't in one. This only inspects the
+    filesystem, so it does not need (or change) the process' current
+    directory."""
+    with instrument.span("infer_dialect"):
+        start = directory = os.path.abspath(directory)
+        cached = _cached_repository(start)
+        if cached is not None:
+            return cached
+        
+        d = set(dialects.values())
         remove_dialects = set()
         prev = None
         # stop when we hit the root directory (os.dirname
         # will stop giving us different values)
         while prev != directory:
             for dialect in d:
-                is_match = dialect.cwd_is_this_dialect()
+                is_match = dialect.is_this_dialect(directory)
                 if is_match == 0:
                     continue
                 elif is_match == 1:
@@ -125,17 +224,195 @@ def infer_dialect(directory):
                     # if the directory doesn't have .svn in it, we
                     # know there's no match
                     remove_dialects.add(dialect)
-            
+        
             if is_match == 1:
-                return dialect
-            
+                _remember_repository(start, dialect, directory)
+                return dialect, directory
+        
             d.difference_update(remove_dialects)
             remove_dialects.clear()
             prev = directory
             directory = os.path.dirname(directory)
+        return None, None
+
+def infer_dialect(directory):
+    """Returns the dialect of the project that directory is in, or
+    None. See find_repository."""
+    return find_repository(directory)[0]
+
+def infer_dialects(directories):
+    """Like infer_dialect, for many directories at once. Returns a
+    dictionary mapping each directory to its dialect (or None).
+    Each ancestor directory is only examined once, no matter how many
+    of the directories are underneath it."""
+    all_dialects = sorted(dialects.values(), key=lambda dialect: dialect.name)
+    # (directory, dialects still possible) -> (dialect, root) found by
+    # walking up from directory
+    found_above = {}
+    
+    def search_up(directory, candidates):
+        walked = []
+        result = (None, None)
+        while True:
+            key = (directory, candidates)
+            if key in found_above:
+                result = found_above[key]
+                break
+            walked.append(key)
+            for dialect in candidates:
+                if dialect.is_this_dialect(directory) == 1:
+                    result = (dialect, directory)
+                    break
+            if result[0] is not None:
+                break
+            parent = os.path.dirname(directory)
+            if parent == directory:
+                break
+            directory = parent
+        for key in walked:
+            found_above[key] = result
+        return result
+    
+    result = {}
+    with instrument.span("infer_dialects"):
+        for directory in directories:
+            absolute = os.path.abspath(directory)
+            cached = _cached_repository(absolute)
+            if cached is not None:
+                result[directory] = cached[0]
+                continue
+            
+            candidates = []
+            found = (None, None)
+            for dialect in all_dialects:
+                is_match = dialect.is_this_dialect(absolute)
+                if is_match == 1:
+                    found = (dialect, absolute)
+                    break
+                elif is_match == 0:
+                    # dialects that can be found in a parent directory
+                    candidates.append(dialect)
+            else:
+                parent = os.path.dirname(absolute)
+                if parent != absolute:
+                    found = search_up(parent, tuple(candidates))
+            
+            dialect, root = found
+            if dialect is not None:
+                _remember_repository(absolute, dialect, root)
+            result[directory] = dialect
+    return result
+
+def _scan_directory(directory, markers, nested, found):
+    """Walks down from directory, adding root -> dialect to found for
+    each working copy. Symlinks are not followed."""
+    pending = [directory]
+    while pending:
+        directory = pending.pop()
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            continue
+        
+        here = [markers[name] for name in names if name in markers]
+        if here:
+            dialect = min(here, key=lambda dialect: dialect.name)
+            found[directory] = dialect
+            # every directory of a Subversion working copy is part of
+            # it, so there is nothing else to find below
+            if dialect.name == "svn" or not nested:
+                continue
+        
+        for name in names:
+            if name in markers:
+                continue
+            child = os.path.join(directory, name)
+            if os.path.isdir(child) and not os.path.islink(child):
+                pending.append(child)
+
+def discover_repositories(top, concurrency=8, nested=False):
+    """Finds every working copy at or below top in one walk down the
+    tree, which is far cheaper than calling infer_dialect for every
+    directory. Returns a dictionary mapping the root of each working
+    copy to its dialect. Each subdirectory of top is scanned by one of
+    up to concurrency threads.
+    
+    The walk doesn't go into a working copy once it has been found,
+    unless nested is true, in which case repositories inside of hg and
+    git working copies (subrepositories, for instance) are found too.
+    Subversion working copies are never descended into."""
+    markers = dict((dialect.marker, dialect) for dialect in dialects.values())
+    top = os.path.abspath(top)
+    found = {}
+    
+    with instrument.span("discover_repositories"):
+        try:
+            names = os.listdir(top)
+        except OSError:
+            return found
+        
+        here = [markers[name] for name in names if name in markers]
+        if here:
+            found[top] = min(here, key=lambda dialect: dialect.name)
+            if found[top].name == "svn" or not nested:
+                return found
+        
+        todo = Queue.Queue()
+        for name in names:
+            child = os.path.join(top, name)
+            if name not in markers and os.path.isdir(child) \
+               and not os.path.islink(child):
+                todo.put(child)
+        
+        def worker(results):
+            while True:
+                try:
+                    subtree = todo.get_nowait()
+                except Queue.Empty:
+                    return
+                # each thread has its own dictionary, so that no locking
+                # is needed
+                _scan_directory(subtree, markers, nested, results)
+        
+        workers = []
+        for i in range(min(concurrency, todo.qsize())):
+            results = {}
+            thread = threading.Thread(target=worker, args=(results,))
+            thread.daemon = True
+            thread.start()
+            workers.append((thread, results))
+        for thread, results in workers:
+            thread.join()
+            found.update(results)
+    return found
+
+def save_repositories(repositories, filename):
+    """Writes the result of discover_repositories to filename as JSON
+    (root -> dialect name)."""
+    data = dict((root, dialect.name) 
+                for root, dialect in repositories.items())
+    tmpname = filename + ".tmp"
+    f = open(tmpname, "w")
+    try:
+        json.dump(data, f, separators=(",", ":"), sort_keys=True)
     finally:
-        os.chdir(cwd)
-    return None
+        f.close()
+    os.rename(tmpname, filename)
+
+def load_repositories(filename):
+    """Reads a mapping written by save_repositories. Entries for
+    unknown dialects are dropped."""
+    f = open(filename)
+    try:
+        data = json.load(f)
+    finally:
+        f.close()
+    repositories = {}
+    for root, dialect_name in data.items():
+        dialect = get_dialect(dialect_name)
+        if dialect is not None:
+            repositories[str(root)] = dialect
+    return repositories
 
 def get_command_class(context, args, dialect=None):
     """This is similar to convert, but removes a step from the
@@ -159,10 +436,300 @@ def get_command_class(context, args, dialect=None):
 def convert(context, args, dialect=None):
     """Converts the arguments provided into a command in the given dialect,
     or figures out the dialect for the project."""
-    cmdclass = get_command_class(context, args, dialect)
-    return cmdclass.from_args(context, args)
+    with instrument.span("convert"):
+        cmdclass = get_command_class(context, args, dialect)
+        return cmdclass.from_args(context, args)
+
+def get_timeout(command):
+    """Returns how long the command may run, in seconds."""
+    timeout = getattr(command, "timeout", None)
+    if timeout is not None:
+        return timeout
+    if getattr(command, "reads_remote", False) \
+       or getattr(command, "writes_remote", False):
+        return remote_timeout
+    return local_timeout
+
+# holds the output of local, read only commands when use_result_cache
+# has been called: (working dir, command line, fingerprint) ->
+# (return code, output)
+result_cache = None
+
+def use_result_cache(max_bytes=64 * 1024 * 1024, max_entries=10000):
+    """Starts caching the output of commands that neither talk to a
+    remote repository nor change anything (status, diff, cat...), when
+    they succeed. A result is reused while the VCS metadata (the hg
+    dirstate, git index, HEAD and ignore files, svn wc.db) and the
+    files the command is given are unchanged. For a command without
+    targets, that means a walk over
+    the working directory, checking the size and modification time of
+    everything in it. The cached output is limited to max_bytes, and
+    shares cache.manager's budget with uvc's other caches."""
+    global result_cache
+    result_cache = cache.manager.register("results",
+        cache.LRUCache(max_entries=max_entries, max_bytes=max_bytes))
+    return result_cache
+
+def stop_result_cache():
+    global result_cache
+    result_cache = None
+    cache.manager.unregister("results")
+
+def _result_cache_key(command, context, command_line):
+    """Returns the result_cache key for running command, or None if
+    its output can't be cached."""
+    if command.reads_remote or command.writes_remote \
+       or not getattr(command, "read_only", False) \
+       or not getattr(command, "cacheable", True):
+        return None
+    dialect, root = find_repository(context.working_dir)
+    if dialect is None:
+        return None
+    
+    working_dir = os.path.abspath(context.working_dir)
+    targets = getattr(command, "targets", None)
+    markers = set(each.marker for each in dialects.values())
+    with instrument.span("fingerprint"):
+        filenames = dialect.fingerprint_files(root)
+        if targets:
+            trees = [_target_path(dialect, root, working_dir, target) 
+                     for target in targets]
+        if targets and None not in trees:
+            # only the targets are walked, but ignore files above them
+            # still matter
+            filenames = filenames + _directory_files(dialect, root, trees)
+        else:
+            trees = [working_dir]
+        digest = cache.fingerprint(filenames, trees, skip=markers)
+    return (working_dir, tuple(command_line), digest)
+
+# hg's kinds of pattern, of which path: and relpath: name one file or
+# directory
+_hg_pattern_kinds = set(["path", "relpath", "glob", "relglob", "re", 
+                         "relre", "rootfilesin", "listfile", "listfile0", 
+                         "set", "include", "subinclude", "filepath"])
+
+def _target_path(dialect, root, working_dir, target):
+    """Returns the file or directory that target (as the dialect reads
+    it) names, or None if it is a pattern that could match anything."""
+    if dialect.name == "git" and target.startswith(":"):
+        # pathspec magic; only literal and top say nothing about
+        # which files match
+        if not target.startswith(":("):
+            return None
+        end = target.find(")")
+        magic = set(target[2:end].split(","))
+        if end == -1 or not magic <= set(["literal", "top"]):
+            return None
+        base = root if "top" in magic else working_dir
+        return os.path.join(base, target[end + 1:])
+    if dialect.name == "hg" and ":" in target:
+        kind, name = target.split(":", 1)
+        if kind == "path":
+            return os.path.join(root, name)
+        if kind == "relpath":
+            return os.path.join(working_dir, name)
+        if kind in _hg_pattern_kinds:
+            return None
+    return os.path.join(working_dir, target)
+
+def _directory_files(dialect, root, paths):
+    """Returns the dialect's directory_files (such as .gitignore) in
+    each directory from root down to each of paths."""
+    names = getattr(dialect, "directory_files", ())
+    if not names:
+        return []
+    root = os.path.abspath(root)
+    directories = set()
+    for each in paths:
+        directory = os.path.dirname(os.path.abspath(each))
+        while directory not in directories:
+            directories.add(directory)
+            if not directory.startswith(root + os.sep):
+                break
+            directory = os.path.dirname(directory)
+    return [os.path.join(directory, name) 
+            for directory in sorted(directories) for name in names]
+
+# how many runs of a read only command go at once, when its targets
+# have to be split between several
+batch_concurrency = 4
+
+def _split_targets(command, command_line):
+    """Returns the command line without the command's targets, and the
+    targets, or None if the targets aren't what the command line ends
+    with."""
+    targets = getattr(command, "targets", None)
+    if not targets:
+        return None
+    targets = list(targets)
+    if list(command_line[-len(targets):]) != targets:
+        return None
+    return list(command_line[:-len(targets)]), targets
+
+def _remove_targets_file(filename):
+    if filename is None:
+        return
+    try:
+        os.unlink(filename)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+
+def _write_targets_file(targets, separator):
+    fd, filename = tempfile.mkstemp(prefix="uvc-targets-")
+    with os.fdopen(fd, "wb") as stream:
+        for target in targets:
+            stream.write(target + separator)
+    return filename
+
+def _targets_file_command_line(command, prefix, targets):
+    """Returns a command line that reads targets from a file, and the
+    file, or (None, None) if the command can't do that."""
+    targets_file = getattr(command, "targets_file", None)
+    if targets_file is None:
+        return None, None
+    parts, separator = targets_file
+    for target in targets:
+        if separator in target:
+            return None, None
+    filename = _write_targets_file(targets, separator)
+    return prefix + [part.replace("%s", filename) for part in parts], filename
 
-def run_command(command, context):
+def _fit_command_line(command, command_line, stream):
+    """Returns what to run for command_line: the command line, the
+    targets file it reads (to be removed afterwards) or None, and the
+    (prefix, targets) to run in batches or None."""
+    if util.command_line_size(command_line) <= util.arg_max():
+        return command_line, None, None
+    split = _split_targets(command, command_line)
+    if split is None:
+        return command_line, None, None
+    prefix, targets = split
+    run_line, targets_file = _targets_file_command_line(command, prefix,
+                                                        targets)
+    if run_line is not None:
+        return run_line, targets_file, None
+    if getattr(command, "batchable", False) and not stream:
+        return command_line, None, split
+    return command_line, None, None
+
+def _run_batches(command, context, prefix, targets, timeout):
+    """Runs command once for each chunk of targets that fits on a
+    command line, and puts what they printed together into one output
+    object. Read only commands run batch_concurrency chunks at a time,
+    others one after the other, since the VCS would lock them out."""
+    chunks = util.split_arguments(prefix, targets)
+    log.debug("Running %s in %s batches", prefix, len(chunks))
+    results = [None] * len(chunks)
+    
+    def run_chunk(i):
+        try:
+            results[i] = command.execute(context.working_dir, 
+                                         prefix + chunks[i], timeout=timeout)
+        except CommandTimeout, e:
+            results[i] = e
+    
+    started = time.time()
+    with instrument.span("execute"):
+        if getattr(command, "read_only", False) and len(chunks) > 1:
+            pending = Queue.Queue()
+            for i in range(len(chunks)):
+                pending.put(i)
+            def worker():
+                while True:
+                    try:
+                        i = pending.get_nowait()
+                    except Queue.Empty:
+                        return
+                    run_chunk(i)
+            threads = [threading.Thread(target=worker) 
+                       for i in range(min(batch_concurrency, len(chunks)))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        else:
+            for i in range(len(chunks)):
+                run_chunk(i)
+                if isinstance(results[i], CommandTimeout):
+                    break
+    
+    returncode = 0
+    outputs = []
+    for result in results:
+        if result is None:
+            continue
+        if isinstance(result, CommandTimeout):
+            log.warning("%s", result)
+            report_usage(command, context, result.usage)
+            output = commands.TimeoutOutput(result.timeout, 
+                                            "".join(outputs) + result.output)
+            output.usage = result.usage
+            return output
+        chunk_returncode, stdout, usage = result
+        report_usage(command, context, usage)
+        outputs.append(stdout.read())
+        if chunk_returncode and not returncode:
+            returncode = chunk_returncode
+    
+    if returncode == 0:
+        _command_succeeded(command, context)
+    with instrument.span("process_output"):
+        output = command.process_batch_output(returncode, outputs)
+    output.usage = util.ResourceUsage(time.time() - started, 
+                                      sum(len(data) for data in outputs))
+    log.debug("Command output: %s", output)
+    return output
+
+def _start_stream(command, context, command_line, timeout, on_exit=None):
+    """Starts command_line as a CommandStream, passing the targets in
+    a file if they don't fit on the command line. on_exit is called
+    with the return code once the command has finished (or the stream
+    has been closed), by which time the targets file is gone."""
+    run_line, targets_file, batches = _fit_command_line(command, 
+                                                        command_line, True)
+    def finished(returncode):
+        _remove_targets_file(targets_file)
+        if on_exit is not None:
+            on_exit(returncode)
+    
+    try:
+        return CommandStream(context.working_dir, run_line,
+                             on_exit=finished, timeout=timeout)
+    except OSError, e:
+        _remove_targets_file(targets_file)
+        if e.errno != errno.E2BIG:
+            raise
+        # a stream can't be put together from several runs
+        raise CommandLineTooLong("The command line is too long to "
+            "run (%s bytes of arguments); run the command without "
+            "streaming, or with fewer targets" 
+            % util.command_line_size(run_line))
+    except:
+        _remove_targets_file(targets_file)
+        raise
+
+def run_command(command, context, stream=False, timeout=None):
+    """Runs the command in the context's working directory and
+    returns its output object.
+    
+    With stream=True, this returns as soon as the command has started
+    and the output object reads from the running command (see
+    commands.StreamingOutput), so that output never needs to be held
+    in memory all at once.
+    
+    timeout overrides get_timeout(command). A command that runs out
+    of time is killed along with any processes it started, and a
+    commands.TimeoutOutput holding the output captured so far is
+    returned (a streaming output just ends, with timed_out set).
+    
+    When the targets make the command line too long for the system
+    (see util.arg_max), they are passed in a file if the VCS can read
+    them from one (the command's targets_file), or else split between
+    several runs of the command whose output is put back together.
+    A stream can't be split that way, so CommandLineTooLong is raised
+    if the system won't run the command line as it is."""
     command_line = command.get_command_line()
     
     # in some cases, such as Subversion's version of the
@@ -170,19 +737,341 @@ def run_command(command, context):
     # the command itself runs no vcs commands.
     if not command_line:
         return command.get_output()
+    
+    if timeout is None:
+        timeout = get_timeout(command)
         
     log.debug("Running: %s", (command_line,))
     log.debug("Working dir: %s", context.working_dir)
     
-    returncode, stdout = run_in_directory(context.working_dir, command_line)
+    if stream:
+        def on_exit(returncode):
+            # also called when the stream is closed before the end
+            report_usage(command, context, command_stream.usage)
+            if returncode == 0:
+                _command_succeeded(command, context)
+        
+        command_stream = _start_stream(command, context, command_line,
+                                       timeout, on_exit)
+        return command.process_output_stream(command_stream)
+    
+    results = result_cache
+    cache_key = None
+    if results is not None:
+        cache_key = _result_cache_key(command, context, command_line)
+    if cache_key is not None:
+        cached = results.get(cache_key)
+        store = cache_store
+        if cached is None and store is not None:
+            cached = store.get("results", cache_key)
+            if cached is not None:
+                # what it cost to run isn't stored; the default will do
+                results.put(cache_key, cached, size=len(cached[1]))
+        if cached is not None:
+            log.debug("Using cached output")
+            returncode, data = cached
+            with instrument.span("process_output"):
+                return command.process_output(returncode, StringIO(data))
+    
+    run_line, targets_file, batches = _fit_command_line(command, 
+                                                        command_line, stream)
+    if batches is not None:
+        # the batches' output isn't cached, as it can't always be read
+        # back as one
+        return _run_batches(command, context, batches[0], batches[1],
+                            timeout)
+    
+    try:
+        with instrument.span("execute"):
+            returncode, stdout, usage = command.execute(context.working_dir, 
+                                                        run_line, 
+                                                        timeout=timeout)
+    except CommandTimeout, e:
+        log.warning("%s", e)
+        output = commands.TimeoutOutput(e.timeout, e.output)
+        output.usage = e.usage
+        report_usage(command, context, e.usage)
+        return output
+    finally:
+        _remove_targets_file(targets_file)
     
-    if returncode == 0 and hasattr(command, "command_successful"):
+    # a failure may be down to something the fingerprint doesn't cover
+    # (a lock held by another command, say), so only successes are kept
+    if cache_key is not None and returncode == 0:
+        data = stdout.read()
+        cost = usage.wall_time if usage is not None else None
+        results.put(cache_key, (returncode, data), size=len(data),
+                    cost=cost)
+        if store is not None:
+            store.put("results", cache_key, (returncode, data))
+        stdout = StringIO(data)
+    return _finish_command(command, context, returncode, stdout, usage)
+
+def _command_succeeded(command, context):
+    if getattr(command, "creates_repository", False):
+        forget_repositories(context.working_dir)
+    if hasattr(command, "command_successful"):
         command.command_successful()
+
+def _finish_command(command, context, returncode, stdout, usage):
+    report_usage(command, context, usage)
+    if returncode == 0:
+        _command_succeeded(command, context)
     
-    output = command.process_output(returncode, stdout)
+    with instrument.span("process_output"):
+        output = command.process_output(returncode, stdout)
+    output.usage = usage
     log.debug("Command output: %s", output)
     return output
 
+# functions called as sink(command, context, usage) with the
+# util.ResourceUsage of every command that runs
+usage_sinks = []
+
+def add_usage_sink(sink):
+    """Registers sink to be called with (command, context, usage) each
+    time a command finishes, for example to account for the cost of
+    each user's commands."""
+    usage_sinks.append(sink)
+
+def remove_usage_sink(sink):
+    usage_sinks.remove(sink)
+
+def report_usage(command, context, usage):
+    """Passes usage on to the registered sinks. A failing sink is
+    logged and otherwise ignored."""
+    if usage is None:
+        return
+    for sink in list(usage_sinks):
+        try:
+            sink(command, context, usage)
+        except Exception:
+            log.exception("Usage sink %r failed", sink)
+
+class PendingCommand(object):
+    """A command started by start_command. Rather than blocking
+    a thread, it is driven by an event loop: whenever fileno()
+    is readable, call on_readable(). Once done() is true, result()
+    returns the same output object that run_command would have.
+    
+    The command gets the same timeout as with run_command. A command
+    that produces no output can't make fileno() readable, so unless
+    deadline is None, on_readable() must also be called once
+    time.time() reaches deadline; it then kills the command and
+    result() is a commands.TimeoutOutput.
+    
+    With asyncio, for example::
+    
+        loop.add_reader(pending.fileno(), pending.on_readable)
+    
+    (removing the reader once done() is true), or use
+    wait_for_commands to drive a set of them with poll.
+    
+    A command whose dialect runs it some other way than spawning it
+    (see commands.DialectCommand.spawns) is run by run_command in a
+    thread of its own, and fileno() becomes readable when that
+    finishes. Such a command can't be killed: cancel() just stops
+    waiting for it."""
+    
+    cancelled = False
+    deadline = None
+    
+    def __init__(self, command, context):
+        self.command = command
+        self.context = context
+        self.stream = None
+        self._output = None
+        self._error = None
+        self._chunks = []
+        self._fd = None
+        
+        command_line = command.get_command_line()
+        if not command_line:
+            self._output = command.get_output()
+            return
+        
+        if not getattr(command, "spawns", True):
+            self._start_thread()
+            return
+        
+        self.timeout = get_timeout(command)
+        log.debug("Starting: %s", (command_line,))
+        log.debug("Working dir: %s", context.working_dir)
+        self.stream = _start_stream(command, context, command_line,
+                                    self.timeout)
+        if self.timeout is not None:
+            self.deadline = time.time() + self.timeout
+    
+    def _start_thread(self):
+        self._fd, finished_fd = os.pipe()
+        def run():
+            try:
+                self._thread_output = run_command(self.command, 
+                                                  self.context)
+            except Exception:
+                self._thread_error = sys.exc_info()
+            finally:
+                # the end of the pipe is what wakes up the event loop
+                os.close(finished_fd)
+        
+        self._thread_output = self._thread_error = None
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+    
+    def fileno(self):
+        if self.stream is None:
+            return self._fd
+        return self.stream.fileno()
+    
+    def done(self):
+        return self._output is not None or self._error is not None \
+            or self.cancelled
+    
+    def on_readable(self):
+        """Collects the output that is available without blocking.
+        Returns True once the command has finished."""
+        if self.done():
+            return True
+        if self.stream is None:
+            os.read(self._fd, 1)
+            os.close(self._fd)
+            self._output = self._thread_output
+            self._error = self._thread_error
+            return True
+        data = self.stream.read_available()
+        if data:
+            self._chunks.append(data)
+            return False
+        output = "".join(self._chunks)
+        self._chunks = None
+        if self.stream.timed_out:
+            log.warning("Command timed out after %s seconds: %s", 
+                        self.timeout, self.command)
+            report_usage(self.command, self.context, self.stream.usage)
+            self._output = commands.TimeoutOutput(self.timeout, output)
+            self._output.usage = self.stream.usage
+            return True
+        self._output = _finish_command(self.command, self.context,
+                                       self.stream.returncode, 
+                                       StringIO(output), self.stream.usage)
+        return True
+    
+    def cancel(self):
+        """Kills the command if it is still running."""
+        if self.done():
+            return
+        self.cancelled = True
+        self._chunks = None
+        if self.stream is None:
+            os.close(self._fd)
+        else:
+            self.stream.close()
+    
+    def result(self):
+        if self.cancelled:
+            raise CommandCancelled("Command was cancelled: %s" 
+                                   % (self.command,))
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+        if self._output is None:
+            raise UVCError("Command is still running: %s" % (self.command,))
+        return self._output
+
+def start_command(command, context):
+    """Starts the command without waiting for it, returning a
+    PendingCommand."""
+    return PendingCommand(command, context)
+
+def wait_for_commands(pending_commands, timeout=None):
+    """Drives the given PendingCommands from a single thread until
+    they have all finished, or until timeout seconds have passed.
+    Returns the list of commands that are still running. If something
+    goes wrong while waiting, the commands that haven't finished are
+    cancelled before the exception is passed on."""
+    if timeout is not None:
+        deadline = time.time() + timeout
+    running = dict((pending.fileno(), pending) 
+                   for pending in pending_commands if not pending.done())
+    try:
+        while running:
+            # wake up for whichever comes first: the end of the wait,
+            # or a command running out of time
+            deadlines = [pending.deadline for pending in running.values()
+                         if pending.deadline is not None]
+            if timeout is not None:
+                if deadline <= time.time():
+                    break
+                deadlines.append(deadline)
+            wait = None
+            if deadlines:
+                wait = max(min(deadlines) - time.time(), 0)
+            ready = set(util.select_readable(running.keys(), wait))
+            now = time.time()
+            for fd, pending in running.items():
+                if pending.deadline is not None and pending.deadline <= now:
+                    ready.add(fd)
+            for fd in ready:
+                if running[fd].on_readable():
+                    del running[fd]
+    except:
+        for pending in running.values():
+            pending.cancel()
+        raise
+    return running.values()
+
+def run_many(contexts, args, concurrency=8, dialect=None):
+    """Runs the same command (given as generic arguments, as for
+    convert) in each of the contexts, with up to concurrency commands
+    running at once. Yields (context, output, error) tuples in the
+    order in which the commands finish. A command that fails to
+    convert or run yields its exception as error (and None as output)
+    rather than stopping the others.
+    
+    Unless a dialect is given, the dialects for all of the working
+    directories are inferred up front with infer_dialects."""
+    contexts = list(contexts)
+    if dialect is not None or (args and args[0] in dialects) \
+       or is_new_project_command(list(args)):
+        context_dialects = dict.fromkeys(range(len(contexts)), dialect)
+    else:
+        by_dir = infer_dialects(set(context.working_dir 
+                                    for context in contexts))
+        context_dialects = dict((i, by_dir[context.working_dir])
+                                for i, context in enumerate(contexts))
+    
+    todo = Queue.Queue()
+    for i in range(len(contexts)):
+        todo.put(i)
+    done = Queue.Queue()
+    stopping = threading.Event()
+    
+    def worker():
+        while not stopping.is_set():
+            try:
+                i = todo.get_nowait()
+            except Queue.Empty:
+                return
+            context = contexts[i]
+            try:
+                command = convert(context, list(args), context_dialects[i])
+                done.put((context, run_command(command, context), None))
+            except Exception, e:
+                log.debug("Command failed in %s: %s", context.working_dir, e)
+                done.put((context, None, e))
+    
+    workers = [threading.Thread(target=worker) 
+               for i in range(min(concurrency, len(contexts)))]
+    for thread in workers:
+        thread.daemon = True
+        thread.start()
+    try:
+        for i in range(len(contexts)):
+            yield done.get()
+    finally:
+        # if the caller stops early, don't start any more commands
+        stopping.set()
+
 def _get_command_with_blanks_filled_in(context, args, dialect):
     """This will launch the user's text editor for
     items that really need to be filled in (such as
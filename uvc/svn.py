@@ -1,13 +1,26 @@
 """Implements the Subversion VCS dialect."""
 import os
-import re
-import glob
+import json
+import stat
+import sqlite3
+import time
+import errno
+import fcntl
+import getpass
+import logging
+import tempfile
+import threading
+import ConfigParser
+from xml.parsers import expat
+from cStringIO import StringIO
 
 from uvc.commands import UVCError, DialectCommand, StatusOutput, BaseCommand,\
-                        SimpleStringOutput
+                        SimpleStringOutput, StreamingStatusOutput
 from uvc.exc import RepositoryAlreadyInitialized
 from uvc import util
 
+_log = logging.getLogger("uvc.svn")
+
 class SVNError(UVCError):
     """A Subversion-specific error."""
     pass
@@ -54,8 +67,189 @@ class clone(AuthSVNCommand):
 checkout = clone
 
 def _commit_log_file(working_dir):
+    """The plain text file of commit messages that older versions of
+    uvc kept. It is still pushed, if it is there."""
     return working_dir / ".svn_commit_messages"
 
+def _commit_journal_file(working_dir):
+    return working_dir / ".svn_commit_journal"
+
+class CommitJournal(object):
+    """The commits made in a working copy that haven't been pushed
+    yet, one JSON record per line (time, user, targets, message).
+
+    Records are only ever appended, under an exclusive flock, and
+    are on disk when append returns. Concurrent appends in one process
+    share fsyncs: each fsync covers every record written before it
+    started. The journal is only rewritten by discard_through, which
+    replaces the file; anything holding the lock checks that it still
+    has the current file before using it.
+
+    Where read has got to is described by a position, (inode, size,
+    offset): the file that was read, its size then, and the offset
+    just past the last whole record."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._written = 0
+        self._synced = 0
+
+    def _open_locked(self, flags, operation):
+        """Opens the journal with flags and takes the flock operation
+        on it, returning the descriptor, or None if the journal
+        doesn't exist (and flags don't create it)."""
+        while True:
+            try:
+                fd = os.open(self.filename, flags, 0644)
+            except OSError, e:
+                if e.errno == errno.ENOENT:
+                    return None
+                raise
+            fcntl.flock(fd, operation)
+            try:
+                current = os.stat(self.filename).st_ino
+            except OSError:
+                current = None
+            if current == os.fstat(fd).st_ino:
+                return fd
+            # replaced or removed while waiting for the lock
+            os.close(fd)
+
+    def append(self, record):
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        fd = self._open_locked(os.O_RDWR | os.O_APPEND | os.O_CREAT,
+                               fcntl.LOCK_EX)
+        try:
+            try:
+                size = os.fstat(fd).st_size
+                if size:
+                    os.lseek(fd, size - 1, os.SEEK_SET)
+                    if os.read(fd, 1) != "\n":
+                        # a record torn by a crash; end it, so that it
+                        # doesn't take this one down with it
+                        line = "\n" + line
+                while line:
+                    line = line[os.write(fd, line):]
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            with self._lock:
+                self._written += 1
+                ticket = self._written
+            with self._sync_lock:
+                if self._synced < ticket:
+                    with self._lock:
+                        covered = self._written
+                    os.fsync(fd)
+                    self._synced = covered
+        finally:
+            os.close(fd)
+
+    def exists(self):
+        try:
+            return os.path.getsize(self.filename) > 0
+        except OSError:
+            return False
+
+    def read(self):
+        """Returns the records and the position just past the last one,
+        reading the journal once. A torn record at the end (from a
+        crash part way through a write) is left out."""
+        fd = self._open_locked(os.O_RDONLY, fcntl.LOCK_SH)
+        if fd is None:
+            return [], (None, 0, 0)
+        records = []
+        offset = 0
+        try:
+            info = os.fstat(fd)
+            stream = os.fdopen(os.dup(fd), "rb")
+            try:
+                for line in stream:
+                    if not line.endswith("\n"):
+                        break
+                    offset += len(line)
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        _log.warning("Skipping a damaged record in %s",
+                                    self.filename)
+            finally:
+                stream.close()
+        finally:
+            os.close(fd)
+        return records, (info.st_ino, info.st_size, offset)
+
+    def discard_through(self, position):
+        """Throws away the records before position (as returned by
+        read), keeping any appended since. The journal is replaced with
+        a new file by rename, so it is never seen half rewritten. If
+        the journal isn't the file that was read any more (another
+        discard_through replaced it), nothing is thrown away."""
+        inode, size, offset = position
+        if inode is None:
+            return
+        fd = self._open_locked(os.O_RDWR, fcntl.LOCK_EX)
+        if fd is None:
+            return
+        try:
+            info = os.fstat(fd)
+            # records are only appended, so the file that was read can
+            # only have grown; the size also tells apart a new journal
+            # that happens to reuse the inode
+            if info.st_ino != inode or info.st_size < size:
+                _log.debug("%s was replaced since it was read; "
+                          "keeping it", self.filename)
+                return
+            if info.st_size <= offset:
+                os.unlink(self.filename)
+                return
+            os.lseek(fd, offset, os.SEEK_SET)
+            directory = os.path.dirname(os.path.abspath(self.filename))
+            temp_fd, temp_name = tempfile.mkstemp(dir=directory,
+                                                  prefix=".svn_commit_")
+            try:
+                with os.fdopen(temp_fd, "wb") as remainder:
+                    data = os.read(fd, util.read_size)
+                    while data:
+                        remainder.write(data)
+                        data = os.read(fd, util.read_size)
+                    remainder.flush()
+                    os.fsync(remainder.fileno())
+                os.chmod(temp_name, 0644)
+                os.rename(temp_name, self.filename)
+            except:
+                os.unlink(temp_name)
+                raise
+        finally:
+            os.close(fd)
+
+_journals = {}
+_journals_lock = threading.Lock()
+
+def get_commit_journal(working_dir):
+    """Returns the CommitJournal for working_dir, shared within the
+    process so that appends to it can share fsyncs."""
+    filename = os.path.abspath(_commit_journal_file(working_dir))
+    with _journals_lock:
+        journal = _journals.get(filename)
+        if journal is None:
+            journal = _journals[filename] = CommitJournal(filename)
+        return journal
+
+def _get_user(generic):
+    # the context's user is who is committing; the others may only be
+    # the account uvc runs under
+    if generic.user:
+        return generic.user
+    auth = generic.auth
+    if auth and auth.get("username"):
+        return auth["username"]
+    try:
+        return getpass.getuser()
+    except Exception:
+        return None
+
 class commit(SVNCommand):
     reads_remote = False
     writes_remote = False
@@ -67,12 +261,11 @@ class commit(SVNCommand):
         return None
         
     def get_output(self):
-        commit_log = _commit_log_file(self.generic.working_dir)
-        if not commit_log.exists():
-            content = self.generic.message + "\n\n"
-        else:
-            content = commit_log.text() + self.generic.message + "\n\n"
-        commit_log.write_text(content)
+        journal = get_commit_journal(self.generic.working_dir)
+        journal.append(dict(time=time.time(), 
+                            user=_get_user(self.generic),
+                            targets=list(self.generic.targets),
+                            message=self.generic.message))
         return SimpleStringOutput("Commit message saved. Don't forget to push to save to the remote repository!")
 
 class diff(SVNCommand):
@@ -82,6 +275,7 @@ class diff(SVNCommand):
 class remove(SVNCommand):
     reads_remote = False
     writes_remote = False
+    targets_file = (["--targets", "%s"], "\n")
     
     def command_parts(self):
         parts = super(remove, self).command_parts()
@@ -91,46 +285,68 @@ class remove(SVNCommand):
 
 delete = remove
 
-_status_line_mask = re.compile("^(.)..... (.*)$")
+# svn's own default global-ignores, for when its config doesn't set
+# them
+_default_global_ignores = ("*.o *.lo *.la *.al .libs *.so *.so.[0-9]* *.a "
+                           "*.pyc *.pyo __pycache__ *.rej *~ #*# .#* .*.swp "
+                           ".DS_Store [Tt]humbs.db")
 
-def _get_file_list(working_dir, status="?"):
-    retcode, stdout = util.run_in_directory(working_dir,
-        ["svn", "status"])
-    status_lines = stdout.read().split("\n")
-    file_list = []
-    for line in status_lines:
-        m = _status_line_mask.match(line)
-        if not m:
-            continue
-        if m.group(1) == status:
-            filename = m.group(2)
-            if not filename.startswith("."):
-                file_list.append(m.group(2))
-    
-    return file_list
+# where svn reads its runtime config, system-wide first so that the
+# user's own settings win
+config_files = ["/etc/subversion/config", 
+                os.path.expanduser("~/.subversion/config")]
+
+def _configured_global_ignores():
+    """Returns the global-ignores svn uses, read from its config."""
+    parser = ConfigParser.RawConfigParser()
+    try:
+        parser.read(config_files)
+        value = parser.get("miscellany", "global-ignores")
+    except ConfigParser.Error, e:
+        _log.debug("Using svn's default global-ignores: %s", e)
+        return _default_global_ignores
+    # the patterns may be continued over several lines
+    return " ".join(value.split())
+
+def _add_global_ignores():
+    """The global-ignores for add without targets: the configured
+    ones, plus dotfiles, which add leaves alone unless they are
+    named. A --config-option replaces the configured setting rather
+    than adding to it, so both are given."""
+    return _configured_global_ignores() + " .*"
 
 class add(SVNCommand):
     reads_remote = False
     writes_remote = False
+    targets_file = (["--targets", "%s"], "\n")
 
     def command_parts(self):
         parts = super(add, self).command_parts()
         if not self.targets:
-            parts.extend(_get_file_list(self.generic.working_dir))
+            # one recursive pass over the working copy, which skips
+            # what is already versioned and what is ignored
+            parts.extend(["--force", "--depth", "infinity", 
+                          "--config-option", 
+                          "config:miscellany:global-ignores=" + 
+                          _add_global_ignores(), "."])
         return parts
 
 class push(AuthSVNCommand):
     reads_remote = True
     writes_remote = True
     
+    # how much of the commit journal the message was made from
+    journal_position = (None, 0, 0)
+    
     def get_command_line(self):
-        commit_log = _commit_log_file(self.generic.working_dir)
-        if not commit_log.exists():
+        working_dir = self.generic.working_dir
+        if not get_commit_journal(working_dir).exists() and \
+           not _commit_log_file(working_dir).exists():
             return None
         return super(push, self).get_command_line()
         
     def get_output(self):
-        # only called if the commit_log doesn't exist
+        # only called if there is nothing in the journal
         return SimpleStringOutput("Nothing to push. Run commit first.")
     
     def command_parts(self):
@@ -138,13 +354,25 @@ class push(AuthSVNCommand):
         self.add_auth_info(parts)
         parts.append("commit")
         parts.append("-m")
-        commit_log = _commit_log_file(self.generic.working_dir)
-        parts.append(commit_log.text())
+        working_dir = self.generic.working_dir
+        message = []
+        commit_log = _commit_log_file(working_dir)
+        if commit_log.exists():
+            message.append(commit_log.text())
+        records, self.journal_position = \
+            get_commit_journal(working_dir).read()
+        for record in records:
+            message.append(record["message"] + "\n\n")
+        parts.append("".join(message))
         return parts
         
     def command_successful(self):
-        commit_log = _commit_log_file(self.generic.working_dir)
-        commit_log.unlink()
+        working_dir = self.generic.working_dir
+        get_commit_journal(working_dir).discard_through(
+            self.journal_position)
+        commit_log = _commit_log_file(working_dir)
+        if commit_log.exists():
+            commit_log.unlink()
 
 class update(AuthSVNCommand):
     reads_remote = True
@@ -158,6 +386,7 @@ class update(AuthSVNCommand):
 class resolved(SVNCommand):
    reads_remote = False
    writes_remote = False
+   targets_file = (["--targets", "%s"], "\n")
 
    def command_parts(self):
        parts = super(resolved, self).command_parts()
@@ -165,36 +394,288 @@ class resolved(SVNCommand):
        parts.insert(1, "--accept")
        parts.insert(2, "working")
        if not self.targets:
-           parts.extend(_get_file_list(self.generic.working_dir, status="C"))
+           # every conflicted file, found by svn as it goes
+           parts.extend(["-R", "."])
        return parts
 
+class cat(SVNCommand):
+    writes_remote = False
+    
+    @property
+    def reads_remote(self):
+        # without -r, svn reads the working copy's pristine copies
+        return bool(self.generic.revision)
+
+# the item attribute of wc-status in svn status --xml -> uvc state
+_xml_item_states = {
+    "modified": StatusOutput.MODIFIED,
+    "merged": StatusOutput.MODIFIED,
+    "conflicted": StatusOutput.MODIFIED,
+    "replaced": StatusOutput.MODIFIED,
+    "added": StatusOutput.ADDED,
+    "deleted": StatusOutput.REMOVED,
+    "normal": StatusOutput.CLEAN,
+    "missing": StatusOutput.MISSING,
+    "incomplete": StatusOutput.MISSING,
+    "obstructed": StatusOutput.MISSING,
+    "unversioned": StatusOutput.UNKNOWN,
+    "ignored": StatusOutput.IGNORED,
+}
+
+def _parse_status(stdout):
+    """Yields (state, filename) pairs from svn status --xml. The XML
+    is parsed as it is read, so memory use doesn't depend on the
+    size of the output."""
+    entries = []
+    current = []
+    
+    def start_element(name, attributes):
+        if name == "entry":
+            current[:] = [attributes.get("path")]
+        elif name == "wc-status" and current:
+            item = attributes.get("item")
+            if item in ("normal", "none") \
+               and attributes.get("props") in ("modified", "conflicted"):
+                state = StatusOutput.MODIFIED
+            else:
+                state = _xml_item_states.get(item)
+            if state is not None:
+                entries.append((state, current[0]))
+            del current[:]
+    
+    parser = expat.ParserCreate()
+    # filenames come back as UTF-8 byte strings, like the other dialects
+    parser.returns_unicode = False
+    parser.StartElementHandler = start_element
+    started = False
+    try:
+        for chunk in util.read_chunks(stdout):
+            started = True
+            parser.Parse(chunk, False)
+            for entry in entries:
+                yield entry
+            del entries[:]
+        if started:
+            parser.Parse("", True)
+    except expat.ExpatError, e:
+        # svn's error messages are mixed in with its output, and they
+        # end the XML. Report what was read up to that point.
+        _log.warning("svn status output is not valid XML: %s", e)
+    for entry in entries:
+        yield entry
+
 class status(SVNCommand):
     reads_remote = False
     writes_remote = False
+    
+    def command_parts(self):
+        parts = super(status, self).command_parts()
+        parts.insert(1, "--xml")
+        return parts
 
     def process_output(self, returncode, stdout):
-        return StatusOutput(returncode, stdout)
+        return StatusOutput(returncode, stdout, _parse_status)
+    
+    def process_output_stream(self, stream):
+        return StreamingStatusOutput(stream, _parse_status)
+    
+    def process_batch_output(self, returncode, outputs):
+        # each run prints an XML document of its own
+        output = StatusOutput(returncode)
+        for data in outputs:
+            for state, filename in _parse_status(StringIO(data)):
+                output.append(state, filename)
+        return output
 
 class revert(SVNCommand):
     reads_remote = False
     writes_remote = False
+    targets_file = (["--targets", "%s"], "\n")
 
     def command_parts(self):
         parts = super(revert, self).command_parts()
         if not self.targets:
-            parts.append("-R")
-            pwd = os.getcwd()
-            try:
-                os.chdir(self.generic.working_dir)
-                parts.extend(glob.glob("*"))
-            finally:
-                os.chdir(pwd)
+            parts.extend(["-R", "."])
         return parts
 
+class WorkingCopyDBError(SVNError):
+    """The working copy has no wc.db, or one this can't read."""
+    pass
+
+# the wc.db formats (PRAGMA user_version) of svn 1.7 to 1.14, whose
+# NODES tables all look the same
+_wc_db_formats = set([29, 30, 31, 32])
+
+# what the NODES table calls a node that is in the working copy
+_present = ("normal", "incomplete")
+
+def _find_wc_root(directory):
+    directory = os.path.abspath(directory)
+    while True:
+        if os.path.exists(os.path.join(directory, ".svn", "wc.db")):
+            return directory
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return None
+        directory = parent
+
+class WorkingCopyDB(object):
+    """Reads what svn 1.7 and later record about a working copy in
+    .svn/wc.db, without running svn. Nothing is ever written to it.
+    Paths are relative to the working copy's root, with "/" between
+    directories, as svn stores them.
+    
+    Raises WorkingCopyDBError for a working copy without a wc.db, or
+    with a format that isn't known."""
+    
+    def __init__(self, directory, busy_timeout=10):
+        self.root = _find_wc_root(directory)
+        if self.root is None:
+            raise WorkingCopyDBError("No wc.db above %s" % directory)
+        self.filename = os.path.join(self.root, ".svn", "wc.db")
+        try:
+            self.connection = sqlite3.connect(self.filename, 
+                                              timeout=busy_timeout)
+            # svn's database, so make sure nothing here can change it
+            self.connection.execute("PRAGMA query_only=ON")
+            self.connection.text_factory = str
+            self.format = self.connection.execute(
+                "PRAGMA user_version").fetchone()[0]
+        except sqlite3.Error, e:
+            raise WorkingCopyDBError("Unable to read %s: %s" 
+                                     % (self.filename, e))
+        if self.format not in _wc_db_formats:
+            self.close()
+            raise WorkingCopyDBError("Unknown wc.db format %s in %s"
+                                     % (self.format, self.root))
+    
+    def _select(self, condition="", arguments=()):
+        # a path's current state is its row with the highest op_depth;
+        # rows below it are what is being replaced or deleted
+        query = ("SELECT local_relpath, kind, presence, revision, "
+                 "translated_size, last_mod_time FROM nodes AS n "
+                 "WHERE op_depth = (SELECT MAX(op_depth) FROM nodes "
+                 "WHERE wc_id = n.wc_id AND local_relpath = n.local_relpath)"
+                 + condition)
+        try:
+            rows = self.connection.execute(query, arguments)
+            for relpath, kind, presence, revision, size, mtime in rows:
+                if presence not in _present or not relpath:
+                    continue
+                if size is not None and size < 0:
+                    size = None
+                if mtime is not None:
+                    # svn keeps microseconds
+                    mtime = mtime / 1000000.0
+                yield relpath, kind, revision, size, mtime
+        except sqlite3.Error, e:
+            raise WorkingCopyDBError("Unable to read %s: %s" 
+                                     % (self.filename, e))
+    
+    def nodes(self, prefix=""):
+        """Yields (path, kind, revision, size, mtime) for each file and
+        directory in the working copy at or below prefix, including
+        added ones (whose revision is None). size and mtime (in
+        seconds) are what svn saw when the file last matched its
+        text base, or None if it hasn't recorded that."""
+        if not prefix:
+            return self._select()
+        # the paths below prefix sort between prefix + "/" and prefix +
+        # "0" ("0" follows "/"); comparing them works on the encoded
+        # bytes, where substr would count characters
+        return self._select(" AND (local_relpath = ? OR "
+                            "(local_relpath > ? AND local_relpath < ?))",
+                            (prefix, prefix + "/", prefix + "0"))
+    
+    def get_node(self, relpath):
+        """Returns the nodes() entry for relpath, or None if it isn't
+        versioned."""
+        for node in self._select(" AND local_relpath = ?", (relpath,)):
+            return node
+        return None
+    
+    def close(self):
+        self.connection.close()
+
+def _relative_to_root(wcdb, directory):
+    relative = os.path.relpath(os.path.abspath(directory), wcdb.root)
+    if relative == ".":
+        return ""
+    return relative.replace(os.sep, "/")
+
+def _changed_on_disk(filename, size, mtime):
+    try:
+        info = os.lstat(filename)
+    except OSError:
+        return True
+    if size is None or mtime is None or not stat.S_ISREG(info.st_mode):
+        return True
+    return info.st_size != size or abs(info.st_mtime - mtime) > 0.000001
+
+def _versioned_files_from_status(working_dir):
+    retcode, stdout = util.run_in_directory(working_dir,
+        ["svn", "status", "-v", "--xml"])
+    return [filename for state, filename in _parse_status(stdout)
+            if state not in (StatusOutput.UNKNOWN, StatusOutput.IGNORED,
+                             StatusOutput.REMOVED)
+            and not os.path.isdir(os.path.join(working_dir, filename))]
+
+def versioned_files(working_dir):
+    """Returns the versioned files at or below working_dir, relative
+    to it, read from wc.db if possible and from svn status otherwise.
+    Files that are being deleted aren't included."""
+    try:
+        wcdb = WorkingCopyDB(working_dir)
+    except WorkingCopyDBError, e:
+        _log.debug("Running svn status instead: %s", e)
+        return _versioned_files_from_status(working_dir)
+    try:
+        prefix = _relative_to_root(wcdb, working_dir)
+        start = len(prefix) + 1 if prefix else 0
+        return [relpath[start:] for relpath, kind, revision, size, mtime 
+                in wcdb.nodes(prefix) if kind == "file"]
+    finally:
+        wcdb.close()
+
+def possibly_modified(working_dir, filenames):
+    """Returns the filenames (relative to working_dir) that are
+    unversioned, or that svn status could report as changed: ones whose
+    size or modification time differ from what svn recorded. The rest
+    certainly haven't changed since svn last looked at them (apart
+    from their properties, which aren't checked). Without a readable
+    wc.db, every filename is returned."""
+    try:
+        wcdb = WorkingCopyDB(working_dir)
+    except WorkingCopyDBError, e:
+        _log.debug("Not checking wc.db: %s", e)
+        return list(filenames)
+    try:
+        prefix = _relative_to_root(wcdb, working_dir)
+        result = []
+        for filename in filenames:
+            relpath = filename.replace(os.sep, "/")
+            if prefix:
+                relpath = prefix + "/" + relpath
+            node = wcdb.get_node(relpath)
+            if node is None or node[2] is None or \
+               _changed_on_disk(os.path.join(working_dir, filename),
+                                node[3], node[4]):
+                result.append(filename)
+        return result
+    finally:
+        wcdb.close()
+
 class SVNDialect(object):
     
     name = "svn"
     
+    # the directory that marks a working copy of this dialect
+    marker = ".svn"
+    
+    # the working copy database in the marker directory (the first
+    # one that exists is used; svn before 1.7 has entries)
+    state_files = ["wc.db", "entries"]
+    
     def convert(self, command_object):
         """Converts to an SVN-specific command."""
         local_command = self.get_dialect_command_class(command_object.__class__.__name__)
@@ -222,7 +703,16 @@ class SVNDialect(object):
         """Returns 1 if the .svn directory is here, 2 otherwise. svn
         plants directories everywhere, so if it's not in the current
         directory, it's not an svn project."""
-        if os.path.isdir(".svn"):
+        return self.is_this_dialect(os.getcwd())
+    
+    def is_this_dialect(self, directory):
+        """Returns 1 if the .svn directory is in directory, 2 otherwise."""
+        if os.path.isdir(os.path.join(directory, self.marker)):
             return 1
         return 2
+    
+    def fingerprint_files(self, root):
+        """Returns the working copy database, for cache fingerprints."""
+        marker = os.path.join(root, self.marker)
+        return [os.path.join(marker, name) for name in self.state_files]
     
\ No newline at end of file
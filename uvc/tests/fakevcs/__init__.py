@@ -0,0 +1,111 @@
+"""Fake hg, git and svn executables for load and stress testing
+without real repositories. FakeVCS puts them at the front of PATH and
+configures what each subcommand does::
+
+    fake = FakeVCS()
+    fake.set("hg", "status", lines=2000000, line="M file%(n)d.txt\\n")
+    fake.set("git", "diff", bytes=500 * 1024 * 1024, rate=50 * 1024 * 1024)
+    fake.set("hg", "fetch", output="pulling\\n", hang=3600)
+    with fake:
+        ... run uvc commands ...
+
+A behaviour can have:
+
+* output: a string to write first
+* lines, line: write lines lines from the template line, which is
+  formatted with the line number as %(n)d
+* bytes: write that many bytes of diff-like text
+* chunk_size: how much to write at a time (64k by default)
+* rate: at most this many bytes per second
+* delay: seconds to sleep after each chunk (trickling output)
+* stderr: a string to write to stderr
+* hang: seconds to sleep once the output is written
+* exit: the exit status (0 by default)
+
+The subcommand "default" applies to anything not otherwise
+configured. Each invocation's arguments are recorded, see calls()."""
+
+import os
+import sys
+import copy
+import json
+import shutil
+import tempfile
+from functools import wraps
+
+from uvc.path import path
+
+script = path(__file__).dirname().abspath() / "fakevcs.py"
+
+dialects = ["hg", "git", "svn"]
+
+class FakeVCS(object):
+    
+    def __init__(self, behaviours=None):
+        self.behaviours = copy.deepcopy(behaviours or {})
+        self.bin_dir = None
+        self._saved_environ = None
+    
+    def set(self, dialect, subcommand, **behaviour):
+        """Sets what dialect's subcommand does. Takes effect for the
+        next command started, even while installed."""
+        self.behaviours.setdefault(dialect, {})[subcommand] = behaviour
+        if self.bin_dir is not None:
+            self._write_config()
+    
+    def _write_config(self):
+        with open(self.bin_dir / "config.json", "w") as f:
+            json.dump(self.behaviours, f)
+    
+    def install(self):
+        """Creates the executables and puts them first on PATH."""
+        self.bin_dir = path(tempfile.mkdtemp(prefix="uvc-fakevcs-"))
+        for dialect in dialects:
+            executable = self.bin_dir / dialect
+            executable.write_text('#!/bin/sh\nexec "%s" "%s" %s "$@"\n' 
+                                  % (sys.executable, script, dialect))
+            executable.chmod(0755)
+        self._write_config()
+        self._saved_environ = dict((name, os.environ.get(name)) for name in
+            ["PATH", "UVC_FAKEVCS_CONFIG", "UVC_FAKEVCS_LOG"])
+        os.environ["PATH"] = self.bin_dir + os.pathsep + \
+            os.environ.get("PATH", "")
+        os.environ["UVC_FAKEVCS_CONFIG"] = self.bin_dir / "config.json"
+        os.environ["UVC_FAKEVCS_LOG"] = self.bin_dir / "calls.log"
+    
+    def uninstall(self):
+        """Restores PATH and removes the executables."""
+        for name, value in self._saved_environ.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        shutil.rmtree(self.bin_dir)
+        self.bin_dir = None
+    
+    def calls(self):
+        """The command lines run so far, as lists starting with the
+        dialect name."""
+        log_file = self.bin_dir / "calls.log"
+        if not log_file.exists():
+            return []
+        return [json.loads(line) for line in log_file.lines()]
+    
+    def __enter__(self):
+        self.install()
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.uninstall()
+        return False
+
+def fake_vcs(behaviours=None):
+    """Decorates a test so that it runs with the fake executables
+    installed. The FakeVCS is passed to the test."""
+    def entangle(func):
+        @wraps(func)
+        def new_one():
+            with FakeVCS(behaviours) as fake:
+                return func(fake)
+        return new_one
+    return entangle
@@ -0,0 +1,106 @@
+"""Stand-in for the hg, git and svn executables. It is run as
+
+    python fakevcs.py <dialect> <arguments...>
+
+and behaves as described by the JSON file named in the
+UVC_FAKEVCS_CONFIG environment variable, which maps dialects to
+subcommands to behaviours (see uvc.tests.fakevcs.FakeVCS). The output
+only depends on the configuration, so runs are reproducible."""
+
+import os
+import sys
+import json
+import time
+
+def find_behaviour(config, dialect, args):
+    """The behaviour for the first argument that names a configured
+    subcommand, or the dialect's "default"."""
+    subcommands = config.get(dialect, {})
+    for arg in args:
+        if arg in subcommands:
+            return subcommands[arg]
+    return subcommands.get("default", {})
+
+class Throttle(object):
+    """Limits output to rate bytes per second (no limit if rate is
+    None) and pauses delay seconds between chunks."""
+    
+    def __init__(self, rate, delay):
+        self.rate = rate
+        self.delay = delay
+        self.start = time.time()
+        self.written = 0
+    
+    def wrote(self, size):
+        self.written += size
+        if self.delay:
+            time.sleep(self.delay)
+        if self.rate:
+            ahead = self.written / float(self.rate) - \
+                (time.time() - self.start)
+            if ahead > 0:
+                time.sleep(ahead)
+
+def write(out, data, throttle):
+    out.write(data)
+    out.flush()
+    throttle.wrote(len(data))
+
+def generate(behaviour, out):
+    throttle = Throttle(behaviour.get("rate"), behaviour.get("delay"))
+    chunk_size = behaviour.get("chunk_size", 65536)
+    
+    if "output" in behaviour:
+        write(out, behaviour["output"], throttle)
+    
+    lines = behaviour.get("lines")
+    if lines:
+        template = behaviour.get("line", "M file%(n)d.txt\n")
+        batch = max(chunk_size // max(len(template % dict(n=lines)), 1), 1)
+        for start in xrange(0, lines, batch):
+            write(out, "".join(template % dict(n=n) for n in 
+                               xrange(start, min(start + batch, lines))),
+                  throttle)
+    
+    size = behaviour.get("bytes")
+    if size:
+        # a diff-like block that repeats
+        block = "".join("+line %d of a large change\n" % n 
+                        for n in range(chunk_size // 28 + 1))[:chunk_size]
+        remaining = size
+        while remaining > 0:
+            data = block[:remaining]
+            write(out, data, throttle)
+            remaining -= len(data)
+
+def main(argv):
+    dialect = argv[1]
+    args = argv[2:]
+    config = {}
+    config_file = os.environ.get("UVC_FAKEVCS_CONFIG")
+    if config_file:
+        with open(config_file) as f:
+            config = json.load(f)
+    
+    log_file = os.environ.get("UVC_FAKEVCS_LOG")
+    if log_file:
+        with open(log_file, "a") as f:
+            f.write(json.dumps([dialect] + args) + "\n")
+    
+    behaviour = find_behaviour(config, dialect, args)
+    if "stderr" in behaviour:
+        sys.stderr.write(behaviour["stderr"])
+        sys.stderr.flush()
+    try:
+        generate(behaviour, sys.stdout)
+    except IOError:
+        # the reader went away
+        return 141
+    
+    hang = behaviour.get("hang")
+    if hang:
+        time.sleep(hang)
+    return behaviour.get("exit", 0)
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,60 @@
+from uvc.cache import LRUCache, CacheManager
+
+def test_lru_cache_evicts_least_recently_used():
+    lru = LRUCache(max_entries=2)
+    lru.put("a", 1)
+    lru.put("b", 2)
+    assert lru.get("a") == 1
+    lru.put("c", 3)
+    assert "b" not in lru
+    assert lru.get("a") == 1
+    assert lru.get("c") == 3
+    assert lru.get("b", "missing") == "missing"
+    stats = lru.stats()
+    assert stats == dict(entries=2, bytes=0, hits=3, misses=1, 
+                         evictions=1), stats
+
+def test_lru_cache_discard_if():
+    lru = LRUCache()
+    for i in range(10):
+        lru.put(i, i * i)
+    lru.discard_if(lambda key, value: key % 2)
+    assert len(lru) == 5
+    assert 3 not in lru
+    assert lru.get(4) == 16
+
+def test_lru_cache_byte_budget():
+    lru = LRUCache(max_bytes=100)
+    lru.put("a", "x" * 60, size=60)
+    lru.put("b", "y" * 30, size=30)
+    lru.put("c", "z" * 30, size=30)
+    assert "a" not in lru
+    assert lru.stats()["bytes"] == 60
+    lru.put("huge", "!" * 200, size=200)
+    assert "huge" not in lru
+    assert len(lru) == 2
+
+def test_cache_manager_budget():
+    manager = CacheManager(max_bytes=100)
+    cheap = manager.register("cheap", LRUCache())
+    costly = manager.register("costly", LRUCache(default_cost=10))
+    costly.put("a", "x", size=40)
+    cheap.put("b", "y", size=40)
+    assert manager.bytes == 80
+    # the cheap cache gives up its item, though it is the newer one
+    costly.put("c", "z", size=40)
+    assert "b" not in cheap
+    assert "a" in costly and "c" in costly
+    assert cheap.get("b") is None
+    assert costly.get("a") == "x"
+    stats = manager.stats()
+    assert stats["cheap"]["evictions"] == 1
+    assert stats["cheap"]["hit_ratio"] == 0.0
+    assert stats["costly"]["hit_ratio"] == 1.0
+    assert stats["costly"]["bytes"] == 80
+
+    manager.set_budget(50)
+    assert manager.bytes <= 50
+    manager.unregister("costly")
+    assert costly.manager is None
+    assert manager.stats().keys() == ["cheap"]
@@ -0,0 +1,125 @@
+import os
+import stat
+import tempfile
+import subprocess
+import sys
+
+from uvc.path import path
+from uvc import cachestore, main
+
+tmpdir = None
+
+def setup_module(module):
+    global tmpdir
+    tmpdir = path(tempfile.mkdtemp())
+
+def teardown_module(module):
+    tmpdir.rmtree()
+
+def test_store_round_trip_and_ttl():
+    store = cachestore.CacheStore(tmpdir / "roundtrip.db", ttls=dict(short=-1))
+    try:
+        store.put("results", ("dir", ("git", "status")), (0, "M \0a"))
+        assert store.get("results", ("dir", ("git", "status"))) == (0, "M \0a")
+        assert store.get("results", "missing") is None
+        assert store.get("other", ("dir", ("git", "status"))) is None
+        
+        store.put("short", "key", "value")
+        assert store.get("short", "key", "expired") == "expired"
+        
+        stats = store.stats()
+        assert stats["results"]["entries"] == 1
+        assert stats["results"]["hits"] == 1
+        assert stats["results"]["misses"] == 1
+        assert stats["short"]["entries"] == 0
+    finally:
+        store.close()
+    
+    # still there after "restarting"
+    store = cachestore.CacheStore(tmpdir / "roundtrip.db")
+    try:
+        assert store.get("results", ("dir", ("git", "status"))) == (0, "M \0a")
+    finally:
+        store.close()
+
+def test_store_evicts_least_recently_used():
+    store = cachestore.CacheStore(tmpdir / "evict.db", max_bytes=10000)
+    try:
+        for i in range(30):
+            store.put("blobs", i, "x" * 1000)
+        stats = store.stats()["blobs"]
+        assert stats["bytes"] <= 10000
+        assert store.get("blobs", 29) is not None
+        assert store.get("blobs", 0) is None
+    finally:
+        store.close()
+
+def test_store_keys_are_canonical():
+    store = cachestore.CacheStore(tmpdir / "keys.db")
+    try:
+        name = "x" * 20
+        # pickled, the first key refers back to its first string
+        store.put("results", (name, name), "value")
+        assert store.get("results", ("x" * 20, "".join(["x"] * 20))) == \
+            "value"
+        assert store.get("results", [u"x" * 20, path("x" * 20)]) == "value"
+        store.delete("results", ("x" * 20, "x" * 20))
+        assert store.get("results", (name, name)) is None
+    finally:
+        store.close()
+
+def test_store_only_trusts_its_owner():
+    filename = tmpdir / "private.db"
+    store = cachestore.CacheStore(filename)
+    store.put("results", "key", "value")
+    store.close()
+    assert stat.S_IMODE(os.stat(filename).st_mode) == 0600
+    
+    os.chmod(filename, 0666)
+    try:
+        cachestore.CacheStore(filename)
+        assert False, "Expected CacheStoreError"
+    except cachestore.CacheStoreError:
+        pass
+    os.chmod(filename, 0600)
+    if os.getuid() == 0:
+        os.chown(filename, 12345, -1)
+        try:
+            cachestore.CacheStore(filename)
+            assert False, "Expected CacheStoreError"
+        except cachestore.CacheStoreError:
+            pass
+
+def test_store_shared_between_processes():
+    filename = tmpdir / "shared.db"
+    writer = """
+import sys
+from uvc import cachestore
+store = cachestore.CacheStore(sys.argv[1])
+for i in range(200):
+    store.put("results", (sys.argv[2], i), i)
+"""
+    processes = [subprocess.Popen([sys.executable, "-c", writer, filename, 
+                                   str(n)]) for n in range(4)]
+    assert [process.wait() for process in processes] == [0] * 4
+    store = cachestore.CacheStore(filename)
+    try:
+        assert store.stats()["results"]["entries"] == 800
+        assert store.get("results", ("3", 199)) == 199
+    finally:
+        store.close()
+
+def test_dialect_cache_writes_through():
+    store = cachestore.CacheStore(tmpdir / "dialects.db")
+    working_copy = tmpdir / "wc"
+    (working_copy / ".hg").makedirs()
+    main.use_cache_store(store)
+    try:
+        assert main.infer_dialect(working_copy).name == "hg"
+        main.dialect_cache.clear()
+        hits = store.stats()["dialects"]["hits"]
+        assert main.infer_dialect(working_copy).name == "hg"
+        assert store.stats()["dialects"]["hits"] == hits + 1
+    finally:
+        main.use_cache_store(None)
+        store.close()
@@ -1,4 +1,6 @@
 
+from cStringIO import StringIO
+
 from uvc.path import path
 from uvc import commands
 from uvc.tests.util import test_context
@@ -70,6 +72,26 @@ def test_status_command():
     status = commands.status(test_context, ["mydir"])
     assert str(status) == "status mydir"
 
+def test_status_output_columns():
+    output = commands.StatusOutput(0, StringIO(
+        "M a file\n? unknown\nM other\nnot a status line\n! gone\n"))
+    assert len(output) == 4
+    assert output.count("M") == 2
+    assert output.count("A") == 0
+    assert output.counts()["?"] == 1
+    assert list(output.modified()) == ["a file", "other"]
+    assert list(output.unknown()) == ["unknown"]
+    assert list(output.missing()) == ["gone"]
+    assert list(output.added()) == []
+    assert output.as_list() == [["M", "a file"], ["?", "unknown"],
+                                ["M", "other"], ["!", "gone"]]
+    assert output.data is output.as_list()
+    
+    output.append("A", "new")
+    assert list(output.added()) == ["new"]
+    assert output.as_list()[-1] == ["A", "new"]
+    assert str(output) == "M a file\n? unknown\nM other\n! gone\nA new\n"
+
 def test_remove_command():
     remove = commands.remove(test_context, ["myfile"])
     assert not remove.reads_remote
@@ -0,0 +1,53 @@
+from uvc.path import path
+from uvc import commands, main, hg, git, svn
+from uvc.tests.fakevcs import fake_vcs
+
+topdir = path(__file__).dirname().abspath() / ".." / ".." / "testfiles"
+
+context = None
+
+def setup_module(module):
+    global context
+    if not topdir.exists():
+        topdir.mkdir()
+    context = main.Context(topdir)
+
+@fake_vcs({"hg": {"status": dict(lines=100000, line="? file%(n)d.txt\0")}})
+def test_large_status_streams(fake):
+    status = hg.status(commands.status(context, []))
+    output = main.run_command(status, context, stream=True)
+    count = 0
+    for state, filename in output:
+        assert state == "?"
+        count += 1
+    assert count == 100000
+    assert filename == "file99999.txt"
+    assert output.return_code == 0
+    assert fake.calls() == [["hg", "status", "-0"]]
+
+@fake_vcs()
+def test_exit_status_and_stderr(fake):
+    fake.set("git", "diff", output="partial\n", stderr="fatal: broken\n", 
+             exit=128)
+    diff = git.diff(commands.diff(context, []))
+    output = main.run_command(diff, context)
+    assert output.return_code == 128
+    assert "partial\n" in str(output)
+    assert "fatal: broken\n" in str(output)
+
+@fake_vcs({"svn": {"update": dict(output="Updating\n", hang=60)}})
+def test_hang_times_out(fake):
+    update = svn.update(commands.update(context, []))
+    output = main.run_command(update, context, timeout=0.5)
+    assert output.timed_out
+    assert str(output) == "Updating\n"
+
+@fake_vcs({"git": {"diff": dict(bytes=300000, chunk_size=100000, 
+                                delay=0.05)}})
+def test_trickling_output(fake):
+    diff = git.diff(commands.diff(context, []))
+    output = main.run_command(diff, context, stream=True)
+    chunks = list(output.chunks())
+    assert sum(len(chunk) for chunk in chunks) == 300000
+    assert len(chunks) >= 3
+    assert output.usage.wall_time >= 0.15
@@ -0,0 +1,505 @@
+import os
+import time
+import errno
+import tempfile
+import threading
+import subprocess
+
+from uvc.path import path
+from uvc import commands, git, main, gitbatch, util, exc
+
+topdir = path(__file__).dirname().abspath() / ".." / ".." / "testfiles"
+repodir = topdir / "gitrepo"
+
+context = None
+
+def _git(*args):
+    subprocess.check_call(["git", "-c", "user.name=uvc", 
+                           "-c", "user.email=uvc@example.com"] + list(args),
+                          cwd=repodir, stdout=subprocess.PIPE)
+
+def setup_module(module):
+    global context
+    if repodir.exists():
+        repodir.rmtree()
+    repodir.makedirs()
+    (repodir / ".gitattributes").write_text("*.txt text\n*.bin binary\n")
+    (repodir / "a.txt").write_bytes("first version\n")
+    (repodir / "b.bin").write_bytes("\0\1\2")
+    _git("init", "-q")
+    _git("add", ".")
+    _git("commit", "-q", "-m", "first")
+    (repodir / "a.txt").write_bytes("second version\n")
+    _git("commit", "-q", "-a", "-m", "second")
+    context = main.Context(repodir)
+
+def teardown_module(module):
+    git.batch_helpers.close()
+    repodir.rmtree()
+
+def test_cat_command():
+    generic_cat = commands.cat(context, ["-r", "HEAD~1", "a.txt", "b.bin"])
+    cat = git.cat(generic_cat)
+    assert not cat.reads_remote
+    assert not cat.writes_remote
+    assert cat.get_command_line() == ["git", "show", "HEAD~1:./a.txt",
+                                      "HEAD~1:./b.bin"]
+    output = main.run_command(cat, context)
+    assert output.return_code == 0
+    assert str(output) == "first version\n\0\1\2"
+
+def test_cat_missing_file():
+    cat = git.cat(commands.cat(context, ["a.txt", "nothere.txt"]))
+    output = main.run_command(cat, context)
+    assert output.return_code == 128
+    assert str(output) == "second version\n" \
+        "fatal: path 'nothere.txt' does not exist in 'HEAD'\n"
+
+def test_read_files_pipelines_many_requests():
+    paths = ["a.txt", "b.bin", "missing"] * 5000
+    result = git.read_files(repodir, paths, "HEAD")
+    assert result[:3] == ["second version\n", "\0\1\2", None]
+    assert len(result) == 15000
+    assert result[-2] == "\0\1\2"
+
+def test_status_command():
+    status = git.status(commands.status(context, []))
+    assert status.get_command_line() == ["git", "status", "--porcelain=v2", 
+                                         "-z"]
+    (repodir / "a.txt").write_bytes("changed\n")
+    (repodir / "new\nline.txt").write_bytes("new\n")
+    (repodir / "added.txt").write_bytes("added\n")
+    _git("add", "added.txt")
+    _git("mv", "b.bin", "moved.bin")
+    try:
+        output = main.run_command(status, context)
+        assert sorted(output.as_list()) == [
+            ["?", "new\nline.txt"],
+            ["A", "added.txt"],
+            ["A", "moved.bin"],
+            ["M", "a.txt"],
+            ["R", "b.bin"]]
+        
+        streamed = main.run_command(status, context, stream=True)
+        assert sorted(streamed) == sorted(output.as_list())
+    finally:
+        _git("reset", "-q", "--hard")
+        _git("clean", "-q", "-f")
+
+def test_status_in_subdirectory():
+    (repodir / "sub").makedirs()
+    (repodir / "sub" / "c.txt").write_bytes("c\n")
+    _git("add", "sub/c.txt")
+    _git("commit", "-q", "-m", "sub")
+    try:
+        (repodir / "sub" / "c.txt").write_bytes("changed\n")
+        (repodir / "sub" / "new.txt").write_bytes("new\n")
+        (repodir / "a.txt").write_bytes("changed\n")
+        subcontext = main.Context(repodir / "sub")
+        status = git.status(commands.status(subcontext, []))
+        expected = [["?", "new.txt"], ["M", "../a.txt"], ["M", "c.txt"]]
+        assert sorted(main.run_command(status, subcontext).as_list()) == \
+            expected
+        assert sorted(main.run_command(status, subcontext, stream=True)) == \
+            expected
+    finally:
+        _git("reset", "-q", "--hard", "HEAD~1")
+        _git("clean", "-q", "-f", "-d")
+
+def _backdate(*names):
+    # git rewrites its index on every status while files are as new as
+    # the index ("racy" entries), which would change the fingerprint
+    then = time.time() - 60
+    for name in names:
+        os.utime(repodir / name, (then, then))
+
+def test_result_cache():
+    _backdate("a.txt", "b.bin", ".gitattributes")
+    status = git.status(commands.status(context, []))
+    main.run_command(status, context)
+    
+    results = main.use_result_cache(max_bytes=1024 * 1024)
+    try:
+        assert main.run_command(status, context).as_list() == []
+        assert main.run_command(status, context).as_list() == []
+        assert results.stats()["hits"] == 1
+        
+        (repodir / "a.txt").write_bytes("changed for the cache\n")
+        _backdate("a.txt")
+        assert main.run_command(status, context).as_list() == [["M", "a.txt"]]
+        assert main.run_command(status, context).as_list() == [["M", "a.txt"]]
+        assert results.stats()["hits"] == 2
+        
+        diff = git.diff(commands.diff(context, ["a.txt"]))
+        first = str(main.run_command(diff, context))
+        assert "+changed for the cache" in first
+        # only a.txt (and the git metadata) matters to this diff
+        (repodir / "other.txt").write_bytes("untracked\n")
+        assert str(main.run_command(diff, context)) == first
+        assert results.stats()["hits"] == 3
+        
+        # commands that change things are never cached
+        misses = results.stats()["misses"]
+        add = git.add(commands.add(context, ["other.txt"]))
+        main.run_command(add, context)
+        assert results.stats()["misses"] == misses
+        assert sorted(main.run_command(status, context).as_list()) == [
+            ["A", "other.txt"], ["M", "a.txt"]]
+    finally:
+        main.stop_result_cache()
+        _git("reset", "-q", "--hard")
+        _git("clean", "-q", "-f")
+
+class failing_diff(git.diff):
+    def get_command_line(self):
+        return ["git", "diff", "--no-such-option"]
+
+def test_result_cache_follows_ignore_rules():
+    (repodir / "scratch.tmp").write_bytes("scratch\n")
+    _backdate("a.txt", "b.bin", ".gitattributes", "scratch.tmp")
+    status = git.status(commands.status(context, []))
+    targeted = git.status(commands.status(context, ["scratch.tmp"]))
+    main.run_command(status, context)
+    exclude = repodir / ".git" / "info" / "exclude"
+    original_exclude = exclude.bytes() if exclude.exists() else ""
+    excludes = path(tempfile.mkdtemp()) / "ignore"
+    
+    results = main.use_result_cache(max_bytes=1024 * 1024)
+    try:
+        untracked = ["?", "scratch.tmp"]
+        assert main.run_command(status, context).as_list() == [untracked]
+        assert main.run_command(targeted, context).as_list() == [untracked]
+        
+        exclude.write_bytes(original_exclude + "*.tmp\n")
+        assert main.run_command(status, context).as_list() == []
+        assert main.run_command(targeted, context).as_list() == []
+        exclude.write_bytes(original_exclude)
+        assert main.run_command(status, context).as_list() == [untracked]
+        
+        excludes.write_bytes("scratch.*\n")
+        _git("config", "core.excludesFile", excludes)
+        assert main.run_command(status, context).as_list() == []
+        
+        # a .gitignore above the targets counts, though it isn't walked
+        _git("config", "--unset", "core.excludesFile")
+        assert main.run_command(targeted, context).as_list() == [untracked]
+        (repodir / ".gitignore").write_bytes("scratch.tmp\n")
+        assert main.run_command(targeted, context).as_list() == []
+        
+        # failures aren't kept
+        failing = failing_diff(commands.diff(context, []))
+        hits = results.stats()["hits"]
+        assert main.run_command(failing, context).return_code != 0
+        assert main.run_command(failing, context).return_code != 0
+        assert results.stats()["hits"] == hits
+    finally:
+        main.stop_result_cache()
+        exclude.write_bytes(original_exclude)
+        # it may already be unset
+        subprocess.call(["git", "config", "--unset-all", "core.excludesFile"],
+                        cwd=repodir)
+        excludes.dirname().rmtree()
+        for name in ["scratch.tmp", ".gitignore"]:
+            if (repodir / name).exists():
+                (repodir / name).unlink()
+
+def test_working_tree_status_with_result_cache():
+    _backdate("a.txt", "b.bin", ".gitattributes")
+    results = main.use_result_cache(max_bytes=1024 * 1024)
+    try:
+        (repodir / "a.txt").write_bytes("changed for status\n")
+        _backdate("a.txt")
+        assert git.working_tree_status(repodir).as_list() == [["M", "a.txt"]]
+        # the same ":(literal)a.txt" target, but the file is gone
+        (repodir / "a.txt").unlink()
+        assert git.working_tree_status(repodir).as_list() == [["!", "a.txt"]]
+    finally:
+        main.stop_result_cache()
+        _git("reset", "-q", "--hard")
+
+def test_result_cache_skips_moving_revisions():
+    _git("branch", "b", "HEAD~1")
+    results = main.use_result_cache(max_bytes=1024 * 1024)
+    try:
+        cat = git.cat(commands.cat(context, ["-r", "b", "a.txt"]))
+        assert str(main.run_command(cat, context)) == "first version\n"
+        _git("update-ref", "refs/heads/b", "HEAD")
+        assert str(main.run_command(cat, context)) == "second version\n"
+        
+        head = subprocess.Popen(["git", "rev-parse", "HEAD"], cwd=repodir,
+            stdout=subprocess.PIPE).communicate()[0].strip()
+        cat = git.cat(commands.cat(context, ["-r", head, "a.txt"]))
+        main.run_command(cat, context)
+        hits = results.stats()["hits"]
+        assert str(main.run_command(cat, context)) == "second version\n"
+        assert results.stats()["hits"] == hits + 1
+    finally:
+        main.stop_result_cache()
+        _git("branch", "-D", "b")
+
+def test_attr_command():
+    generic_attr = commands.attr(context, ["-a", "text", "-a", "binary",
+                                           "a.txt", "b.bin"])
+    attr = git.attr(generic_attr)
+    assert attr.get_command_line() == ["git", "check-attr", "text", 
+        "binary", "--", "a.txt", "b.bin"]
+    output = main.run_command(attr, context)
+    assert output.as_dict() == {
+        "a.txt": dict(text="set", binary="unspecified"),
+        "b.bin": dict(text="unset", binary="set")
+    }
+    assert str(output) == "a.txt: text: set\na.txt: binary: unspecified\n" \
+        "b.bin: text: unset\nb.bin: binary: set\n"
+
+def test_helper_pool_reuses_and_evicts():
+    pool = gitbatch.HelperPool(max_size=1)
+    try:
+        pool.cat_file(repodir, ["HEAD:./a.txt"])
+        helper = pool.helpers.values()[0]
+        pool.cat_file(repodir, ["HEAD:./b.bin"])
+        assert pool.helpers.values() == [helper]
+        
+        pool.check_attr(repodir, ["text"], ["a.txt"])
+        assert len(pool.helpers) == 1
+        assert not helper.alive
+        
+        # a helper that died is replaced
+        new_helper = pool.helpers.values()[0]
+        new_helper.close()
+        assert pool.check_attr(repodir, ["text"], ["a.txt"]) == \
+            [dict(text="set")]
+    finally:
+        pool.close()
+
+def test_helper_pool_keeps_claimed_helpers():
+    pool = gitbatch.HelperPool(max_size=1, idle_timeout=0)
+    try:
+        key = ("cat-file", repodir)
+        helper = pool.get(key, lambda: gitbatch.CatFile(repodir))
+        # neither idle eviction nor the size limit can stop a helper
+        # that has been claimed and not yet released
+        time.sleep(0.01)
+        pool.check_attr(repodir, ["text"], ["a.txt"])
+        assert helper.alive
+        assert helper.request(["HEAD:./a.txt"]) == ["second version\n"]
+        pool.release(helper)
+        pool.check_attr(repodir, ["text"], ["a.txt"])
+        assert not helper.alive
+    finally:
+        pool.close()
+
+def test_helper_pool_from_many_threads():
+    pool = gitbatch.HelperPool(max_size=1, idle_timeout=0)
+    failures = []
+    def worker():
+        try:
+            for i in range(20):
+                assert pool.cat_file(repodir, ["HEAD:./a.txt"]) == \
+                    ["second version\n"]
+                assert pool.check_attr(repodir, ["text"], ["a.txt"]) == \
+                    [dict(text="set")]
+        except Exception, e:
+            failures.append(e)
+    threads = [threading.Thread(target=worker) for i in range(8)]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        pool.close()
+    assert not failures, failures
+
+def test_module_globals_are_not_commands():
+    try:
+        main.get_dialect("git").get_dialect_command_class("log")
+        assert False, "expected GitError for log"
+    except git.GitError:
+        pass
+
+def test_cat_in_other_dialects():
+    generic_cat = commands.cat(context, ["-r", "5", "a.txt"])
+    assert str(generic_cat) == "cat -r 5 a.txt"
+    hg_cat = main.get_dialect("hg").convert(generic_cat)
+    assert hg_cat.get_command_line() == ["hg", "cat", "-r", "5", "a.txt"]
+
+def test_clone_command_conversion():
+    generic_clone = commands.clone(context, ["git://example.com/bar.git"])
+    result = main.get_dialect("git").convert(generic_clone)
+    assert result.get_command_line() == ["git", "clone", 
+                                         "git://example.com/bar.git", "bar"]
+
+def test_many_targets():
+    names = ["many/%s-%s.txt" % ("x" * 40, i) for i in range(300)]
+    (repodir / "many").makedirs()
+    for name in names:
+        (repodir / name).write_text("x\n")
+    original = util.max_command_line
+    util.max_command_line = 4096
+    try:
+        add = git.add(commands.add(context, names))
+        assert util.command_line_size(add.get_command_line()) > 4096
+        output = main.run_command(add, context)
+        assert output.return_code == 0, str(output)
+        
+        # status can't read a file of targets, so it is run in batches
+        status = git.status(commands.status(context, names))
+        output = main.run_command(status, context)
+        assert sorted(output.added()) == sorted(names)
+    finally:
+        util.max_command_line = original
+        _git("rm", "-q", "-r", "--cached", "--ignore-unmatch", "many")
+        (repodir / "many").rmtree()
+
+def _targets_files():
+    return set(name for name in os.listdir(tempfile.gettempdir())
+               if name.startswith("uvc-targets-"))
+
+def test_many_targets_streamed():
+    # the same file over and over makes a long enough command line
+    names = ["a.txt"] * 400
+    before = _targets_files()
+    original = util.max_command_line
+    original_stream = main.CommandStream
+    util.max_command_line = 4096
+    try:
+        # the file of targets is removed if the stream is closed early
+        add = git.add(commands.add(context, names))
+        output = main.run_command(add, context, stream=True)
+        assert _targets_files() != before
+        output.close()
+        assert _targets_files() == before
+        
+        # and if the command can't be started
+        def broken(*args, **kw):
+            raise OSError(errno.ENOENT, "No such file or directory")
+        main.CommandStream = broken
+        try:
+            main.run_command(add, context, stream=True)
+            assert False, "Expected OSError"
+        except OSError:
+            pass
+        assert _targets_files() == before
+    finally:
+        util.max_command_line = original
+        main.CommandStream = original_stream
+    
+    # status can't read its targets from a file, and a stream can't be
+    # put together from several runs
+    names = ["a.txt"] * (os.sysconf("SC_ARG_MAX") // 10)
+    status = git.status(commands.status(context, names))
+    try:
+        main.run_command(status, context, stream=True)
+        assert False, "Expected CommandLineTooLong"
+    except exc.CommandLineTooLong:
+        pass
+
+def test_pending_commands_started_like_run_command():
+    names = ["a.txt"] * 400
+    before = _targets_files()
+    original = util.max_command_line
+    util.max_command_line = 4096
+    try:
+        # too many targets for the command line go in a file
+        add = main.start_command(git.add(commands.add(context, names)),
+                                 context)
+        assert _targets_files() != before
+        assert not main.wait_for_commands([add], timeout=60)
+        assert add.result().return_code == 0
+        assert _targets_files() == before
+    finally:
+        util.max_command_line = original
+    
+    # cat is run by gitbatch rather than spawned
+    cat = main.start_command(git.cat(commands.cat(context, ["a.txt"])),
+                             context)
+    assert cat.stream is None
+    assert not main.wait_for_commands([cat], timeout=60)
+    assert str(cat.result()) == "second version\n"
+
+def test_index_reader():
+    root = path(tempfile.mkdtemp()).realpath()
+    def run_git(*args):
+        return subprocess.Popen(["git", "-c", "user.name=uvc", 
+                                 "-c", "user.email=uvc@example.com"] + 
+                                list(args), cwd=root, 
+                                stdout=subprocess.PIPE).communicate()[0]
+    try:
+        names = ["a.txt", "dir/b.txt", "dir/sub/c.txt", "star*.txt", 
+                 "dir/sub/d-with-a-longer-name.txt"]
+        for name in names:
+            if not (root / name).parent.exists():
+                (root / name).parent.makedirs()
+            (root / name).write_text("first\n")
+        run_git("init", "-q")
+        run_git("add", ".")
+        run_git("commit", "-q", "-m", "first")
+        then = time.time() - 60
+        for name in names:
+            os.utime(root / name, (then, then))
+        
+        for version in ["2", "3", "4"]:
+            run_git("update-index", "--index-version", version)
+            # git only keeps version 3 for entries with extended flags
+            if version == "3":
+                run_git("update-index", "--skip-worktree", "a.txt")
+            else:
+                run_git("update-index", "--no-skip-worktree", "a.txt")
+            # rewrite the index after backdating, so nothing is racy
+            run_git("update-index", "--really-refresh")
+            index = git.GitIndex(root / "dir")
+            try:
+                assert index.root == root
+                assert index.version == int(version)
+                entries = list(index.entries())
+            finally:
+                index.close()
+            assert [entry.path for entry in entries] == \
+                run_git("ls-files", "-z").split("\0")[:-1]
+            assert git.changed_candidates(root) == []
+            assert git.working_tree_status(root).as_list() == []
+            
+        (root / "dir" / "b.txt").write_text("second\n")
+        (root / "star*.txt").unlink()
+        (root / "untracked.txt").write_text("new\n")
+        assert git.changed_candidates(root) == ["dir/b.txt", "star*.txt"]
+        assert git.working_tree_status(root / "dir").as_list() == [
+            ["M", "dir/b.txt"], ["!", "star*.txt"]]
+        
+        (root / ".git" / "index").write_bytes("DIRC\0\0\0\x09\0\0\0\0")
+        try:
+            git.changed_candidates(root)
+            assert False, "expected GitIndexError"
+        except git.GitIndexError:
+            pass
+        
+        # without an index, everything git tracked is being removed
+        (root / ".git" / "index").unlink()
+        assert len(list(git.working_tree_status(root).removed())) == \
+            len(names)
+    finally:
+        root.rmtree()
+
+def test_split_index_is_refused():
+    root = path(tempfile.mkdtemp()).realpath()
+    def run_git(*args):
+        subprocess.check_call(["git", "-c", "user.name=uvc", 
+                               "-c", "user.email=uvc@example.com"] + 
+                              list(args), cwd=root, stdout=subprocess.PIPE)
+    try:
+        for name in ["a.txt", "b.txt", "c.txt"]:
+            (root / name).write_text("first\n")
+        run_git("init", "-q")
+        run_git("add", ".")
+        run_git("commit", "-q", "-m", "first")
+        run_git("update-index", "--split-index")
+        for function in [git.tracked_files, git.changed_candidates]:
+            try:
+                function(root)
+                assert False, "expected GitIndexError"
+            except git.GitIndexError:
+                pass
+        (root / "b.txt").write_text("second\n")
+        assert git.working_tree_status(root).as_list() == [["M", "b.txt"]]
+    finally:
+        root.rmtree()
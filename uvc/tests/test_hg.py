@@ -42,6 +42,13 @@ def test_convert_unknown_command():
         assert False, "expected HgError for unknown command"
     except hg.HgError:
         pass
+    
+    # module globals that aren't commands aren't found either
+    try:
+        dialect.get_dialect_command_class("log")
+        assert False, "expected HgError for log"
+    except hg.HgError:
+        pass
 
 def test_commit_command():
     test_context.user = "Zaphod Beeblebrox <zaphod@onecooldude.us>"
@@ -143,7 +150,7 @@ def test_status_command():
     assert not status.writes_remote
     assert not status.reads_remote
     
-    assert status.get_command_line() == ["hg", "status"]
+    assert status.get_command_line() == ["hg", "status", "-0"]
     
     status_output = """M modified/file
 A new/file
@@ -154,7 +161,8 @@ C clean/file
 I ignored/file
 """
     
-    output = status.process_output(0, StringIO(status_output))
+    output = status.process_output(0, 
+                            StringIO(status_output.replace("\n", "\0")))
     the_list = output.as_list()
     print the_list
     assert the_list == [
@@ -168,6 +176,9 @@ I ignored/file
 ]
     assert str(output) == status_output
     
+    output = status.process_output(0, StringIO("M a\nfile\0? with space\0"))
+    assert output.as_list() == [["M", "a\nfile"], ["?", "with space"]]
+    
 @patch("uvc.main.infer_dialect")
 def test_init_command(infer_dialect):
     infer_dialect.return_value = None
@@ -0,0 +1,236 @@
+import os
+import sys
+import time
+
+from uvc.path import path
+from uvc import commands, main, hg, hgserver, exc
+from uvc.tests.mock import patch
+
+topdir = path(__file__).dirname().abspath() / ".." / ".." / "testfiles"
+
+# speaks just enough of the command server protocol for these tests
+fake_server = '''
+import os, struct, sys, time
+def send(channel, data):
+    sys.stdout.write(struct.pack(">cI", channel, len(data)) + data)
+    sys.stdout.flush()
+send("o", "capabilities: getencoding runcommand\\nencoding: UTF-8")
+while True:
+    line = sys.stdin.readline()
+    if not line:
+        break
+    length = struct.unpack(">I", sys.stdin.read(4))[0]
+    args = sys.stdin.read(length).split("\\0")
+    if args[0] == "die":
+        sys.exit(1)
+    if args[0] == "hang":
+        send("o", "started\\n")
+        time.sleep(60)
+    send("o", "%s %s\\n" % (os.getpid(), " ".join(args)))
+    send("e", "cwd %s\\n" % os.getcwd())
+    send("r", struct.pack(">i", len(args)))
+'''
+
+fake_command_line = [sys.executable, "-c", fake_server]
+
+# says hello, then dies once it has read a command
+dying_server = '''
+import struct, sys
+sys.stdout.write(struct.pack(">cI", "o", 10) + "runcommand")
+sys.stdout.flush()
+sys.stdin.readline()
+length = struct.unpack(">I", sys.stdin.read(4))[0]
+sys.stdin.read(length)
+sys.exit(1)
+'''
+
+context = None
+
+def setup_module(module):
+    global context
+    if not topdir.exists():
+        topdir.mkdir()
+    context = main.Context(topdir)
+
+def test_command_server_runs_commands():
+    server = hgserver.CommandServer(topdir, fake_command_line)
+    try:
+        returncode, output = server.run(["status", "foo"])
+        assert returncode == 2
+        ran, cwd = output.splitlines()
+        pid, args = ran.split(" ", 1)
+        assert args == "status foo"
+        assert cwd == "cwd %s" % topdir.realpath()
+        
+        returncode, output = server.run(["diff"])
+        assert returncode == 1
+        assert output.startswith("%s diff\n" % pid)
+    finally:
+        server.close()
+    assert not server.alive
+
+def test_command_server_timeout():
+    server = hgserver.CommandServer(topdir, fake_command_line)
+    try:
+        server.run(["hang"], timeout=0.2)
+        assert False, "Expected CommandTimeout"
+    except exc.CommandTimeout, e:
+        assert e.output == "started\n"
+    assert not server.alive
+
+def test_pool_reuses_and_replaces_servers():
+    pool = hgserver.CommandServerPool(command_line=fake_command_line)
+    try:
+        first = pool.run(topdir, ["status"])[1].split()[0]
+        second = pool.run(topdir, ["status"])[1].split()[0]
+        assert first == second
+        
+        try:
+            pool.run(topdir, ["die"])
+            assert False, "Expected CommandServerError"
+        except hgserver.CommandServerError:
+            pass
+        
+        third = pool.run(topdir, ["status"])[1].split()[0]
+        assert third != first
+    finally:
+        pool.close()
+
+def test_pool_evicts_idle_servers():
+    pool = hgserver.CommandServerPool(idle_timeout=0.1, 
+                                      command_line=fake_command_line)
+    other_dir = topdir / "hgserver_other"
+    if not other_dir.exists():
+        other_dir.mkdir()
+    try:
+        pool.run(topdir, ["status"])
+        server = pool.servers[topdir.realpath()]
+        time.sleep(0.2)
+        pool.run(other_dir, ["status"])
+        assert not server.alive
+        assert pool.servers.keys() == [other_dir.realpath()]
+    finally:
+        pool.close()
+        other_dir.rmdir()
+
+def test_pool_limits_server_count():
+    pool = hgserver.CommandServerPool(max_servers=1,
+                                      command_line=fake_command_line)
+    other_dir = topdir / "hgserver_other"
+    if not other_dir.exists():
+        other_dir.mkdir()
+    try:
+        pool.run(topdir, ["status"])
+        pool.run(other_dir, ["status"])
+        assert pool.servers.keys() == [other_dir.realpath()]
+    finally:
+        pool.close()
+        other_dir.rmdir()
+
+class _HookedLock(object):
+    """Runs hook (once) just after the lock is first released."""
+    
+    def __init__(self, lock, hook):
+        self.lock = lock
+        self.hook = hook
+    
+    def __enter__(self):
+        self.lock.acquire()
+    
+    def __exit__(self, *args):
+        self.lock.release()
+        hook, self.hook = self.hook, None
+        if hook is not None:
+            hook()
+
+def test_pool_does_not_evict_claimed_servers():
+    pool = hgserver.CommandServerPool(max_servers=1,
+                                      command_line=fake_command_line)
+    other_dir = topdir / "hgserver_other"
+    if not other_dir.exists():
+        other_dir.mkdir()
+    try:
+        pool.run(topdir, ["status"])
+        server = pool.servers[topdir.realpath()]
+        # another thread's run makes room for its own server just as
+        # this one has looked its server up
+        pool.lock = _HookedLock(pool.lock, 
+                                lambda: pool.run(other_dir, ["status"]))
+        returncode, output = pool.run(topdir, ["status"])
+        assert returncode == 1
+        assert output.startswith("%s status\n" % server.process.pid)
+    finally:
+        pool.close()
+        other_dir.rmdir()
+
+def test_local_hg_commands_use_the_server():
+    hg.command_server_pool = hgserver.CommandServerPool(
+        command_line=fake_command_line)
+    try:
+        status = hg.status(commands.status(context, []))
+        output = main.run_command(status, context)
+        assert output.as_list() == []
+        diff = hg.diff(commands.diff(context, []))
+        output = main.run_command(diff, context)
+        assert output.return_code == 1
+        assert str(output).split("\n")[0].endswith(" diff")
+        
+        # and so do the ones started without waiting
+        pending = main.start_command(diff, context)
+        assert pending.stream is None
+        assert not main.wait_for_commands([pending], timeout=30)
+        assert str(pending.result()).split("\n")[0].endswith(" diff")
+    finally:
+        hg.stop_command_server()
+
+@patch("uvc.util.execute")
+def test_falls_back_to_spawning(rid):
+    rid.return_value = [0, commands.StringIO("spawned"), None]
+    hg.command_server_pool = hgserver.CommandServerPool(
+        command_line=[sys.executable, "-c", "pass"])
+    try:
+        diff = hg.diff(commands.diff(context, []))
+        output = main.run_command(diff, context)
+        assert str(output) == "spawned"
+        assert rid.called
+        
+        # remote commands are always spawned
+        rid.reset_mock()
+        update = hg.update(commands.update(context, []))
+        main.run_command(update, context)
+        assert rid.called
+    finally:
+        hg.stop_command_server()
+
+@patch("uvc.util.execute")
+def test_changes_are_not_run_twice(rid):
+    rid.return_value = [0, commands.StringIO("spawned"), None]
+    hg.command_server_pool = hgserver.CommandServerPool(
+        command_line=[sys.executable, "-c", dying_server])
+    try:
+        # the server may have committed before it died
+        commit = hg.commit(commands.commit(context, ["-m", "message"]))
+        try:
+            main.run_command(commit, context)
+            assert False, "Expected CommandServerError"
+        except hgserver.CommandServerError, e:
+            assert not isinstance(e, hgserver.CommandServerUnavailable)
+        assert not rid.called
+        
+        # reading again is harmless
+        diff = hg.diff(commands.diff(context, []))
+        assert str(main.run_command(diff, context)) == "spawned"
+        assert rid.called
+    finally:
+        hg.stop_command_server()
+    
+    # a server that never got the command can't have run it
+    rid.reset_mock()
+    hg.command_server_pool = hgserver.CommandServerPool(
+        command_line=[sys.executable, "-c", "pass"])
+    try:
+        commit = hg.commit(commands.commit(context, ["-m", "message"]))
+        main.run_command(commit, context)
+        assert rid.called
+    finally:
+        hg.stop_command_server()
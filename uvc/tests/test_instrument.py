@@ -0,0 +1,54 @@
+import logging
+
+from uvc import instrument, main
+from uvc.tests.util import test_context
+from uvc.tests.test_util import fake_status
+
+def test_spans_cost_nothing_without_collectors():
+    assert not instrument.collectors
+    assert instrument.span("anything") is instrument.span("else")
+
+def test_callback_collector_sees_pipeline_phases():
+    seen = []
+    collector = instrument.CallbackCollector(
+        lambda name, seconds: seen.append(name))
+    instrument.add_collector(collector)
+    try:
+        command = main.convert(test_context, ["hg", "status"])
+        main.run_command(fake_status(command.generic), test_context)
+    finally:
+        instrument.remove_collector(collector)
+    assert seen == ["convert", "execute", "process_output"]
+
+def test_histogram_collector():
+    collector = instrument.HistogramCollector()
+    for i in range(1, 101):
+        collector.record("phase", i / 1000.0)
+    summary = collector.summary()["phase"]
+    assert summary["count"] == 100
+    assert summary["min"] == 0.001
+    assert summary["max"] == 0.1
+    assert abs(summary["total"] - 5.05) < 1e-9
+    # accurate to within one bucket (a factor of 2 ** 0.25)
+    assert 0.05 <= summary["p50"] <= 0.05 * 2 ** 0.25
+    assert 0.099 <= summary["p99"] <= 0.1
+    collector.reset()
+    assert collector.summary() == {}
+
+def test_logging_collector():
+    records = []
+    class Handler(logging.Handler):
+        def emit(self, record):
+            records.append(record.getMessage())
+    logger = logging.getLogger("uvc.tests.instrument")
+    logger.addHandler(Handler())
+    logger.setLevel(logging.DEBUG)
+    collector = instrument.LoggingCollector(logger)
+    instrument.add_collector(collector)
+    try:
+        with instrument.span("phase"):
+            pass
+    finally:
+        instrument.remove_collector(collector)
+    assert len(records) == 1
+    assert records[0].startswith("phase took ")
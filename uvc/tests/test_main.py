@@ -1,6 +1,9 @@
 import os
+import tempfile
 
-from uvc import main, hg, commands, svn, git
+from uvc import main, hg, commands, svn, git, exc
+from uvc.path import path
+from uvc.tests.util import mock_run_command
 
 topdir = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", 
                         "testfiles"))
@@ -56,3 +59,146 @@ def test_get_command_class():
     result = main.get_command_class(context,
                 ["checkout", "http://foo/bar"], dialect=main.get_dialect('svn'))
     assert result == svn.clone
+
+def _make_working_copies():
+    # outside of uvc's own checkout, so that there is no repository
+    # above these
+    manydir = path(tempfile.mkdtemp()).realpath()
+    for i, marker in enumerate([".hg", ".git", ".svn", None] * 5):
+        working_dir = manydir / ("wc%s" % i)
+        working_dir.makedirs()
+        if marker:
+            (working_dir / marker).mkdir()
+        (working_dir / "sub" / "deeper").makedirs()
+    return manydir
+
+def test_infer_dialects_matches_infer_dialect():
+    manydir = _make_working_copies()
+    try:
+        directories = [d for d in manydir.walkdirs() 
+                       if not d.name.startswith(".")]
+        result = main.infer_dialects(directories)
+        assert len(result) == len(directories)
+        for directory in directories:
+            assert result[directory] == main.infer_dialect(directory), \
+                directory
+        assert result[manydir / "wc0" / "sub"].name == "hg"
+        assert result[manydir / "wc2" / "sub"] is None
+        assert result[manydir / "wc2"].name == "svn"
+    finally:
+        manydir.rmtree()
+
+def test_find_repository_is_cached_until_marker_goes_away():
+    manydir = _make_working_copies()
+    try:
+        wc = manydir / "wc1"
+        deeper = wc / "sub" / "deeper"
+        dialect, root = main.find_repository(deeper)
+        assert dialect.name == "git"
+        assert root == wc
+        
+        hits = main.dialect_cache.hits
+        assert main.find_repository(deeper) == (dialect, root)
+        assert main.dialect_cache.hits == hits + 1
+        
+        # replacing the repository with one of another kind is noticed
+        (wc / ".git").rmdir()
+        (wc / ".hg").mkdir()
+        assert main.infer_dialect(deeper).name == "hg"
+        
+        (wc / ".hg").rmdir()
+        assert main.infer_dialect(deeper) is None
+    finally:
+        manydir.rmtree()
+
+def test_forget_repositories():
+    manydir = _make_working_copies()
+    try:
+        sub = manydir / "wc1" / "sub"
+        assert main.infer_dialect(sub).name == "git"
+        assert main.infer_dialect(sub / "deeper").name == "git"
+        # a repository nested inside of a cached one is only seen once
+        # the cache is told about it
+        (sub / ".hg").mkdir()
+        main.forget_repositories(sub)
+        assert main.infer_dialect(sub / "deeper").name == "hg"
+        assert main.infer_dialect(manydir / "wc1").name == "git"
+    finally:
+        manydir.rmtree()
+
+# "M foo" in the status format of each VCS
+@mock_run_command(dict(
+    hg="M foo\0",
+    git="1 .M N... 100644 100644 100644 %s %s foo\0" % ("0" * 40, "0" * 40),
+    svn='<?xml version="1.0"?><status><target path=".">'
+        '<entry path="foo"><wc-status item="modified" props="none"/>'
+        '</entry></target></status>'))
+def test_run_many(run_command_params):
+    manydir = _make_working_copies()
+    try:
+        contexts = [main.Context(manydir / ("wc%s" % i)) for i in range(20)]
+        results = list(main.run_many(contexts, ["status"], concurrency=4))
+        assert len(results) == 20
+        assert set(result[0] for result in results) == set(contexts)
+        for context, output, error in results:
+            index = contexts.index(context)
+            if index % 4 == 3:
+                # no repository there
+                assert output is None
+                assert isinstance(error, exc.UVCError)
+            else:
+                assert error is None
+                assert output.as_list() == [["M", "foo"]]
+        dialect_names = set(command.dialect_name 
+                            for command in run_command_params[::2])
+        assert dialect_names == set(["hg", "git", "svn"])
+    finally:
+        manydir.rmtree()
+
+def test_discover_repositories():
+    manydir = _make_working_copies()
+    try:
+        # a subrepository, and a directory that looks like a nested
+        # working copy inside of a Subversion one
+        (manydir / "wc0" / "sub" / ".git").mkdir()
+        (manydir / "wc2" / "sub" / ".hg").mkdir()
+        
+        found = main.discover_repositories(manydir, concurrency=3)
+        assert len(found) == 15
+        for i in range(20):
+            working_dir = manydir / ("wc%s" % i)
+            assert found.get(working_dir) == main.infer_dialect(working_dir)
+        
+        found = main.discover_repositories(manydir, nested=True)
+        assert len(found) == 16
+        assert found[manydir / "wc0" / "sub"].name == "git"
+        
+        assert main.discover_repositories(manydir / "wc1" / "sub") == {}
+        assert main.discover_repositories(manydir / "wc2") == \
+            {manydir / "wc2": main.get_dialect("svn")}
+        
+        filename = manydir / "repositories.json"
+        main.save_repositories(found, filename)
+        assert main.load_repositories(filename) == found
+    finally:
+        manydir.rmtree()
+
+def test_target_paths_for_fingerprints():
+    git_dialect = main.get_dialect("git")
+    hg_dialect = main.get_dialect("hg")
+    root = "/wc"
+    working_dir = "/wc/sub"
+    assert main._target_path(git_dialect, root, working_dir, 
+                             ":(literal)a*.txt") == "/wc/sub/a*.txt"
+    assert main._target_path(git_dialect, root, working_dir, 
+                             ":(top,literal)a.txt") == "/wc/a.txt"
+    assert main._target_path(git_dialect, root, working_dir, 
+                             ":(glob)**/a.txt") is None
+    assert main._target_path(hg_dialect, root, working_dir, 
+                             "path:sub/a.txt") == "/wc/sub/a.txt"
+    assert main._target_path(hg_dialect, root, working_dir, 
+                             "relpath:a.txt") == "/wc/sub/a.txt"
+    assert main._target_path(hg_dialect, root, working_dir, 
+                             "glob:*.txt") is None
+    assert main._target_path(hg_dialect, root, working_dir, 
+                             "a.txt") == "/wc/sub/a.txt"
@@ -1,4 +1,8 @@
 import os
+import shutil
+import tempfile
+import sqlite3
+import threading
 from cStringIO import StringIO
 
 from uvc.path import path
@@ -43,11 +47,30 @@ def test_convert_unknown_command():
         assert False, "expected SVNError for unknown command"
     except svn.SVNError:
         pass
+    
+    # module globals that aren't commands aren't found either
+    try:
+        dialect.get_dialect_command_class("log")
+        assert False, "expected SVNError for log"
+    except svn.SVNError:
+        pass
+
+def test_cat_with_revision_reads_remote():
+    cat = dialect.convert(commands.cat(test_context, ["foo"]))
+    assert not cat.reads_remote
+    assert main.get_timeout(cat) == main.local_timeout
+    cat = dialect.convert(commands.cat(test_context, ["-r", "HEAD", "foo"]))
+    assert cat.reads_remote
+    assert main.get_timeout(cat) == main.remote_timeout
+
+def _clear_commit_journal():
+    working_dir = path(test_context.working_dir)
+    for name in [".svn_commit_journal", ".svn_commit_messages"]:
+        if (working_dir / name).exists():
+            (working_dir / name).unlink()
 
 def test_commit_command():
-    commit_file = path(test_context.working_dir) / ".svn_commit_messages"
-    if commit_file.exists():
-        commit_file.unlink()
+    _clear_commit_journal()
     
     generic_commit = commands.commit(test_context, 
                 ["-m", "test message", "foo", "bar"])
@@ -55,23 +78,41 @@ def test_commit_command():
     assert result.get_command_line() == None
     assert str(result.get_output()) == "Commit message saved. Don't forget to push to save to the remote repository!"
     
-    assert commit_file.exists(), "Expected commit file at " + commit_file
-    assert commit_file.text() == "test message\n\n"
+    journal = svn.get_commit_journal(test_context.working_dir)
+    assert journal.exists(), "Expected commit journal at " + journal.filename
+    records, (inode, size, offset) = journal.read()
+    assert len(records) == 1
+    assert records[0]["message"] == "test message"
+    assert records[0]["targets"] == ["foo", "bar"]
+    assert records[0]["time"] > 0
+    assert offset == os.path.getsize(journal.filename)
     
+def test_commit_records_context_user():
+    _clear_commit_journal()
+    original = test_context.user
+    test_context.user = "someone@example.com"
+    try:
+        generic_commit = commands.commit(test_context, ["-m", "message"])
+        dialect.convert(generic_commit).get_output()
+    finally:
+        test_context.user = original
+    records, position = svn.get_commit_journal(test_context.working_dir).read()
+    assert records[0]["user"] == "someone@example.com"
+    _clear_commit_journal()
+
 def test_push_command_before_commit():
-    commit_file = path(test_context.working_dir) / ".svn_commit_messages"
-    if commit_file.exists():
-        commit_file.unlink()
+    _clear_commit_journal()
     
     generic_push = commands.push(test_context, [])
     result = dialect.convert(generic_push)
     assert result.get_command_line() == None
     assert str(result.get_output()) == "Nothing to push. Run commit first."
-    
+
 def test_push_after_commit():
-    commit_file = path(test_context.working_dir) / ".svn_commit_messages"
-    if commit_file.exists():
-        commit_file.unlink()
+    _clear_commit_journal()
+    # left behind by an older uvc
+    (path(test_context.working_dir) / ".svn_commit_messages").write_text(
+        "old message\n\n")
     
     generic_commit = commands.commit(test_context, 
                 ["-m", "test message1", "foo", "bar"])
@@ -86,8 +127,150 @@ def test_push_after_commit():
     generic_push = commands.push(test_context, [])
     result = dialect.convert(generic_push)
     assert result.get_command_line() == ["svn", "commit", "-m", 
-        "test message1\n\ntest message2\n\n"]
+        "old message\n\ntest message1\n\ntest message2\n\n"]
+    
+    # a commit made while the push runs is kept for the next one
+    generic_commit = commands.commit(test_context, 
+                ["-m", "test message3", "foo"])
+    dialect.convert(generic_commit).get_output()
+    result.command_successful()
+    
+    assert not (path(test_context.working_dir) / 
+                ".svn_commit_messages").exists()
+    journal = svn.get_commit_journal(test_context.working_dir)
+    records, position = journal.read()
+    assert [record["message"] for record in records] == ["test message3"]
+    
+    generic_push = commands.push(test_context, [])
+    result = dialect.convert(generic_push)
+    assert result.get_command_line()[-1] == "test message3\n\n"
+    result.command_successful()
+    assert not journal.exists()
+    _clear_commit_journal()
+
+def _append_commits(filename, writer, count):
+    journal = svn.CommitJournal(filename)
+    for i in range(count):
+        journal.append(dict(message="%s %s" % (writer, i)))
+
+def test_commit_journal_concurrent_appends():
+    filename = path(tempfile.mkdtemp()) / "journal"
+    try:
+        pids = []
+        for i in range(4):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    _append_commits(filename, "process %s" % i, 50)
+                finally:
+                    os._exit(0)
+            pids.append(pid)
+        threads = [threading.Thread(target=_append_commits, 
+                                    args=(filename, "thread %s" % i, 50))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for pid in pids:
+            os.waitpid(pid, 0)
+        
+        # a torn record, as if a writer crashed
+        with open(filename, "ab") as stream:
+            stream.write('{"message": "half')
+        records, (inode, size, offset) = \
+            svn.CommitJournal(filename).read()
+        assert len(records) == 400, len(records)
+        assert len(set(record["message"] for record in records)) == 400
+        assert offset == os.path.getsize(filename) - len('{"message": "half')
+    finally:
+        shutil.rmtree(filename.dirname())
+
+def test_commit_journal_after_torn_record():
+    filename = path(tempfile.mkdtemp()) / "journal"
+    try:
+        _append_commits(filename, "before", 1)
+        with open(filename, "ab") as stream:
+            stream.write('{"message": "half')
+        _append_commits(filename, "after", 1)
+        records, position = svn.CommitJournal(filename).read()
+        assert [record["message"] for record in records] == \
+            ["before 0", "after 0"]
+        assert position[2] == os.path.getsize(filename)
+    finally:
+        shutil.rmtree(filename.dirname())
+
+def test_commit_journal_interleaved_pushes():
+    filename = path(tempfile.mkdtemp()) / "journal"
+    try:
+        journal = svn.CommitJournal(filename)
+        _append_commits(filename, "first", 2)
+        first_records, first_position = journal.read()
+        _append_commits(filename, "second", 1)
+        second_records, second_position = journal.read()
+        _append_commits(filename, "third", 1)
+        
+        # the second push finishes first and keeps the third commit;
+        # the first push mustn't then throw the third commit away
+        journal.discard_through(second_position)
+        journal.discard_through(first_position)
+        records, position = journal.read()
+        assert [record["message"] for record in records] == ["third 0"]
+        
+        # nor a journal made after the one it read was removed
+        journal.discard_through(position)
+        _append_commits(filename, "fourth", 1)
+        journal.discard_through(first_position)
+        records, position = journal.read()
+        assert [record["message"] for record in records] == ["fourth 0"]
+    finally:
+        shutil.rmtree(filename.dirname())
+
+svn_status_xml = """<?xml version="1.0" encoding="UTF-8"?>
+<status>
+<target path=".">
+<entry path="modified">
+<wc-status props="none" item="modified" revision="3">
+<commit revision="2"><author>someone</author></commit>
+</wc-status>
+</entry>
+<entry path="only &amp; props">
+<wc-status props="modified" item="normal" revision="3"></wc-status>
+</entry>
+<entry path="new">
+<wc-status props="none" item="added" revision="-1"></wc-status>
+</entry>
+<entry path="gone">
+<wc-status props="none" item="missing" revision="3"></wc-status>
+</entry>
+<entry path="caf\xc3\xa9">
+<wc-status props="none" item="unversioned"></wc-status>
+</entry>
+<entry path="external">
+<wc-status props="none" item="external"></wc-status>
+</entry>
+</target>
+</status>
+"""
+
+def test_status_command():
+    status = svn.status(commands.status(context, []))
+    assert status.get_command_line() == ["svn", "status", "--xml"]
+    output = status.process_output(0, StringIO(svn_status_xml))
+    assert output.as_list() == [
+        [StatusOutput.MODIFIED, "modified"],
+        [StatusOutput.MODIFIED, "only & props"],
+        [StatusOutput.ADDED, "new"],
+        [StatusOutput.MISSING, "gone"],
+        [StatusOutput.UNKNOWN, "caf\xc3\xa9"]]
     
+    # an error part way through ends the output
+    broken = svn_status_xml.replace("<entry path=\"gone\">", 
+                                    "svn: E155010: oops\n")
+    output = status.process_output(1, StringIO(broken))
+    assert len(output) == 3
+    assert len(status.process_output(1, StringIO(""))) == 0
+
 def test_diff_command():
     generic_diff = commands.diff(context, [])
     result = dialect.convert(generic_diff)
@@ -97,34 +280,155 @@ def test_diff_command():
 def test_add_all_files(rid):
     generic_add = commands.add(test_context, [])
     result = dialect.convert(generic_add)
-    stdout = StringIO("""A      foo.txt
-?      bar.txt
-A      baz.txt
-""")
-    rid.return_value = [0, stdout]
-    assert result.get_command_line() == ["svn", "add", "bar.txt"]
-    assert rid.called
-    
-def test_revert_all_files():
-    testfile = topdir / "foo.txt"
-    testfile.write_text("Test text")
+    command_line = result.get_command_line()
+    assert command_line[:5] == ["svn", "add", "--force", "--depth", 
+                                "infinity"]
+    assert command_line[-1] == "."
+    ignores = command_line[-2]
+    assert ignores.startswith("config:miscellany:global-ignores=")
+    assert ".*" in ignores.split("=", 1)[1].split()
+    # no separate svn status
+    assert not rid.called
+
+def test_add_all_files_keeps_configured_ignores():
+    directory = path(tempfile.mkdtemp())
+    original = svn.config_files
     try:
-        generic_revert = commands.revert(context, [])
-        result = dialect.convert(generic_revert)
-        assert result.get_command_line() == ["svn", "revert", "-R", "foo.txt"]
+        svn.config_files = [directory / "system", directory / "user"]
+        generic_add = commands.add(test_context, [])
+        assert dialect.convert(generic_add).get_command_line()[-2] == \
+            "config:miscellany:global-ignores=" + \
+            svn._default_global_ignores + " .*"
+        
+        (directory / "system").write_text(
+            "[miscellany]\nglobal-ignores = *.o\n")
+        (directory / "user").write_text(
+            "[auth]\npassword-stores =\n\n"
+            "[miscellany]\nglobal-ignores = *.bak build\n  *.tmp\n")
+        assert dialect.convert(generic_add).get_command_line()[-2] == \
+            "config:miscellany:global-ignores=*.bak build *.tmp .*"
     finally:
-        testfile.unlink()
+        svn.config_files = original
+        directory.rmtree()
+    
+def test_revert_all_files():
+    generic_revert = commands.revert(context, [])
+    result = dialect.convert(generic_revert)
+    assert result.get_command_line() == ["svn", "revert", "-R", "."]
     
 @patch("uvc.util.run_in_directory")
 def test_resolve_all_files(rid):
-    stdout = StringIO("""A      foo.txt
-C      bar.txt
-A      baz.txt
-""")
-    rid.return_value = [0, stdout]
     generic_resolved = commands.resolved(context, [])
     result = dialect.convert(generic_resolved)
     assert result.get_command_line() == ["svn", "resolve", 
-        "--accept", "working", "bar.txt"]
-    assert rid.called
-    
\ No newline at end of file
+        "--accept", "working", "-R", "."]
+    assert not rid.called
+    
+def _make_wc_db(root, format=31):
+    """Creates a working copy with a wc.db holding the parts of the
+    NODES table that svn.WorkingCopyDB reads."""
+    (root / ".svn").makedirs()
+    (root / "dir").makedirs()
+    connection = sqlite3.connect(root / ".svn" / "wc.db")
+    connection.executescript("""
+        CREATE TABLE nodes (wc_id INTEGER NOT NULL, 
+            local_relpath TEXT NOT NULL, op_depth INTEGER NOT NULL,
+            parent_relpath TEXT, revision INTEGER, presence TEXT NOT NULL,
+            kind TEXT NOT NULL, translated_size INTEGER, 
+            last_mod_time INTEGER,
+            PRIMARY KEY (wc_id, local_relpath, op_depth));
+        PRAGMA user_version = %s;
+        """ % format)
+    def node(relpath, op_depth=0, revision=3, presence="normal", 
+             kind="file", recorded=True):
+        size = mtime = None
+        if recorded and kind == "file":
+            info = os.lstat(root / relpath)
+            size = info.st_size
+            mtime = int(round(info.st_mtime * 1000000))
+        connection.execute("INSERT INTO nodes VALUES (1, ?, ?, ?, ?, ?, "
+                           "?, ?, ?)", (relpath, op_depth, 
+                           os.path.dirname(relpath), revision, presence,
+                           kind, size, mtime))
+    for name in ["a.txt", "b.txt", "dir/c.txt", "new.txt", "gone.txt", 
+                 "unversioned.txt"]:
+        (root / name).write_text("text\n")
+    node("", kind="dir")
+    node("a.txt")
+    node("b.txt")
+    node("dir", kind="dir")
+    node("dir/c.txt")
+    node("new.txt", op_depth=1, revision=None, recorded=False)
+    node("gone.txt")
+    node("gone.txt", op_depth=1, revision=None, presence="base-deleted")
+    node("excluded.txt", presence="not-present", recorded=False)
+    connection.commit()
+    connection.close()
+    (root / "b.txt").write_text("changed\n")
+
+def test_working_copy_db():
+    root = path(tempfile.mkdtemp())
+    try:
+        _make_wc_db(root)
+        assert sorted(svn.versioned_files(root)) == ["a.txt", "b.txt", 
+            "dir/c.txt", "new.txt"]
+        assert svn.versioned_files(root / "dir") == ["c.txt"]
+        assert svn.possibly_modified(root, ["a.txt", "b.txt", "new.txt",
+            "unversioned.txt", "dir/c.txt", "gone.txt"]) == \
+            ["b.txt", "new.txt", "unversioned.txt", "gone.txt"]
+        assert svn.possibly_modified(root / "dir", ["c.txt"]) == []
+        
+        wcdb = svn.WorkingCopyDB(root / "dir")
+        try:
+            assert wcdb.root == root
+            assert wcdb.get_node("a.txt")[:3] == ("a.txt", "file", 3)
+            assert wcdb.get_node("gone.txt") is None
+            try:
+                wcdb.connection.execute("DELETE FROM nodes")
+                assert False, "expected the database to be read only"
+            except sqlite3.OperationalError:
+                pass
+            assert wcdb.get_node("a.txt") is not None
+        finally:
+            wcdb.close()
+    finally:
+        root.rmtree()
+
+def test_working_copy_db_non_ascii_paths():
+    root = path(tempfile.mkdtemp())
+    try:
+        _make_wc_db(root)
+        directory = "d\xc3\xafr"
+        (root / directory).makedirs()
+        connection = sqlite3.connect(root / ".svn" / "wc.db")
+        connection.text_factory = str
+        for relpath, kind in [(directory, "dir"),
+                              (directory + "/\xc3\xa9.txt", "file"),
+                              (directory + "0.txt", "file"),
+                              (directory + ".txt", "file")]:
+            connection.execute("INSERT INTO nodes VALUES (1, ?, 0, ?, 3, "
+                               "'normal', ?, NULL, NULL)", 
+                               (relpath, os.path.dirname(relpath), kind))
+        connection.commit()
+        connection.close()
+        assert svn.versioned_files(root / directory) == ["\xc3\xa9.txt"]
+    finally:
+        root.rmtree()
+
+@patch("uvc.util.run_in_directory")
+def test_working_copy_db_unknown_format(rid):
+    root = path(tempfile.mkdtemp())
+    try:
+        _make_wc_db(root, format=99)
+        try:
+            svn.WorkingCopyDB(root)
+            assert False, "expected WorkingCopyDBError"
+        except svn.WorkingCopyDBError:
+            pass
+        rid.return_value = [0, StringIO(svn_status_xml)]
+        assert svn.versioned_files(root) == ["modified", "only & props", 
+                                             "new", "gone"]
+        assert rid.call_args[0][1] == ["svn", "status", "-v", "--xml"]
+        assert svn.possibly_modified(root, ["a.txt"]) == ["a.txt"]
+    finally:
+        root.rmtree()
@@ -0,0 +1,98 @@
+"""Runs many commands at once from different threads to make sure
+that nothing in the execution path depends on (or changes) the
+process' current directory."""
+import os
+import sys
+import threading
+from Queue import Queue
+
+from uvc.path import path
+from uvc import commands, main, svn
+
+topdir = path(__file__).dirname().abspath() / ".." / ".." / "testfiles" / \
+            "threads"
+
+thread_count = 20
+calls_per_thread = 15
+working_copy_count = 30
+
+working_copies = []
+
+class pwd(commands.DialectCommand):
+    """Reports the directory that the child process runs in."""
+    
+    def get_command_line(self):
+        return [sys.executable, "-c",
+                "import os, sys; sys.stdout.write(os.getcwd())"]
+
+def setup_module(module):
+    if topdir.exists():
+        topdir.rmtree()
+    topdir.makedirs()
+    markers = [".hg", ".git", ".svn"]
+    for i in range(working_copy_count):
+        working_copy = topdir / ("wc%s" % i)
+        (working_copy / markers[i % 3]).makedirs()
+        (working_copy / ("file%s.txt" % i)).write_text("test data")
+        working_copies.append(working_copy.realpath())
+
+def teardown_module(module):
+    topdir.rmtree()
+
+def _run_in_threads(func):
+    """Calls func(i) calls_per_thread times from each of thread_count
+    threads, returning any failures."""
+    failures = Queue()
+    def worker(thread_num):
+        for call_num in range(calls_per_thread):
+            i = thread_num * calls_per_thread + call_num
+            try:
+                func(i)
+            except Exception, e:
+                failures.put((i, e))
+    threads = [threading.Thread(target=worker, args=(n,))
+               for n in range(thread_count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    result = []
+    while not failures.empty():
+        result.append(failures.get())
+    return result
+
+def test_concurrent_run_command():
+    start_dir = os.getcwd()
+    def run_one(i):
+        working_copy = working_copies[i % working_copy_count]
+        context = main.Context(working_copy)
+        command = pwd(commands.status(context, []))
+        output = main.run_command(command, context)
+        assert output.return_code == 0
+        assert str(output) == working_copy, "%s != %s" % (output, 
+                                                          working_copy)
+    failures = _run_in_threads(run_one)
+    assert not failures, failures
+    assert os.getcwd() == start_dir
+    
+def test_concurrent_infer_dialect():
+    start_dir = os.getcwd()
+    expected = ["hg", "git", "svn"]
+    def infer_one(i):
+        index = i % working_copy_count
+        dialect = main.infer_dialect(working_copies[index])
+        assert dialect.name == expected[index % 3]
+    failures = _run_in_threads(infer_one)
+    assert not failures, failures
+    assert os.getcwd() == start_dir
+
+def test_concurrent_svn_revert_all():
+    start_dir = os.getcwd()
+    def revert_one(i):
+        index = i % working_copy_count
+        context = main.Context(working_copies[index])
+        revert = svn.revert(commands.revert(context, []))
+        assert revert.get_command_line() == ["svn", "revert", "-R", "."]
+    failures = _run_in_threads(revert_one)
+    assert not failures, failures
+    assert os.getcwd() == start_dir
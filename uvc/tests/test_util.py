@@ -0,0 +1,348 @@
+import os
+import sys
+import time
+
+from uvc.path import path
+from uvc import commands, main, hg, util, exc
+
+topdir = path(__file__).dirname().abspath() / ".." / ".." / "testfiles"
+
+context = None
+
+def setup_module(module):
+    global context
+    if not topdir.exists():
+        topdir.mkdir()
+    context = main.Context(topdir)
+
+def _python(code):
+    return [sys.executable, "-c", code]
+
+def test_run_in_directory_with_large_output():
+    # more than the pipe can hold, which used to hang
+    command_line = _python("import sys; sys.stdout.write('x' * 2000000)")
+    returncode, stdout = util.run_in_directory(topdir, command_line)
+    assert returncode == 0
+    assert len(stdout.read()) == 2000000
+
+def test_command_stream_yields_output_while_running():
+    marker = topdir / "stream_marker"
+    if marker.exists():
+        marker.unlink()
+    code = """import os, sys, time
+sys.stdout.write("first\\n")
+sys.stdout.flush()
+for i in range(100):
+    if os.path.exists("stream_marker"):
+        break
+    time.sleep(0.1)
+sys.stdout.write("second\\n")
+sys.exit(3)
+"""
+    exit_codes = []
+    stream = util.CommandStream(topdir, _python(code), 
+                                on_exit=exit_codes.append)
+    try:
+        lines = iter(stream)
+        assert lines.next() == "first\n"
+        assert stream.returncode is None
+        marker.write_text("")
+        assert list(lines) == ["second\n"]
+        assert stream.returncode == 3
+        assert exit_codes == [3]
+    finally:
+        marker.unlink()
+    
+def test_command_stream_read_and_chunks():
+    command_line = _python("import sys; sys.stdout.write('a\\nb\\nc')")
+    stream = util.CommandStream(topdir, command_line)
+    assert stream.read(1) == "a"
+    assert stream.readline() == "\n"
+    assert "".join(stream.chunks()) == "b\nc"
+    assert stream.readline() == ""
+    assert stream.returncode == 0
+
+def test_command_stream_close_kills_command():
+    command_line = _python("import time; time.sleep(60)")
+    stream = util.CommandStream(topdir, command_line)
+    stream.close()
+    assert stream.returncode is not None
+    assert stream.returncode != 0
+
+class fake_status(hg.status):
+    def get_command_line(self):
+        return _python("""import sys
+for i in range(50000):
+    sys.stdout.write("M file%s\\0? other%s\\0" % (i, i))
+""")
+
+def test_run_command_streaming_status():
+    command = fake_status(commands.status(context, []))
+    output = main.run_command(command, context, stream=True)
+    assert isinstance(output, commands.StreamingStatusOutput)
+    entries = iter(output)
+    assert entries.next() == ["M", "file0"]
+    assert entries.next() == ["?", "other0"]
+    assert output.return_code is None
+    count = 2 + len(list(entries))
+    assert count == 100000
+    assert output.return_code == 0
+
+class fake_diff(hg.diff):
+    def get_command_line(self):
+        return _python("""import sys
+for i in range(50000):
+    sys.stdout.write("+line %s\\n" % i)
+""")
+
+def test_run_command_streaming_basic_output():
+    command = fake_diff(commands.diff(context, []))
+    output = main.run_command(command, context, stream=True)
+    assert isinstance(output, commands.StreamingOutput)
+    size = sum(len(chunk) for chunk in output.chunks())
+    assert size == len("".join("+line %s\n" % i for i in range(50000)))
+    assert output.return_code == 0
+
+def test_pending_commands_driven_from_one_thread():
+    pending = []
+    for i in range(40):
+        command = fake_diff(commands.diff(context, []))
+        pending.append(main.start_command(command, context))
+    status = main.start_command(fake_status(commands.status(context, [])),
+                                context)
+    pending.append(status)
+    assert not main.wait_for_commands(pending, timeout=60)
+    expected = "".join("+line %s\n" % i for i in range(50000))
+    for command in pending[:-1]:
+        output = command.result()
+        assert isinstance(output, commands.BasicOutput)
+        assert output.return_code == 0
+        assert str(output) == expected
+    assert len(status.result().as_list()) == 100000
+
+class fake_hang(hg.diff):
+    def get_command_line(self):
+        return _python("import time; time.sleep(60)")
+
+def test_pending_command_cancel():
+    pending = main.start_command(fake_hang(commands.diff(context, [])), 
+                                 context)
+    assert main.wait_for_commands([pending], timeout=0.1) == [pending]
+    pending.cancel()
+    assert pending.done()
+    assert pending.stream.returncode is not None
+    try:
+        pending.result()
+        assert False, "Expected CommandCancelled"
+    except exc.CommandCancelled:
+        pass
+
+def test_pending_commands_with_many_descriptors():
+    descriptors = _open_descriptors(1100)
+    try:
+        pending = [main.start_command(fake_diff(commands.diff(context, [])),
+                                      context)
+                   for i in range(3)]
+        assert min(command.fileno() for command in pending) >= 1024
+        assert not main.wait_for_commands(pending, timeout=60)
+        for command in pending:
+            assert command.result().return_code == 0
+    finally:
+        _close_descriptors(descriptors)
+
+def test_pending_commands_cancelled_on_error():
+    pending = main.start_command(fake_hang(commands.diff(context, [])), 
+                                 context)
+    def broken(fds, timeout=None):
+        raise OSError("poll failed")
+    original = util.select_readable
+    util.select_readable = broken
+    try:
+        try:
+            main.wait_for_commands([pending])
+            assert False, "Expected OSError"
+        except OSError:
+            pass
+    finally:
+        util.select_readable = original
+    assert pending.done()
+    assert not _is_running(pending.stream.process.pid)
+
+def _is_running(pid):
+    try:
+        state = open("/proc/%s/stat" % pid).read().split(")")[-1].split()[0]
+    except IOError:
+        return False
+    return state != "Z"
+
+class fake_hung_fetch(hg.update):
+    timeout = 0.5
+    
+    def get_command_line(self):
+        return _python("""import subprocess, sys, time
+child = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"])
+sys.stdout.write("%s\\n" % child.pid)
+sys.stdout.write("partial output\\n")
+sys.stdout.flush()
+time.sleep(60)
+""")
+
+def test_timeout_kills_process_group():
+    command = fake_hung_fetch(commands.update(context, []))
+    output = main.run_command(command, context)
+    assert isinstance(output, commands.TimeoutOutput)
+    assert output.timed_out
+    assert output.timeout == 0.5
+    pid, partial = str(output).splitlines()
+    assert partial == "partial output"
+    for i in range(20):
+        if not _is_running(pid):
+            break
+        time.sleep(0.1)
+    assert not _is_running(pid)
+    
+def test_timeout_for_streaming_output():
+    command = fake_hang(commands.diff(context, []))
+    output = main.run_command(command, context, stream=True, timeout=0.2)
+    assert list(output) == []
+    assert output.timed_out
+    assert output.return_code != 0
+
+def test_timeout_for_pending_command():
+    command = fake_hang(commands.diff(context, []))
+    command.timeout = 0.2
+    pending = main.start_command(command, context)
+    started = time.time()
+    assert not main.wait_for_commands([pending], timeout=30)
+    assert time.time() - started < 10
+    output = pending.result()
+    assert isinstance(output, commands.TimeoutOutput)
+    assert output.timeout == 0.2
+    assert not _is_running(pending.stream.process.pid)
+
+def test_run_in_directory_timeout():
+    command_line = _python("import sys, time; sys.stdout.write('x'); "
+                           "sys.stdout.flush(); time.sleep(60)")
+    try:
+        util.run_in_directory(topdir, command_line, timeout=0.2)
+        assert False, "Expected CommandTimeout"
+    except exc.CommandTimeout, e:
+        assert e.output == "x"
+
+def _open_descriptors(count):
+    """Opens count descriptors, so that the next ones opened are
+    numbered above what select can handle."""
+    import resource
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and soft < count + 64:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (count + 64, hard))
+    return [os.open(os.devnull, os.O_RDONLY) for i in range(count)]
+
+def _close_descriptors(descriptors):
+    for fd in descriptors:
+        os.close(fd)
+
+def test_timeout_with_many_descriptors():
+    descriptors = _open_descriptors(1100)
+    try:
+        returncode, stdout, usage = util.execute(topdir, 
+            _python("print 'hello'"), timeout=10)
+        assert returncode == 0
+        assert stdout.read() == "hello\n"
+        
+        try:
+            util.run_in_directory(topdir, _python("import time; "
+                                  "time.sleep(60)"), timeout=0.2)
+            assert False, "Expected CommandTimeout"
+        except exc.CommandTimeout:
+            pass
+    finally:
+        _close_descriptors(descriptors)
+
+def test_command_stream_killed_on_error():
+    stream = util.CommandStream(topdir, _python("import time; "
+                                                "time.sleep(60)"),
+                                timeout=10)
+    original = util.wait_readable
+    def broken(fd, timeout=None):
+        raise ValueError("broken")
+    util.wait_readable = broken
+    try:
+        try:
+            stream.read()
+            assert False, "Expected ValueError"
+        except ValueError:
+            pass
+    finally:
+        util.wait_readable = original
+    # killed and reaped
+    assert stream.returncode is not None
+    assert not _is_running(stream.process.pid)
+
+def test_default_timeouts():
+    local = hg.diff(commands.diff(context, []))
+    remote = hg.update(commands.update(context, []))
+    assert main.get_timeout(local) == main.local_timeout
+    assert main.get_timeout(remote) == main.remote_timeout
+    assert main.local_timeout < main.remote_timeout
+    assert main.get_timeout(fake_hung_fetch(commands.update(context, []))) \
+        == 0.5
+
+class fake_busy_diff(hg.diff):
+    def get_command_line(self):
+        return _python("""import sys, time
+data = "x" * 20000000
+end = time.time() + 0.2
+while time.time() < end:
+    pass
+sys.stdout.write("y" * 1000)
+""")
+
+def test_usage_is_measured_and_reported():
+    reported = []
+    def sink(command, context, usage):
+        reported.append((command, context, usage))
+    main.add_usage_sink(sink)
+    try:
+        command = fake_busy_diff(commands.diff(context, []))
+        output = main.run_command(command, context)
+    finally:
+        main.remove_usage_sink(sink)
+    usage = output.usage
+    assert reported == [(command, context, usage)]
+    assert usage.bytes_out == 1000
+    assert usage.wall_time >= 0.2
+    assert usage.user_time + usage.system_time >= 0.1
+    # kilobytes; the child held a 20MB string
+    assert usage.max_rss > 20000
+
+def test_usage_for_streaming_and_timeouts():
+    reported = []
+    main.add_usage_sink(lambda command, context, usage: 
+                        reported.append(usage))
+    try:
+        command = fake_diff(commands.diff(context, []))
+        output = main.run_command(command, context, stream=True)
+        assert output.usage is None
+        list(output)
+        assert output.usage.bytes_out == len("".join("+line %s\n" % i 
+                                                     for i in range(50000)))
+        
+        command = fake_hang(commands.diff(context, []))
+        output = main.run_command(command, context, timeout=0.1)
+        assert output.timed_out
+        assert output.usage.wall_time >= 0.1
+        assert len(reported) == 2
+    finally:
+        del main.usage_sinks[:]
+
+def test_split_arguments():
+    arguments = ["x" * 10] * 10
+    # each argument takes up 19 bytes, "cmd" 12
+    chunks = util.split_arguments(["cmd"], arguments, limit=12 + 19 * 3)
+    assert [len(chunk) for chunk in chunks] == [3, 3, 3, 1]
+    assert sum(chunks, []) == arguments
+    assert util.split_arguments(["cmd"], ["x" * 100, "y"], limit=50) == \
+        [["x" * 100], ["y"]]
+    assert util.command_line_size(["cmd"] + chunks[0]) <= 12 + 19 * 3
+    assert 4096 <= util.arg_max() <= util.max_command_line
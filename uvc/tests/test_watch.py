@@ -0,0 +1,75 @@
+import subprocess
+import tempfile
+
+from uvc.path import path
+from uvc import watch, inotify
+from uvc.tests.mock import patch
+
+repodir = None
+
+def _git(*args):
+    subprocess.check_call(["git", "-c", "user.name=uvc", 
+                           "-c", "user.email=uvc@example.com"] + list(args),
+                          cwd=repodir, stdout=subprocess.PIPE)
+
+def setup_module(module):
+    global repodir
+    repodir = path(tempfile.mkdtemp()).realpath()
+    (repodir / "sub").mkdir()
+    (repodir / "a.txt").write_bytes("a\n")
+    (repodir / "sub" / "b.txt").write_bytes("b\n")
+    _git("init", "-q")
+    _git("add", ".")
+    _git("commit", "-q", "-m", "first")
+
+def teardown_module(module):
+    repodir.rmtree()
+
+def test_status_watcher_only_looks_at_changes():
+    if not inotify.available():
+        return
+    watcher = watch.StatusWatcher(repodir / "sub")
+    try:
+        assert watcher.root == repodir
+        assert watcher.status().as_list() == []
+        assert watcher.status().as_list() == []
+        assert (watcher.full_runs, watcher.partial_runs) == (1, 0)
+        
+        (repodir / "a.txt").write_bytes("changed\n")
+        assert watcher.status().as_list() == [["M", "a.txt"]]
+        assert (watcher.full_runs, watcher.partial_runs) == (1, 1)
+        
+        (repodir / "new" / "deeper").makedirs()
+        (repodir / "new" / "deeper" / "c.txt").write_bytes("c\n")
+        (repodir / "sub" / "b.txt").remove()
+        assert watcher.status().as_list() == [["M", "a.txt"], 
+                                              ["?", "new/"],
+                                              ["!", "sub/b.txt"]]
+        (repodir / "new" / "deeper" / "d.txt").write_bytes("d\n")
+        (repodir / "a.txt").write_bytes("a\n")
+        assert watcher.status().as_list() == [["?", "new/"],
+                                              ["!", "sub/b.txt"]]
+        (repodir / "new").rmtree()
+        assert watcher.status().as_list() == [["!", "sub/b.txt"]]
+        assert watcher.full_runs == 1
+        
+        # changes to the index mean starting over
+        _git("rm", "-q", "sub/b.txt")
+        assert watcher.status().as_list() == [["R", "sub/b.txt"]]
+        assert watcher.full_runs == 2
+    finally:
+        watcher.close()
+        _git("reset", "-q", "--hard")
+
+@patch("uvc.inotify.available")
+def test_status_watcher_without_inotify(available):
+    available.return_value = False
+    watcher = watch.StatusWatcher(repodir)
+    try:
+        assert watcher.status().as_list() == []
+        (repodir / "a.txt").write_bytes("changed\n")
+        assert watcher.status().as_list() == [["M", "a.txt"]]
+        assert (watcher.full_runs, watcher.partial_runs) == (2, 0)
+    finally:
+        watcher.close()
+        _git("reset", "-q", "--hard")
@@ -11,7 +11,8 @@ topdir = (path(__file__).parent)
 def mock_run_command(command_output, create_dir=None):
     """Monkeypatches in a new run_command function in uvc.main
     so that we can pretend about what happens when you run the
-    command."""
+    command. command_output can also be a dictionary of the output
+    for each dialect, keyed by name."""
     run_command_params = []
     def new_run_command(command, context):
         run_command_params.append(command)
@@ -19,7 +20,10 @@ def mock_run_command(command_output, create_dir=None):
         if create_dir is not None:
             working_dir = path(context.working_dir)
             (working_dir / create_dir).mkdir()
-        return command.process_output(0, StringIO(command_output))
+        output = command_output
+        if isinstance(output, dict):
+            output = output[command.dialect_name]
+        return command.process_output(0, StringIO(output))
         
     def entangle(func):
         @wraps(func)
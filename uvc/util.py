@@ -1,17 +1,347 @@
 """Utility functions used by uvc."""
 
 import os
+import sys
+import math
+import time
+import errno
+import select
+import signal
 import subprocess
+from cStringIO import StringIO
 
-def run_in_directory(working_dir, command_line):
-    current_dir = os.getcwd()
-    os.chdir(working_dir)
+from uvc.exc import CommandTimeout
+
+# how much to read from the child's pipe at a time
+read_size = 65536
+
+# the most argument bytes to put on one command line, even where the
+# system allows more; copying huge command lines around is slow too
+max_command_line = 256 * 1024
+
+# what each argument costs besides its text: the NUL and the pointer
+_argument_overhead = 1 + 8
+
+def wait_readable(fd, timeout=None):
+    """Waits up to timeout seconds (forever if None) for fd to become
+    readable, returning True if it did."""
+    return bool(select_readable([fd], timeout))
+
+def select_readable(fds, timeout=None):
+    """Waits up to timeout seconds (forever if None) for any of fds to
+    become readable (or reach the end of their input), and returns
+    those that did. This uses poll where there is one, since select
+    can't handle descriptors numbered 1024 or more."""
+    if not hasattr(select, "poll"):
+        return _retry_on_eintr(select.select, fds, [], [], timeout)[0]
+    poller = select.poll()
+    for fd in fds:
+        poller.register(fd, select.POLLIN | select.POLLPRI)
+    if timeout is not None:
+        timeout = int(math.ceil(timeout * 1000))
+    # hang ups and errors are reported whether asked for or not, and
+    # reading is how they are found out about
+    return [fd for fd, event in _retry_on_eintr(poller.poll, timeout)]
+
+def _retry_on_eintr(function, *args):
+    while True:
+        try:
+            return function(*args)
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+
+class CommandStream(object):
+    """A command running in a working directory whose combined
+    stdout/stderr can be consumed while the command is still
+    running. This is file-like (read and readline work), iterating
+    over it yields lines and chunks() yields blocks of output as
+    they arrive. returncode is set once the output is exhausted.
+    
+    on_exit, if given, is called with the return code once the
+    command has finished.
+    
+    The command runs in its own process group. If timeout (in seconds)
+    is given and the command is still running when it expires, the
+    whole group (including, for example, ssh processes started by the
+    VCS) is killed, timed_out is set and the output simply ends.
+    
+    Once the command has finished, usage is a ResourceUsage."""
+    
+    timed_out = False
+    usage = None
+    
+    def __init__(self, working_dir, command_line, on_exit=None, 
+                 timeout=None):
+        self._started = time.time()
+        self._bytes_out = 0
+        self.process = subprocess.Popen(command_line, cwd=working_dir,
+                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                    preexec_fn=_new_process_group)
+        self.on_exit = on_exit
+        self.returncode = None
+        self.timeout = timeout
+        if timeout is not None:
+            self._deadline = time.time() + timeout
+        self._fd = self.process.stdout.fileno()
+        self._buffer = ""
+        # how much of _buffer has already been handed out
+        self._pos = 0
+        self._eof = False
+    
+    def _fill(self):
+        """Reads whatever the child has available, returning False
+        at the end of the output."""
+        if self._eof:
+            return False
+        try:
+            if self.timeout is not None:
+                remaining = max(self._deadline - time.time(), 0)
+                if not wait_readable(self._fd, remaining):
+                    self.timed_out = True
+                    self._kill()
+                    return False
+            data = os.read(self._fd, read_size)
+        except:
+            # don't leave the command running, or unreaped
+            if self.returncode is None:
+                self._kill()
+            raise
+        if not data:
+            self._eof = True
+            self._finish()
+            return False
+        self._bytes_out += len(data)
+        self._buffer = self._buffer[self._pos:] + data
+        self._pos = 0
+        return True
+    
+    def _take(self, end):
+        data = self._buffer[self._pos:end]
+        self._pos = end
+        return data
+    
+    def _finish(self):
+        self.process.stdout.close()
+        self.returncode, rusage = _wait_with_rusage(self.process)
+        self.usage = ResourceUsage(time.time() - self._started,
+                                   self._bytes_out, rusage)
+        if self.on_exit is not None:
+            self.on_exit(self.returncode)
+    
+    def read(self, size=-1):
+        if size < 0:
+            chunks = [self._take(len(self._buffer))]
+            while self._fill():
+                chunks.append(self._take(len(self._buffer)))
+            return "".join(chunks)
+        while len(self._buffer) - self._pos < size and self._fill():
+            pass
+        return self._take(min(self._pos + size, len(self._buffer)))
+    
+    def readline(self):
+        start = self._pos
+        while True:
+            index = self._buffer.find("\n", start)
+            if index != -1:
+                return self._take(index + 1)
+            start = len(self._buffer) - self._pos
+            if not self._fill():
+                return self._take(len(self._buffer))
+    
+    def __iter__(self):
+        line = self.readline()
+        while line:
+            yield line
+            line = self.readline()
+    
+    def chunks(self):
+        """Yields output in the pieces the child produced it, without
+        waiting for line breaks."""
+        data = self.read_available()
+        while data:
+            yield data
+            data = self.read_available()
+    
+    def read_available(self):
+        """Returns output that is buffered or that the child has
+        already written, reading from the pipe at most once. This only
+        blocks if nothing at all is available, so after an event loop
+        reports fileno() as readable it returns immediately. An
+        empty string means the command has finished."""
+        if self._pos == len(self._buffer):
+            self._fill()
+        return self._take(len(self._buffer))
+    
+    def fileno(self):
+        return self._fd
+    
+    def close(self):
+        """Stops reading. If the command is still running, it is
+        killed."""
+        if self.returncode is not None:
+            return
+        self._buffer = ""
+        self._pos = 0
+        self._kill()
+    
+    def _kill(self):
+        _kill_process_group(self.process)
+        self._eof = True
+        self._finish()
+    
+class ResourceUsage(object):
+    """What running a command cost: wall_time, user_time and
+    system_time in seconds, max_rss in kilobytes and bytes_out, the
+    amount of output. The CPU and memory figures are None when they
+    could not be measured."""
+    
+    def __init__(self, wall_time, bytes_out, rusage=None):
+        self.wall_time = wall_time
+        self.bytes_out = bytes_out
+        if rusage is not None:
+            self.user_time = rusage.ru_utime
+            self.system_time = rusage.ru_stime
+            self.max_rss = rusage.ru_maxrss
+        else:
+            self.user_time = self.system_time = self.max_rss = None
+    
+    def __repr__(self):
+        return "<ResourceUsage wall=%s user=%s sys=%s max_rss=%s out=%s>" \
+            % (self.wall_time, self.user_time, self.system_time, 
+               self.max_rss, self.bytes_out)
+
+def _wait_with_rusage(process):
+    """Waits for the process, returning its return code and its
+    resource usage (None where os.wait4 is not available)."""
+    if not hasattr(os, "wait4") or process.returncode is not None:
+        return process.wait(), None
+    while True:
+        try:
+            pid, status, rusage = os.wait4(process.pid, 0)
+            break
+        except OSError, e:
+            if e.errno != errno.EINTR:
+                raise
+    # let Popen know the process is gone and decode its status
+    process._handle_exitstatus(status)
+    return process.returncode, rusage
+
+def _new_process_group():
+    if hasattr(os, "setsid"):
+        os.setsid()
+
+def _kill_process_group(process):
+    """Kills the process and anything it started. The group outlives
+    its leader, so this is worth doing even if the process itself
+    has exited."""
+    if hasattr(os, "killpg"):
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            # the whole group is already gone
+            pass
+    elif process.poll() is None:
+        process.kill()
+
+def read_chunks(stream):
+    """Yields the contents of stream (a CommandStream or file-like
+    object) in pieces, as soon as they are available."""
+    if hasattr(stream, "chunks"):
+        for chunk in stream.chunks():
+            yield chunk
+        return
+    chunk = stream.read(read_size)
+    while chunk:
+        yield chunk
+        chunk = stream.read(read_size)
+
+def split_records(stream, separator="\0"):
+    """Yields the separator-terminated records in stream (without
+    the separator), reading it in pieces rather than all at once. A
+    final record without a separator is yielded as well."""
+    partial = ""
+    for chunk in read_chunks(stream):
+        records = chunk.split(separator)
+        if partial:
+            records[0] = partial + records[0]
+        partial = records.pop()
+        for record in records:
+            yield record
+    if partial:
+        yield partial
+
+def is_full_hash(revision):
+    """Returns True if revision is a full SHA-1 or SHA-256 hash, which
+    always names the same commit."""
+    return len(revision) in (40, 64) and \
+        revision.strip("0123456789abcdefABCDEF") == ""
+
+def arg_max():
+    """Returns roughly how many bytes of arguments a command can be
+    given: the system's limit less what the environment takes up, and
+    no more than max_command_line."""
+    if sys.platform == "win32":
+        # CreateProcess's limit, in characters
+        return min(32767 - 1024, max_command_line)
     try:
-        p = subprocess.Popen(command_line, 
-                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        p.wait()
-    finally:
-        os.chdir(current_dir)
-    
-    return [p.returncode, p.stdout]
-    
\ No newline at end of file
+        limit = os.sysconf("SC_ARG_MAX")
+    except (ValueError, OSError, AttributeError):
+        limit = -1
+    if limit <= 0:
+        # the smallest limit POSIX allows
+        limit = 4096 * 8
+    environment = sum(len(key) + len(value) + 1 + _argument_overhead
+                      for key, value in os.environ.items())
+    # leave room for anything the VCS passes on to the programs it runs
+    return max(min(limit - environment - 4096, max_command_line), 4096)
+
+def command_line_size(command_line):
+    return sum(len(part) + _argument_overhead for part in command_line)
+
+def split_arguments(prefix, arguments, limit=None):
+    """Splits arguments into lists that each fit on a command line
+    after prefix, in no more than limit bytes (arg_max() by default).
+    An argument too long to fit gets a list of its own."""
+    if limit is None:
+        limit = arg_max()
+    room = limit - command_line_size(prefix)
+    chunks = []
+    chunk = []
+    size = 0
+    for argument in arguments:
+        argument_size = len(argument) + _argument_overhead
+        if chunk and size + argument_size > room:
+            chunks.append(chunk)
+            chunk = []
+            size = 0
+        chunk.append(argument)
+        size += argument_size
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+def execute(working_dir, command_line, timeout=None):
+    """Runs command_line with working_dir as the child's current
+    directory, returning the return code, a file-like object with
+    the output and a ResourceUsage. The process-wide current directory
+    is never changed, so this can safely be called from several
+    threads at once.
+    
+    The output is read while the command runs, so a command with
+    more output than fits in the pipe cannot block.
+    
+    If timeout is given and expires, the command's process group
+    is killed and CommandTimeout is raised carrying the output
+    captured so far."""
+    stream = CommandStream(working_dir, command_line, timeout=timeout)
+    output = stream.read()
+    if stream.timed_out:
+        raise CommandTimeout("Command timed out after %s seconds: %s"
+                             % (timeout, " ".join(command_line)),
+                             timeout, output, stream.usage)
+    return [stream.returncode, StringIO(output), stream.usage]
+
+def run_in_directory(working_dir, command_line, timeout=None):
+    """Like execute, but only returns the return code and output."""
+    return execute(working_dir, command_line, timeout)[:2]
@@ -0,0 +1,216 @@
+"""Keeps the status of a working copy up to date in memory, for
+callers (editors, for instance) that ask for it over and over.
+
+A StatusWatcher runs one full status, then uses inotify to learn which
+files have changed and runs status only for those. If the VCS's own
+record of the working copy (the hg dirstate, git index or svn wc.db)
+changes, because of a commit or an add for example, or if inotify
+loses track of events, the next status is a full one again. Without
+inotify every status is a full one."""
+
+import os
+import logging
+import threading
+
+from uvc import commands, inotify
+from uvc.exc import UVCError
+
+log = logging.getLogger("uvc.watch")
+
+# hg prints a warning for each plain filename that doesn't exist, which
+# would end up in the middle of the output. path: patterns don't warn.
+_pattern_prefix = dict(hg="path:")
+
+# VCS metadata directories, which aren't watched
+_markers = set([".hg", ".git", ".svn"])
+
+class StatusWatcher(object):
+    """Serves the status of the working copy that working_dir is in.
+    Paths are relative to the root of the working copy.
+
+    When more than max_targets files have changed, a full status is
+    run instead of naming them all on the command line."""
+
+    def __init__(self, working_dir, max_targets=500):
+        from uvc import main
+        self.dialect, self.root = main.find_repository(working_dir)
+        if self.dialect is None:
+            raise UVCError("%s is not in a working copy" % working_dir)
+        self.context = main.Context(self.root)
+        self.max_targets = max_targets
+        self.lock = threading.Lock()
+
+        # path -> state, for everything status reports
+        self.entries = {}
+        self.dirty = set()
+        self.needs_rescan = True
+        self.state_signature = None
+
+        # how many times status was run on the whole working copy, and
+        # on just the files that changed
+        self.full_runs = 0
+        self.partial_runs = 0
+
+        self.notifier = None
+        self.watches = {}
+        if inotify.available():
+            try:
+                self.notifier = inotify.Inotify()
+                self._watch_tree("")
+            except inotify.InotifyError, e:
+                log.warning("Not watching %s, every status will be a "
+                            "full one: %s", self.root, e)
+                self._stop_watching()
+
+    def _watch_tree(self, relative):
+        """Adds watches for the directory (relative to the root) and
+        everything below it, except for VCS metadata."""
+        pending = [relative]
+        while pending:
+            relative = pending.pop()
+            directory = os.path.join(self.root, relative)
+            try:
+                wd = self.notifier.add_watch(directory, inotify.IN_CHANGES |
+                        inotify.IN_ONLYDIR | inotify.IN_DONT_FOLLOW)
+            except inotify.InotifyError:
+                if os.path.isdir(directory):
+                    # out of watches, most likely
+                    raise
+                continue
+            self.watches[wd] = relative
+            try:
+                names = os.listdir(directory)
+            except OSError:
+                continue
+            for name in names:
+                child = os.path.join(directory, name)
+                if name not in _markers and os.path.isdir(child) \
+                   and not os.path.islink(child):
+                    pending.append(os.path.join(relative, name))
+
+    def _unwatch_tree(self, relative):
+        prefix = relative + "/"
+        for wd, watched in self.watches.items():
+            if watched == relative or watched.startswith(prefix):
+                self.notifier.remove_watch(wd)
+                del self.watches[wd]
+
+    def _stop_watching(self):
+        if self.notifier is not None:
+            self.notifier.close()
+        self.notifier = None
+        self.watches = {}
+
+    def _read_events(self):
+        for wd, mask, cookie, name in self.notifier.read_events():
+            if mask & inotify.IN_Q_OVERFLOW:
+                log.debug("inotify queue overflowed for %s", self.root)
+                self.needs_rescan = True
+                continue
+            if mask & inotify.IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            directory = self.watches.get(wd)
+            if directory is None or not name or name in _markers:
+                continue
+            relative = os.path.join(directory, name)
+            self.dirty.add(relative)
+            if mask & inotify.IN_ISDIR:
+                if mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO):
+                    self._watch_tree(relative)
+                elif mask & (inotify.IN_DELETE | inotify.IN_MOVED_FROM):
+                    self._unwatch_tree(relative)
+
+    def _get_state_signature(self):
+        marker = os.path.join(self.root, self.dialect.marker)
+        for name in self.dialect.state_files:
+            try:
+                info = os.stat(os.path.join(marker, name))
+            except OSError:
+                continue
+            return (name, info.st_ino, info.st_size, info.st_mtime)
+        return None
+
+    def _run_status(self, targets=None):
+        from uvc import main
+        generic = commands.status(self.context, [])
+        # the targets may no longer exist, so they're set directly rather
+        # than being checked by the command
+        if targets:
+            prefix = _pattern_prefix.get(self.dialect.name, "")
+            generic.targets = [prefix + target for target in targets]
+        command = self.dialect.convert(generic)
+        output = main.run_command(command, self.context)
+        if getattr(output, "timed_out", False):
+            raise UVCError("status timed out in %s" % self.root)
+        return output
+
+    def _full_status(self):
+        self.dirty.clear()
+        output = self._run_status()
+        self.entries = dict((filename, state) for state, filename in output)
+        self.needs_rescan = False
+        self.full_runs += 1
+
+    def _is_covered(self, relative):
+        """True if a directory above relative has changed too, or is
+        reported as unknown or ignored as a whole."""
+        directory = os.path.dirname(relative)
+        while directory:
+            if directory in self.dirty:
+                return True
+            for key in (directory, directory + "/"):
+                if self.entries.get(key) in (commands.StatusOutput.UNKNOWN,
+                                             commands.StatusOutput.IGNORED):
+                    return True
+            directory = os.path.dirname(directory)
+        return False
+
+    def _partial_status(self):
+        changed = [relative for relative in self.dirty
+                   if not self._is_covered(relative)]
+        self.dirty.clear()
+        if len(changed) > self.max_targets:
+            self._full_status()
+            return
+
+        for relative in changed:
+            prefix = relative + "/"
+            for filename in self.entries.keys():
+                if filename == relative or filename.startswith(prefix):
+                    del self.entries[filename]
+        if not changed:
+            return
+        output = self._run_status(sorted(changed))
+        for state, filename in output:
+            self.entries[filename] = state
+        self.partial_runs += 1
+
+    def status(self):
+        """Returns a commands.StatusOutput for the working copy, in
+        filename order."""
+        with self.lock:
+            if self.notifier is not None:
+                self._read_events()
+            signature = self._get_state_signature()
+            try:
+                if self.notifier is None or self.needs_rescan \
+                   or signature != self.state_signature:
+                    self._full_status()
+                elif self.dirty:
+                    self._partial_status()
+            except:
+                # what is in memory can't be trusted any more
+                self.needs_rescan = True
+                raise
+            # running status can update these files itself
+            self.state_signature = self._get_state_signature()
+
+            output = commands.StatusOutput(0)
+            for filename in sorted(self.entries):
+                output.append(self.entries[filename], filename)
+            return output
+
+    def close(self):
+        with self.lock:
+            self._stop_watching()